@@ -3,17 +3,41 @@
 #
 # Copyright (c) 2020 - Early Ehlinger, thenewentity.com
 #
+DEFAULT_BUFFER_SIZE = 1 << 20
+
+# ' X%.5f' style formats, built once per coordinate letter.
+coordinateFormats = {}
+
+def coordinateFormat(c):
+    result = coordinateFormats.get(c)
+    if result is None:
+        result = coordinateFormats[c] = f' {c}%.5f'
+    return result
+
 def gcodeCoordinate(c,v):
     if v != None:
-        return f' {c}{v:.5f}'
+        return coordinateFormat(c) % v
     return ''
 
 def gcodeCoordinates(**kwargs):
-    coord = gcodeCoordinate
-    result = ''
-    for key in kwargs:
-        result = result + coord(key,kwargs[key])
-    return result
+    return ''.join([coordinateFormat(key) % value for key, value in kwargs.items() if value is not None])
+
+# Comment verbosity levels, from quietest to noisiest.
+VERBOSITY_NONE = 0
+VERBOSITY_SUMMARY = 1
+VERBOSITY_TRACE = 2
+
+verbosityLevels = {
+    'none': VERBOSITY_NONE,
+    'summary': VERBOSITY_SUMMARY,
+    'trace': VERBOSITY_TRACE,
+}
+
+def formatComment(comment):
+    # Comments may be passed as (format, *args) so that they are only formatted when written.
+    if isinstance(comment, tuple):
+        return comment[0].format(*comment[1:])
+    return comment
 
 def encodeComment(comment):
     return comment.replace("(","{").replace(")","}")
@@ -26,23 +50,114 @@ def xstr(s):
         return ''
     return str(s)
 
+def movedTo(position, words):
+    """Where the X and Y words of a move take the tool from position; an axis without a word stays put."""
+    return (words.get('X', position[0]), words.get('Y', position[1]))
+
+def formatCode(prefix, code, words, comment):
+    return f'{prefix}{xstr(code)}{gcodeCoordinates(**words)}{wrapComment(comment, " ")}\n'
+
+class GcodeOutput:
+    """Collects gcode text and writes it to a binary stream in blocks of about bufferSize characters."""
+    parallel = False
+
+    def __init__(self, stream, bufferSize = DEFAULT_BUFFER_SIZE):
+        self.stream = stream
+        self.bufferSize = bufferSize
+        self.chunks = []
+        self.size = 0
+        self.written = 0
+        # Last X/Y moved to, for planning travel from where the tool is.
+        self.position = (0, 0)
+
+    def write(self, text):
+        self.chunks.append(text)
+        self.size += len(text)
+        self.written += len(text)
+        if self.size >= self.bufferSize:
+            self.flush()
+
+    def code(self, prefix, code, words, comment):
+        self.write(formatCode(prefix, code, words, comment))
+
+    def getPosition(self):
+        return self.position
+
+    def operation(self, gcodeStyle):
+        """Marks where the gcode of an element's toolpath starts (its gcodeStyle) or ends (None), for planning.
+
+        Before anything is cut, operation(None) marks the end of setting up the machine.
+        """
+        pass
+
+    def flush(self):
+        if self.chunks:
+            self.stream.write(''.join(self.chunks).encode('utf-8'))
+            self.chunks = []
+            self.size = 0
+
 class GcodeExporter:
-    def __init__(self, stream, document, depth):
+    def __init__(self, stream, document, depth, verbosity = VERBOSITY_TRACE, output = None, cache = None):
         self.stream = stream
         self.depth = depth
         self.document = document
+        self.verbosity = verbosity
+        self.output = output or GcodeOutput(stream)
+        self.cache = cache
+        self.prefix = ' ' * depth
+        self.indented = None
 
     def _write(self, code):
-        self.stream.write((' ' * self.depth + code).encode('utf-8'))
+        self.output.write(self.prefix + code)
 
     def _code(self, code=None, comment = None, **kwargs):
-        self._write(f'{xstr(code)}{gcodeCoordinates(**kwargs)}{wrapComment(comment," ")}\n')
-
-    def comment(self, comment):
-        self._write(wrapComment(comment) + '\n')
+        # Inline comments on codes are trace output.
+        comment = formatComment(comment) if self.verbosity >= VERBOSITY_TRACE else None
+        if 'X' in kwargs or 'Y' in kwargs:
+            self.output.position = movedTo(self.output.position, kwargs)
+        self.output.code(self.prefix, code, kwargs, comment)
+
+    def flush(self):
+        self.output.flush()
+
+    def getPosition(self):
+        return self.output.getPosition()
+
+    def isTracing(self):
+        return self.verbosity >= VERBOSITY_TRACE
+
+    def comment(self, comment, *args, level = VERBOSITY_SUMMARY):
+        """Write a comment line if level is enabled. args are only formatted into comment when written."""
+        if level <= self.verbosity:
+            self._write(wrapComment(comment.format(*args) if args else comment) + '\n')
+
+    def trace(self, comment, *args):
+        self.comment(comment, *args, level=VERBOSITY_TRACE)
+
+    def emit(self, records):
+        """Write the moves.Move and moves.Comment records a toolpath generator yields, as they are yielded."""
+        output = self.output
+        verbosity = self.verbosity
+        prefixes = []
+        for record in records:
+            indent = record.indent
+            while len(prefixes) <= indent:
+                prefixes.append(' ' * (self.depth + 2 * len(prefixes)))
+            record.emit(output, prefixes[indent], verbosity)
 
     def indent(self):
-        return GcodeExporter(self.stream, self.document, self.depth + 2)
+        if self.indented is None:
+            self.indented = GcodeExporter(self.stream, self.document, self.depth + 2, self.verbosity, self.output,
+                                          self.cache)
+        return self.indented
+
+    def withVerbosity(self, verbosity):
+        if verbosity is None or verbosity == self.verbosity:
+            return self
+        return GcodeExporter(self.stream, self.document, self.depth, verbosity, self.output, self.cache)
+
+    def withOutput(self, output):
+        return GcodeExporter(self.stream, self.document, self.depth, self.verbosity, output, self.cache)
 
     def rapid(self, comment, **kwargs):
         self._code(code='G00', comment=comment, **kwargs)
@@ -1,6 +1,10 @@
+import functools
 import json
 import re
 
+from GcodeExporter import verbosityLevels
+from instrumentation import instrumented
+
 distanceRegex = re.compile('(([0-9]*(\\.[0-9]*)?)(/([0-9]*(\\.[0-9]*)?))?)(px|in|mm|cm|Q|pc|pt)?')
 unitFactors = { 'in': 25.4, 'px': 25.4 / 96.0, 'cm': 1.0/100.0, 'mm': 1.0, 'Q': 40.0/100.0, 'pc': 25.4/6.0, 'pt': 25.4/72.0 }
 assert distanceRegex.match('3in')
@@ -13,6 +17,24 @@ def isNumber(value):
 def mmFromInch(value):
     return value * 25.4
 
+@functools.lru_cache(maxsize=256)
+def parseDistance(value):
+    """Returns (unitValue, unit, scaledValue) for a distance string, or None if it doesn't parse."""
+    match = distanceRegex.match(value)
+    if match is None:
+        return None
+    numerator = float(match.group(2))
+    denominator = match.group(5)
+    if denominator is None:
+        denominator = 1.0
+    else:
+        denominator = float(denominator)
+    unit = match.group(7) or 'mm'
+    unitFactor = unitFactors.get(unit, 'mm')
+
+    unitValue = numerator / denominator
+    return unitValue, unit, unitValue * unitFactor
+
 def distance(value, defaultValue = None, stream = None):
     if isNumber(value):
         return value
@@ -20,21 +42,11 @@ def distance(value, defaultValue = None, stream = None):
     unitValue = None
     unit = None
     if not value is None:
-        match = distanceRegex.match(value)
-        if not match is None:
-            numerator = float(match.group(2))
-            denominator = match.group(5)
-            if denominator is None:
-                denominator = 1.0
-            else:
-                denominator = float(denominator)
-            unit = match.group(7) or 'mm'
-            unitFactor = unitFactors.get(unit, 'mm')
-
-            unitValue = numerator / denominator
-            scaledValue = unitValue * unitFactor
+        parsed = parseDistance(value)
+        if not parsed is None:
+            unitValue, unit, scaledValue = parsed
     if stream:
-        stream.comment(f"distance: \"{value}\" {unitValue}{unit} {scaledValue}mm")
+        stream.trace('distance: "{}" {}{} {}mm', value, unitValue, unit, scaledValue)
     return scaledValue
 
 class GcodeStyle:
@@ -57,32 +69,69 @@ class GcodeStyle:
         self.toolDiameter = distance(style.get(f"-gcode-tool-{self.tool}-diameter", mmFromInch(0.25)))
         self.toolStepOver = distance(style.get(f"-gcode-tool-{self.tool}-stepover", self.toolDiameter * 0.8 ))
         self.stepOver = distance(style.get("-gcode-stepover", self.toolStepOver))
+        # The T word of the tool when exports are grouped by tool; None numbers it by the order it is used in.
+        toolNumber = style.get(f"-gcode-tool-{self.tool}-number", None)
+        self.toolNumber = int(toolNumber) if toolNumber is not None and toolNumber.isdigit() else None
 
-        # Todo: switch from curveIncrement to maxCurveSegmentLength
         self.curveIncrement = distance(style.get("-gcode-curve-increment", None), 0.05)
         if self.curveIncrement < 0:
             self.curveIncrement = 0.05
         if self.curveIncrement > 1:
             self.curveIncrement = 1
+        # When set, curves are flattened to this chordal tolerance instead of curveIncrement.
+        self.curveTolerance = distance(style.get("-gcode-curve-tolerance", None), None)
+        if self.curveTolerance is not None and self.curveTolerance <= 0:
+            self.curveTolerance = None
         self.edgeMode = style.get("-gcode-edge-mode", 'center')
         self.fillMode = style.get("-gcode-fill-mode", '')
+        self.travelOrder = style.get("-gcode-travel-order", 'document')
+        self.verbosity = style.get("-gcode-verbosity", None)
 
         self.feedxy = distance(style.get("-gcode-feed-xy", None), mmFromInch(25))
         self.feedz = distance(style.get("-gcode-feed-z", None), mmFromInch(10))
 
         self.rapidxy = distance(style.get("-gcode-rapid-xy", None), mmFromInch(60))
         self.rapidz = distance(style.get("-gcode-rapid-z", None), mmFromInch(60))
-        self.supportsCubicSpline = False
+        # lines, arcs (G02/G03 fitted to curves) or cubic (G5 where the depth is constant, else arcs).
+        self.curveOutput = style.get("-gcode-curve-output", 'lines')
+        self.supportsCubicSpline = self.curveOutput == 'cubic'
         self.safeHeight = mmFromInch(0.25)
 
+    def getVerbosity(self):
+        return verbosityLevels.get(self.verbosity, None)
+
+    def fillsArea(self):
+        return self.fillMode in ('hatch', 'zigzag')
+
     def hasTabs(self):
         return self.tabHeight and self.tabWidth and self.tabStartInterval
 
+@instrumented('style')
+def composeStyle(element, parentStyle = None):
+    """element.composed_style(), but built on the parent's already composed style when there is one."""
+    if parentStyle is None:
+        return element.composed_style()
+    if hasattr(element, 'cascaded_style'):
+        # inkex >= 1.2: cascade, then inherit from the parent like Style.specified_style does.
+        return element.cascaded_style().add_inherited(parentStyle)
+    return parentStyle + element.style
+
+def isGcodeProperty(key):
+    return key == 'display' or key.startswith('-gcode-')
+
+@functools.lru_cache(maxsize=1024)
+def cachedGcodeStyle(properties):
+    # GcodeStyle only reads display and -gcode-* properties, so elements that agree on those share one.
+    return GcodeStyle(dict(properties))
+
+@instrumented('style')
 def getGcodeStyle(stream, style):
-    stream.comment(f'SvgStyle: {style}')
-    result = GcodeStyle(style, stream=stream)
-    stream.comment(f'GcodeStyle: {json.dumps(result.__dict__)}')
+    stream.trace('SvgStyle: {}', style)
+    result = cachedGcodeStyle(tuple(sorted((key, value) for key, value in style.items() if isGcodeProperty(key))))
+    if stream.isTracing():
+        stream.trace('GcodeStyle: {}', json.dumps(result.__dict__))
     return result
 
-def getElementGcodeStyle(stream, element):
-    return getGcodeStyle(stream, element.composed_style())
+@instrumented('style')
+def getElementGcodeStyle(stream, element, parentStyle = None):
+    return getGcodeStyle(stream, composeStyle(element, parentStyle))
@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+# coding=utf-8
+#
+# Copyright (c) 2020 - Early Ehlinger, thenewentity.com
+#
+import math
+
+from GcodeExporter import DEFAULT_BUFFER_SIZE, GcodeOutput, coordinateFormat, formatCode, wrapComment
+
+motionCodes = ('G00', 'G01')
+# Motion codes whose centre or control point words always have to be written.
+curveCodes = ('G02', 'G03', 'G5')
+axes = ('X', 'Y', 'Z')
+
+class PendingMove:
+    def __init__(self, prefix, code, start, end, feed, comment):
+        self.prefix = prefix
+        self.code = code
+        self.start = start
+        self.end = end
+        self.feed = feed
+        self.comment = comment
+        self.skipped = []
+
+def asPoint(position):
+    # positions hold the written words, e.g. ' X1.00000'
+    return [float(position[axis][2:]) for axis in axes]
+
+def isCollinear(start, via, end, tolerance):
+    if None in start.values():
+        return False
+    a, b, c = asPoint(start), asPoint(via), asPoint(end)
+    ab = [b[i] - a[i] for i in range(3)]
+    bc = [c[i] - b[i] for i in range(3)]
+    ac = [c[i] - a[i] for i in range(3)]
+    if sum(ab[i] * bc[i] for i in range(3)) <= 0:
+        return False
+    cross = (ac[1] * ab[2] - ac[2] * ab[1], ac[2] * ab[0] - ac[0] * ab[2], ac[0] * ab[1] - ac[1] * ab[0])
+    return math.hypot(*cross) <= tolerance * math.hypot(*ac)
+
+class ModalGcodeOutput(GcodeOutput):
+    """GcodeOutput that drops words and moves that don't change the machine's modal state.
+
+    Motion mode, feed and X/Y/Z are tracked as the text that would be written, so
+    only words that would read back as the current value are dropped. Arcs and
+    splines keep their end point and centre or control point words. Consecutive
+    G01 moves at the same feed are merged when every dropped point lies within
+    mergeTolerance of the merged line; a mergeTolerance of None disables merging.
+    """
+    def __init__(self, stream, mergeTolerance = None, bufferSize = DEFAULT_BUFFER_SIZE):
+        GcodeOutput.__init__(self, stream, bufferSize)
+        self.mergeTolerance = mergeTolerance
+        self.motion = None
+        self.feed = None
+        self.requestedFeed = None
+        self.axisWords = dict.fromkeys(axes)
+        self.pending = None
+        self.originalSize = 0
+        self.linesIn = 0
+        self.linesOut = 0
+
+    def write(self, text):
+        self.flushPending()
+        self.originalSize += len(text)
+        self.writeCompressed(text)
+
+    def writeCompressed(self, text):
+        GcodeOutput.write(self, text)
+
+    def code(self, prefix, code, words, comment):
+        if code in curveCodes:
+            self.curve(prefix, code, words, comment)
+            return
+        if code not in motionCodes:
+            self.flushPending()
+            if code.endswith('M06'):
+                # The machine may move to change tools; write every axis of the next move.
+                self.axisWords = dict.fromkeys(axes)
+            line = formatCode(prefix, code, words, comment)
+            self.originalSize += len(line)
+            self.linesIn += 1
+            self.linesOut += 1
+            self.writeCompressed(line)
+            return
+
+        self.linesIn += 1
+        originalSize = len(prefix) + len(code) + len(wrapComment(comment, ' ')) + 1
+        end = dict(self.axisWords)
+        for key, value in words.items():
+            if value is None:
+                continue
+            text = coordinateFormat(key) % value
+            originalSize += len(text)
+            if key == 'F':
+                self.requestedFeed = text
+            else:
+                end[key] = text
+        self.originalSize += originalSize
+
+        if end == self.axisWords:
+            # No-op move; a feed change carries over to the next move.
+            return
+
+        pending = self.pending
+        if (pending is not None and self.mergeTolerance is not None and code == 'G01' and pending.code == 'G01'
+                and pending.feed == self.requestedFeed and not comment and not pending.comment
+                and all(isCollinear(pending.start, point, end, self.mergeTolerance)
+                        for point in pending.skipped + [pending.end])):
+            pending.skipped.append(pending.end)
+            pending.end = end
+        else:
+            self.flushPending()
+            self.pending = PendingMove(prefix, code, self.axisWords, end, self.requestedFeed, comment)
+        self.axisWords = end
+
+    def curve(self, prefix, code, words, comment):
+        # X, Y, I, J, P and Q are always written, as controllers require them; the code, Z and F only when they change.
+        self.flushPending()
+        self.linesIn += 1
+        self.linesOut += 1
+        self.originalSize += len(formatCode(prefix, code, words, comment))
+        end = dict(self.axisWords)
+        texts = []
+        for key, value in words.items():
+            if value is None:
+                continue
+            text = coordinateFormat(key) % value
+            if key == 'F':
+                self.requestedFeed = text
+                if text == self.feed:
+                    continue
+                self.feed = text
+            elif key in axes:
+                if key == 'Z' and text == end['Z']:
+                    continue
+                end[key] = text
+            texts.append(text)
+        self.axisWords = end
+        line = ''.join(texts).lstrip()
+        if code != self.motion:
+            line = f'{code} {line}'
+            self.motion = code
+        self.writeCompressed(f'{prefix}{line}{wrapComment(comment, " ")}\n')
+
+    def flushPending(self):
+        pending = self.pending
+        if pending is None:
+            return
+        self.pending = None
+        words = [pending.end[axis] for axis in axes if pending.end[axis] != pending.start[axis]]
+        if pending.feed != self.feed:
+            words.append(pending.feed)
+            self.feed = pending.feed
+        if pending.code != self.motion:
+            words.insert(0, pending.code)
+            self.motion = pending.code
+        self.linesOut += 1
+        # words carry their own leading space (' X1.00000'), the motion code doesn't.
+        line = ''.join(words).lstrip()
+        self.writeCompressed(f'{pending.prefix}{line}{wrapComment(pending.comment, " ")}\n')
+
+    def flush(self):
+        self.flushPending()
+        GcodeOutput.flush(self)
+
+    def getSummary(self):
+        self.flushPending()
+        saved = self.originalSize - self.written
+        percent = 100.0 * saved / self.originalSize if self.originalSize else 0
+        return (f'modal compression: {self.linesIn} code lines -> {self.linesOut}, '
+                f'{self.originalSize} -> {self.written} bytes ({percent:.1f}% smaller)')
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# coding=utf-8
+#
+# Copyright (c) 2020 - Early Ehlinger, thenewentity.com
+#
+"""
+Benchmark the exporter on samples/*.svg and on generated stress documents.
+
+    python benchmark.py [--repeat N] [--scale S] [--baseline FILE] [--save-baseline] [CASE...]
+
+Each case is exported with the full ExportCncGcode.save pipeline. Wall time is
+the best of --repeat runs; a separate run with --instrument breaks it down by
+stage (inclusive times, see instrumentation.py) and another measures peak
+memory with tracemalloc. Results are
+compared with the baseline file, and the exit status is 1 if any case got
+slower, bigger or produced more output than the tolerances allow; a case that
+looks slower is timed again before it counts. Baselines are only meaningful on
+the machine that recorded them, so none is committed: the first run records one.
+"""
+import argparse
+import glob
+import json
+import math
+import os
+import shutil
+import sys
+import tempfile
+import tracemalloc
+
+from exportBatch import exportFile
+
+here = os.path.dirname(os.path.abspath(__file__))
+defaultBaseline = os.path.join(here, 'benchmark-baseline.json')
+# Serial and uncached, so every run does all of the work in this process.
+exportArgs = ['--verbosity=summary', '--cache=false', '--workers=1']
+
+svgHeader = '''<?xml version="1.0" encoding="UTF-8"?>
+<svg xmlns="http://www.w3.org/2000/svg" xmlns:sodipodi="http://sodipodi.sourceforge.net/DTD/sodipodi-0.dtd"
+     width="{size}mm" height="{size}mm" viewBox="0 0 {size} {size}" version="1.1" id="svg1">
+  <sodipodi:namedview id="namedview1"/>
+'''
+svgFooter = '</svg>\n'
+
+def manyPathsDocument(scale):
+    """A grid of small closed paths, 10,000 at scale 1."""
+    side = max(1, int(round(100 * math.sqrt(scale))))
+    lines = [svgHeader.format(size=side * 6)]
+    for row in range(side):
+        for column in range(side):
+            lines.append(f'  <path id="p{row}_{column}" d="M {column * 6} {row * 6} h 4 l -1 4 h -2 z" '
+                         'style="-gcode-depth:1mm;-gcode-depth-increment:0.5mm"/>\n')
+    lines.append(svgFooter)
+    return ''.join(lines)
+
+def denseCurvesDocument(scale):
+    """Wavy closed paths of many cubic segments each."""
+    count = max(1, int(round(100 * scale)))
+    lines = [svgHeader.format(size=1000)]
+    for index in range(count):
+        y = 10 + (index % 100) * 9.5
+        x = 10 + (index // 100) * 480
+        segments = ''.join(f' c 1.5,-3 3,-3 4.5,0 s 3,3 4.5,0' for _ in range(50))
+        lines.append(f'  <path id="c{index}" d="M {x} {y}{segments} v 4 h -450 z" '
+                     'style="-gcode-depth:2mm;-gcode-depth-increment:1mm"/>\n')
+    lines.append(svgFooter)
+    return ''.join(lines)
+
+def deepNestingDocument(scale):
+    """Groups nested inside each other, each with its own transform and a path."""
+    depth = max(1, int(round(200 * scale)))
+    lines = [svgHeader.format(size=500)]
+    for level in range(depth):
+        lines.append(f'  <g id="g{level}" transform="translate(0.5,0.5) rotate(0.5)">\n'
+                     f'  <path id="n{level}" d="M 10 10 h 20 v 10 h -20 z" style="-gcode-depth:1mm"/>\n')
+    lines.append('  </g>\n' * depth)
+    lines.append(svgFooter)
+    return ''.join(lines)
+
+def hatchPocketsDocument(scale):
+    """Large hatched pockets, with tabs on their contours."""
+    count = max(1, int(round(16 * scale)))
+    lines = [svgHeader.format(size=1000)]
+    for index in range(count):
+        cx = 125 + (index % 4) * 250
+        cy = 125 + (index // 4 % 4) * 250
+        lines.append(f'  <circle id="h{index}" cx="{cx}" cy="{cy}" r="110" '
+                     'style="-gcode-depth:6mm;-gcode-depth-increment:2mm;-gcode-fill-mode:hatch;'
+                     '-gcode-tool-default-diameter:3mm;-gcode-stepover:1.5mm;'
+                     '-gcode-tab-height:2mm;-gcode-tab-width:5mm;-gcode-tab-start-interval:60mm"/>\n')
+    lines.append(svgFooter)
+    return ''.join(lines)
+
+generators = {
+    'many-paths': manyPathsDocument,
+    'dense-curves': denseCurvesDocument,
+    'deep-nesting': deepNestingDocument,
+    'hatch-pockets': hatchPocketsDocument,
+}
+
+def exportOnce(inputPath, outputPath, extraArgs = ()):
+    path, elements, seconds, error = exportFile(inputPath, outputPath, exportArgs + list(extraArgs))
+    if error:
+        raise RuntimeError(f'{path}: {error}')
+    return elements, seconds
+
+def timeExport(inputPath, outputPath, repeat):
+    return min(exportOnce(inputPath, outputPath)[1] for _ in range(repeat))
+
+def measure(inputPath, outputPath, repeat):
+    seconds = timeExport(inputPath, outputPath, repeat)
+    statsPath = outputPath + '.json'
+    elements, _ = exportOnce(inputPath, outputPath, ['--instrument=true', '--instrument-file=' + statsPath])
+    with open(statsPath, 'r', encoding='utf-8') as file:
+        stages = json.load(file)['stages']
+    tracemalloc.start()
+    try:
+        exportOnce(inputPath, outputPath)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+    return {
+        'elements': elements,
+        'seconds': round(seconds, 4),
+        'peakBytes': peak,
+        'outputBytes': os.path.getsize(outputPath),
+        'stages': {stage: round(stats['seconds'], 4) for stage, stats in sorted(stages.items())},
+    }
+
+def compare(name, result, baseline, options):
+    """Regression messages for one case by the key that regressed; empty if it is within tolerance."""
+    messages = {}
+    # The absolute slack keeps tiny cases from failing on timer and allocator noise.
+    limits = (('seconds', options.time_tolerance, 0.01), ('peakBytes', options.memory_tolerance, 65536),
+              ('outputBytes', options.output_tolerance, 0))
+    for key, tolerance, slack in limits:
+        before = baseline.get(key)
+        if before and result[key] > before * (1 + tolerance) + slack:
+            messages[key] = f'{name}: {key} {before} -> {result[key]} (+{100.0 * (result[key] / before - 1):.1f}%)'
+    return messages
+
+def main(args = None):
+    parser = argparse.ArgumentParser(description='Benchmark gcode export.')
+    parser.add_argument('cases', nargs='*', metavar='CASE',
+                        help='Cases to run: ' + ', '.join(generators) + ', or samples/NAME.svg; all by default')
+    parser.add_argument('--repeat', type=int, default=5, help='Timed runs per case; the fastest counts')
+    parser.add_argument('--scale', type=float, default=1.0, help='Size of the generated documents, 1 being full size')
+    parser.add_argument('--baseline', default=defaultBaseline, help='Baseline results to compare with')
+    parser.add_argument('--save-baseline', action='store_true',
+                        help='Write these results as the new baseline; done anyway when there is none')
+    parser.add_argument('--time-tolerance', type=float, default=0.25, help='Allowed slowdown, 0.25 being 25%%')
+    parser.add_argument('--memory-tolerance', type=float, default=0.25, help='Allowed growth of peak memory')
+    parser.add_argument('--output-tolerance', type=float, default=0.01, help='Allowed growth of the gcode')
+    options = parser.parse_args(args)
+
+    samples = sorted(os.path.relpath(path, here) for path in glob.glob(os.path.join(here, 'samples', '*.svg')))
+    cases = options.cases or samples + list(generators)
+    baseline = {}
+    if not os.path.exists(options.baseline):
+        print(f'no baseline at {options.baseline} yet; these results will be recorded as the baseline')
+        options.save_baseline = True
+    elif not options.save_baseline:
+        with open(options.baseline, 'r', encoding='utf-8') as file:
+            baseline = json.load(file)
+        if baseline.get('scale', 1.0) != options.scale:
+            print(f'the baseline was recorded at --scale={baseline.get("scale", 1.0)}; not comparing')
+            baseline = {}
+
+    directory = tempfile.mkdtemp(prefix='gcode-benchmark-')
+    results = {}
+    regressions = []
+    try:
+        for name in cases:
+            if name in generators:
+                inputPath = os.path.join(directory, name + '.svg')
+                with open(inputPath, 'w', encoding='utf-8') as file:
+                    file.write(generators[name](options.scale))
+            else:
+                inputPath = os.path.join(here, name)
+            outputPath = os.path.join(directory, 'output.gcode')
+            result = results[name] = measure(inputPath, outputPath, options.repeat)
+            stages = ' '.join(f'{stage}:{seconds:.3f}s' for stage, seconds in result['stages'].items())
+            print(f'{name}: {result["elements"]} elements {result["seconds"]:.3f}s '
+                  f'peak {result["peakBytes"] / 1048576.0:.1f}MB output {result["outputBytes"]} bytes ({stages})')
+            if name in baseline:
+                messages = compare(name, result, baseline[name], options)
+                if 'seconds' in messages:
+                    # One slow run on a busy machine isn't a regression; time the case again before calling it one.
+                    seconds = timeExport(inputPath, outputPath, 2 * options.repeat)
+                    result['seconds'] = round(min(result['seconds'], seconds), 4)
+                    messages = compare(name, result, baseline[name], options)
+                regressions.extend(messages.values())
+    finally:
+        shutil.rmtree(directory, ignore_errors=True)
+
+    if options.save_baseline:
+        with open(options.baseline, 'w', encoding='utf-8') as file:
+            json.dump(dict(results, scale=options.scale), file, indent=2, sort_keys=True)
+            file.write('\n')
+        print(f'baseline written to {options.baseline}')
+    for message in regressions:
+        print('REGRESSION ' + message)
+    return 1 if regressions else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
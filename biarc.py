@@ -0,0 +1,145 @@
+#!/usr/bin/env python
+# coding=utf-8
+#
+# Copyright (c) 2020 - Early Ehlinger, thenewentity.com
+#
+"""
+Approximate cubic beziers with biarcs: pairs of circular arcs that meet with a
+common tangent and match the curve's tangents at both ends.
+
+A fit is a list of (end, centre, counterClockwise) segments starting at the
+bezier's first point; centre is None for a straight segment.
+"""
+import functools
+import math
+
+def bezierPoint(bezier, t):
+    (x0, y0), (x1, y1), (x2, y2), (x3, y3) = bezier
+    s = 1 - t
+    a, b, c, d = s * s * s, 3 * s * s * t, 3 * s * t * t, t * t * t
+    return (a * x0 + b * x1 + c * x2 + d * x3, a * y0 + b * y1 + c * y2 + d * y3)
+
+def splitBezier(bezier):
+    """The two halves of bezier, split at t = 0.5 by de Casteljau."""
+    p0, p1, p2, p3 = bezier
+    def mid(a, b):
+        return ((a[0] + b[0]) / 2, (a[1] + b[1]) / 2)
+    p01, p12, p23 = mid(p0, p1), mid(p1, p2), mid(p2, p3)
+    p012, p123 = mid(p01, p12), mid(p12, p23)
+    middle = mid(p012, p123)
+    return (p0, p01, p012, middle), (middle, p123, p23, p3)
+
+def unit(dx, dy):
+    length = math.hypot(dx, dy)
+    return (dx / length, dy / length) if length > 1e-12 else None
+
+def tangents(bezier):
+    """Unit tangents at the start and end of bezier, skipping control points that sit on an end point."""
+    p0, p1, p2, p3 = bezier
+    start = unit(p1[0] - p0[0], p1[1] - p0[1]) or unit(p2[0] - p0[0], p2[1] - p0[1]) \
+        or unit(p3[0] - p0[0], p3[1] - p0[1])
+    end = unit(p3[0] - p2[0], p3[1] - p2[1]) or unit(p3[0] - p1[0], p3[1] - p1[1]) \
+        or unit(p3[0] - p0[0], p3[1] - p0[1])
+    return start, end
+
+def arcCentre(point, tangent, other):
+    """Centre of the circle through point and other that is tangent to tangent at point, or None if straight."""
+    nx, ny = -tangent[1], tangent[0]
+    cx, cy = other[0] - point[0], other[1] - point[1]
+    chordSquared = cx * cx + cy * cy
+    normal = nx * cx + ny * cy
+    # A radius of more than 1000 chords is written as a line.
+    if abs(normal) * 2000 <= math.sqrt(chordSquared):
+        return None
+    radius = chordSquared / (2 * normal)
+    return (point[0] + nx * radius, point[1] + ny * radius)
+
+def isCounterClockwise(point, tangent, centre):
+    return tangent[1] * (point[0] - centre[0]) - tangent[0] * (point[1] - centre[1]) > 0
+
+def biarc(p0, t0, p1, t1):
+    """The biarc from p0 heading t0 to p1 heading t1, with equal tangent lengths; None if there isn't one."""
+    vx, vy = p1[0] - p0[0], p1[1] - p0[1]
+    vv = vx * vx + vy * vy
+    if vv < 1e-18:
+        return None
+    vt = vx * (t0[0] + t1[0]) + vy * (t0[1] + t1[1])
+    denominator = 2 * (1 - (t0[0] * t1[0] + t0[1] * t1[1]))
+    if denominator < 1e-12:
+        vt1 = vx * t1[0] + vy * t1[1]
+        if vt1 <= 0:
+            return None
+        d = vv / (4 * vt1)
+    else:
+        d = (-vt + math.sqrt(vt * vt + denominator * vv)) / denominator
+    if d <= 0:
+        return None
+    joint = ((p0[0] + d * t0[0] + p1[0] - d * t1[0]) / 2, (p0[1] + d * t0[1] + p1[1] - d * t1[1]) / 2)
+    first = arcCentre(p0, t0, joint)
+    second = arcCentre(p1, t1, joint)
+    return [(joint, first, first is not None and isCounterClockwise(p0, t0, first)),
+            (p1, second, second is not None and isCounterClockwise(p1, t1, second))]
+
+def segmentDistance(point, start, end, centre, counterClockwise):
+    if centre is None:
+        dx, dy = end[0] - start[0], end[1] - start[1]
+        lengthSquared = dx * dx + dy * dy
+        t = ((point[0] - start[0]) * dx + (point[1] - start[1]) * dy) / lengthSquared if lengthSquared else 0
+        t = min(max(t, 0.0), 1.0)
+        return math.hypot(point[0] - start[0] - t * dx, point[1] - start[1] - t * dy)
+    a0 = math.atan2(start[1] - centre[1], start[0] - centre[0])
+    a1 = math.atan2(end[1] - centre[1], end[0] - centre[0])
+    a = math.atan2(point[1] - centre[1], point[0] - centre[0])
+    sign = 1 if counterClockwise else -1
+    if (sign * (a - a0)) % (2 * math.pi) <= (sign * (a1 - a0)) % (2 * math.pi):
+        radius = math.hypot(start[0] - centre[0], start[1] - centre[1])
+        return abs(math.hypot(point[0] - centre[0], point[1] - centre[1]) - radius)
+    return min(math.hypot(point[0] - start[0], point[1] - start[1]), math.hypot(point[0] - end[0], point[1] - end[1]))
+
+def fitError(bezier, segments):
+    start = bezier[0]
+    error = 0.0
+    for index in range(1, 8):
+        point = bezierPoint(bezier, index / 8.0)
+        distance = float('inf')
+        segmentStart = start
+        for end, centre, counterClockwise in segments:
+            distance = min(distance, segmentDistance(point, segmentStart, end, centre, counterClockwise))
+            segmentStart = end
+        error = max(error, distance)
+    return error
+
+@functools.lru_cache(maxsize=4096)
+def fitBiarcs(bezier, tolerance, depth = 0):
+    """Segments within tolerance of bezier, a tuple of four (x, y) tuples; halves it until each half fits."""
+    start, end = bezier[0], bezier[3]
+    t0, t1 = tangents(bezier)
+    if t0 is None:
+        return ((end, None, False),)
+    segments = biarc(start, t0, end, t1)
+    if segments is not None and fitError(bezier, segments) <= tolerance:
+        return tuple(segments)
+    if depth >= 8:
+        return tuple((bezierPoint(bezier, index / 4.0), None, False) for index in range(1, 5))
+    first, second = splitBezier(bezier)
+    return fitBiarcs(first, tolerance, depth + 1) + fitBiarcs(second, tolerance, depth + 1)
+
+def segmentLengths(start, segments):
+    result = []
+    for end, centre, counterClockwise in segments:
+        if centre is None:
+            result.append(math.hypot(end[0] - start[0], end[1] - start[1]))
+        else:
+            a0 = math.atan2(start[1] - centre[1], start[0] - centre[0])
+            a1 = math.atan2(end[1] - centre[1], end[0] - centre[0])
+            sweep = ((a1 - a0) if counterClockwise else (a0 - a1)) % (2 * math.pi)
+            result.append(sweep * math.hypot(start[0] - centre[0], start[1] - centre[1]))
+        start = end
+    return result
+
+quarterCircle = ((0.0, 0.0), (0.0, 0.5522847498), (0.4477152502, 1.0), (1.0, 1.0))
+assert len(fitBiarcs(quarterCircle, 0.001)) <= 4
+assert all(math.hypot(centre[0] - 1, centre[1]) < 0.01 for _, centre, _ in fitBiarcs(quarterCircle, 0.001))
+assert not any(ccw for _, _, ccw in fitBiarcs(quarterCircle, 0.001))
+assert fitBiarcs(((0, 0), (1, 0), (2, 0), (3, 0)), 0.001) == (((1.5, 0.0), None, False), ((3, 0), None, False))
+assert abs(sum(segmentLengths((0, 0), fitBiarcs(quarterCircle, 0.0001))) - math.pi / 2) < 0.001
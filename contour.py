@@ -1,12 +1,21 @@
 from float_range import float_range
 from cutPolylineAtDepth import cutPolylineAtDepth
+from instrumentation import instrumented
+from moves import note, trace
+from travelOrder import orderPolylines
 
-def contour(stream, gcodeStyle, zones, transform):
-    for polyline in zones.polylines:
-        stream.comment(f"polyline: {polyline.__dict__}")
+@instrumented('contour')
+def contour(gcodeStyle, zones, position, indent = 0):
+    """Yields the moves tracing each polyline of zones, pass by pass. position is where the tool starts."""
+    polylines = zones.polylines
+    if gcodeStyle.travelOrder == 'nearest' and len(polylines) > 1:
+        polylines, before, after = orderPolylines(polylines, position)
+        yield note("travel order: rapids {:.1f}mm -> {:.1f}mm", before, after, indent=indent)
+    for polyline in polylines:
+        yield trace("polyline: {}", polyline, indent=indent)
         needSafeHeight = True
         for depth in float_range(gcodeStyle.startDepth, gcodeStyle.depth, gcodeStyle.depthIncrement, includeStop=True):
             nextDepth = min(depth + gcodeStyle.depthIncrement, gcodeStyle.depth)
-            needSafeHeight = cutPolylineAtDepth(stream, polyline, gcodeStyle,
-                                                -depth, -nextDepth, needSafeHeight) and needSafeHeight
-        # provided by includeStop=True cutPolylineAtDepth(stream, polyline, gcodeStyle, -depth, -depth, needSafeHeight)
+            needSafeHeight = (yield from cutPolylineAtDepth(polyline, gcodeStyle, -depth, -nextDepth,
+                                                           needSafeHeight, indent)) and needSafeHeight
+        # provided by includeStop=True cutPolylineAtDepth(polyline, gcodeStyle, -depth, -depth, needSafeHeight)
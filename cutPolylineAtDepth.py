@@ -1,13 +1,45 @@
-import geometry
+from biarc import fitBiarcs, segmentLengths
+from instrumentation import instrumented
+from moves import arc, linear, rapid, safeHeight, spline, trace
 
-def cutPolylineAtDepth(stream, polyline, gcodeStyle, startDepth, finalDepth, needSafeHeight):
-    if not len(polyline.points):
+def curveMoves(bezier, startDepth, finalDepth, gcodeStyle, indent):
+    """Yields a G5 spline along bezier if splines are enabled and the depth doesn't change, else G02/G03 arcs.
+
+    Arcs ramp from startDepth to finalDepth as helixes, in proportion to their length.
+    """
+    (x0, y0), (x1, y1), (x2, y2), (x3, y3) = bezier
+    if gcodeStyle.supportsCubicSpline and startDepth == finalDepth:
+        yield spline('cubic spline', indent, X=x3, Y=y3, I=x1 - x0, J=y1 - y0, P=x2 - x3, Q=y2 - y3, F=gcodeStyle.feedxy)
+        return
+    segments = fitBiarcs(bezier, gcodeStyle.curveTolerance or 0.01)
+    lengths = segmentLengths(bezier[0], segments)
+    totalL = sum(lengths) or 1.0
+    start = bezier[0]
+    doneL = 0.0
+    for (end, centre, counterClockwise), length in zip(segments, lengths):
+        doneL += length
+        d = startDepth + doneL / totalL * (finalDepth - startDepth)
+        if centre is None:
+            yield linear('curve segment', indent, X=end[0], Y=end[1], Z=d, F=gcodeStyle.feedxy)
+        else:
+            yield arc('arc', counterClockwise, indent, X=end[0], Y=end[1], Z=d,
+                      I=centre[0] - start[0], J=centre[1] - start[1], F=gcodeStyle.feedxy)
+        start = end
+
+@instrumented('cutPolylineAtDepth')
+def cutPolylineAtDepth(polyline, gcodeStyle, startDepth, finalDepth, needSafeHeight, indent = 0):
+    """Yields the moves ramping along polyline from startDepth to finalDepth, lifting over tabs.
+
+    Returns whether the next pass has to go to safe height first, i.e. the polyline is open.
+    """
+    if not len(polyline):
         return
     totalL = polyline.getLength()
     depthRange = finalDepth - startDepth
+    points = polyline.points.tolist()
+    lengths = polyline.getCumulativeLengths().tolist()
 
-    p0 = polyline.points[0]
-    l = 0
+    p0 = points[0]
     d = startDepth
 
     tabStart = totalL + 1
@@ -15,20 +47,25 @@ def cutPolylineAtDepth(stream, polyline, gcodeStyle, startDepth, finalDepth, nee
     tabDepth = gcodeStyle.tabDepth
     inTab = False
     useTabs = gcodeStyle.hasTabs()
+    # Curves by the index of their first point, when they're written as curves rather than lines.
+    curves = {curve[0]: curve for curve in polyline.curves} if gcodeStyle.curveOutput in ('arcs', 'cubic') else {}
+    curveEnd = 0
     if useTabs:
         tabStart = gcodeStyle.tabStartInterval
         tabEnd = tabStart + gcodeStyle.tabWidth
 
-    stream.comment(f'cutting polyline ramp: {startDepth} -> {finalDepth} needSafeHeight:{needSafeHeight}')
+    yield trace('cutting polyline ramp: {} -> {} needSafeHeight:{}', startDepth, finalDepth, needSafeHeight, indent=indent)
     if needSafeHeight:
-        stream.safe_height(gcodeStyle)
-    stream.rapid(comment='rapid to start of polyline', X=p0[0], Y=p0[1], F=gcodeStyle.rapidxy)
-    stream.linear(comment='plunge to start depth', Z=d, F = gcodeStyle.feedz)
+        yield safeHeight(gcodeStyle, indent)
+    yield rapid('rapid to start of polyline', indent, X=p0[0], Y=p0[1], F=gcodeStyle.rapidxy)
+    yield linear('plunge to start depth', indent, Z=d, F = gcodeStyle.feedz)
 
-    for p1 in polyline.points[1:]:
-        segmentL = geometry.segmentLength(p0,p1)
-        startL = l
-        endL = l + segmentL
+    for index in range(1, len(points)):
+        if index <= curveEnd:
+            continue
+        p1 = points[index]
+        startL = lengths[index - 1]
+        endL = lengths[index]
         lFraction = endL / totalL
         d = startDepth + lFraction * depthRange # interpolate depth at p1
 
@@ -36,14 +73,25 @@ def cutPolylineAtDepth(stream, polyline, gcodeStyle, startDepth, finalDepth, nee
             tabStart += gcodeStyle.tabStartInterval
             tabEnd = tabStart + gcodeStyle.tabWidth
 
+        curve = curves.get(index - 1)
+        if curve is not None and not inTab:
+            curveEnd = curve[1]
+            curveDepth = startDepth + lengths[curveEnd] / totalL * depthRange
+            if lengths[curveEnd] < tabStart or curveDepth > -tabDepth:
+                # The whole curve is cut before the next tab; curves that reach a tab are cut as lines.
+                yield from curveMoves(curve[2], startDepth + startL / totalL * depthRange, curveDepth,
+                                      gcodeStyle, indent)
+                p0 = points[curveEnd]
+                continue
+            curveEnd = 0
+
         finishedSegment = False
         while not finishedSegment:
             if not inTab:
                 if endL < tabStart or d > -tabDepth:
                     # either segment ends before tab, or whole segment is above tab
                     # NOTE: this presumes we only ramp *down*.
-                    stream.linear(comment=f'lFraction:{lFraction} d:{d} tabDepth:{-tabDepth}', X=p1[0], Y=p1[1], Z=d, F=gcodeStyle.feedxy)
-                    l = startL
+                    yield linear(('lFraction:{} d:{} tabDepth:{}', lFraction, d, -tabDepth), indent, X=p1[0], Y=p1[1], Z=d, F=gcodeStyle.feedxy)
                     finishedSegment = True
                 else: # tab starts in this line segment
                     tabStartLFraction = tabStart / totalL
@@ -53,9 +101,9 @@ def cutPolylineAtDepth(stream, polyline, gcodeStyle, startDepth, finalDepth, nee
                     # figure out x,y of tab start
                     tabStartPoint = (p0[0] + tabSegmentFraction*(p1[0]-p0[0]),
                                      p0[1] + tabSegmentFraction*(p1[1]-p0[1]))
-                    stream.linear(comment=f'ramp to tab start', X=tabStartPoint[0], Y=tabStartPoint[1],
-                                Z=tabStartRampDepth, F=gcodeStyle.feedxy)
-                    stream.linear(comment=f'lift to tab depth', Z=-tabDepth, F=gcodeStyle.rapidz)
+                    yield linear('ramp to tab start', indent, X=tabStartPoint[0], Y=tabStartPoint[1],
+                                 Z=tabStartRampDepth, F=gcodeStyle.feedxy)
+                    yield linear('lift to tab depth', indent, Z=-tabDepth, F=gcodeStyle.rapidz)
                     inTab = True
 
             if inTab:
@@ -67,15 +115,14 @@ def cutPolylineAtDepth(stream, polyline, gcodeStyle, startDepth, finalDepth, nee
                     tabEndPoint = (p0[0] + tabSegmentFraction*(p1[0]-p0[0]),
                                    p0[1] + tabSegmentFraction*(p1[1]-p0[1]))
 
-                    stream.linear(comment=f'skim tab top tabStop:{tabStopLFraction}', X=tabEndPoint[0],Y=tabEndPoint[1], F=gcodeStyle.feedxy)
-                    stream.linear(comment=f'plunge to post-tab ramp top', Z=tabStopRampDepth, F=gcodeStyle.feedz)
+                    yield linear(('skim tab top tabStop:{}', tabStopLFraction), indent, X=tabEndPoint[0],Y=tabEndPoint[1], F=gcodeStyle.feedxy)
+                    yield linear('plunge to post-tab ramp top', indent, Z=tabStopRampDepth, F=gcodeStyle.feedz)
                     tabStart = tabStart + gcodeStyle.tabStartInterval
                     tabEnd = tabStart + gcodeStyle.tabWidth
                     inTab = False
                 else:
-                    stream.linear(comment=f'skim tab top endL:{endL} tabEnd:{tabEnd}', X=p1[0],Y=p1[1], F=gcodeStyle.feedxy)
+                    yield linear(('skim tab top endL:{} tabEnd:{}', endL, tabEnd), indent, X=p1[0],Y=p1[1], F=gcodeStyle.feedxy)
                     finishedSegment = True
-            l = endL
         p0 = p1
-    stream.comment(f'polyline.closed: {polyline.closed}')
+    yield trace('polyline.closed: {}', polyline.closed, indent=indent)
     return not polyline.closed
@@ -0,0 +1,412 @@
+#!/usr/bin/env python
+# coding=utf-8
+#
+# Copyright (c) 2020 - Early Ehlinger, thenewentity.com
+#
+"""
+Estimate how long a machine takes to run a gcode program.
+
+    python estimateCycleTime.py [--acceleration A] [--z-acceleration A] [--junction-deviation D] [--json] FILE...
+
+Moves are planned the way GRBL-style controllers do: each accelerates and
+decelerates at a constant rate within its F feed (rapids within the machine's
+rapid rates, whatever F says), and the speed through the corner between two
+moves is limited by the junction deviation. Time is split
+into cutting, rapid (G00 across XY) and Z-only moves, and, when the program
+has summary comments, by the element each move was exported from.
+"""
+import argparse
+import json
+import math
+import re
+import string
+import sys
+import warnings
+
+import numpy
+
+from GcodeStyle import GcodeStyle
+
+# Feeds for moves that come before any F word, and rapid rates.
+defaultStyle = GcodeStyle({})
+
+wordRegex = re.compile(r'([A-Z])\s*([-+]?[0-9]*\.?[0-9]+)')
+commentRegex = re.compile(r'\([^)\n]*\)|;[^\n]*')
+elementRegex = re.compile(r'exporting element type:"[^"]*" id:"([^"]*)"')
+
+categories = ('cutting', 'rapid', 'z')
+motionCodes = (0, 1, 2, 3, 5)
+letterCodes = {letter: code for code, letter in enumerate(string.ascii_uppercase, 1)}
+nan = float('nan')
+
+class MotionModel:
+    """Machine limits, in mm/s² for accelerations, mm for the junction deviation and mm/min for rapid rates."""
+    def __init__(self, acceleration = 500.0, zAcceleration = 200.0, junctionDeviation = 0.01,
+                 rapid = defaultStyle.rapidxy, zRapid = defaultStyle.rapidz):
+        self.acceleration = acceleration
+        self.zAcceleration = zAcceleration
+        self.junctionDeviation = junctionDeviation
+        self.rapid = rapid
+        self.zRapid = zRapid
+
+class Toolpath:
+    """The moves of a program, one row each, in mm and mm/min.
+
+    Words that a move leaves out (modal axes and feeds) are filled in when the
+    rows are turned into arrays. elementIds are the elements moves were exported
+    from, in the order first seen.
+    """
+    def __init__(self, start = (0.0, 0.0, 0.0)):
+        self.start = start
+        self.element = 0
+        self.elementIds = ['(document)']
+        self.elementIndices = {}
+        self.rows = []
+        # The rows as an (n, 10) array, when they were read that way.
+        self.table = None
+
+    def addMove(self, mode, words):
+        """Add a move with motion code mode (0, 1, 2, 3 or 5) from its words, a dict of letters to values."""
+        get = words.get
+        self.rows.append((mode, get('X', nan), get('Y', nan), get('Z', nan), get('F', nan),
+                          get('I', nan), get('J', nan), get('P', nan), get('Q', nan), self.element))
+
+    def addElement(self, elementId):
+        index = self.elementIndices.get(elementId)
+        if index is None:
+            index = self.elementIndices[elementId] = len(self.elementIds)
+            self.elementIds.append(elementId)
+        self.element = index
+
+    def getArrays(self):
+        """(modes, starts, ends, offsets, feeds, elements) with a row per move.
+
+        offsets are the I, J, P, Q words of arcs and splines.
+        """
+        table = self.table if self.table is not None else numpy.array(self.rows, dtype=float).reshape(-1, 10)
+        modes = table[:, 0].astype(int)
+        # Each missing axis or feed is the last one given before it.
+        initial = numpy.array([list(self.start) + [nan]])
+        filled = numpy.concatenate((initial, table[:, 1:5]))
+        for column in range(4):
+            values = filled[:, column]
+            given = numpy.where(numpy.isnan(values), 0, numpy.arange(len(values)))
+            filled[:, column] = values[numpy.maximum.accumulate(given)]
+        ends = filled[1:, :3]
+        starts = filled[:-1, :3]
+        feeds = filled[1:, 3]
+        feeds = numpy.where(numpy.isnan(feeds), defaultStyle.feedxy, feeds)
+        offsets = table[:, 5:9]
+        splines = numpy.flatnonzero(modes == 5)
+        if len(splines) > 1:
+            # A spline without I, J continues the one before it smoothly.
+            continued = splines[1:][numpy.isnan(offsets[splines[1:], 0])]
+            previous = splines[numpy.searchsorted(splines, continued) - 1]
+            offsets[continued, :2] = -offsets[previous, 2:]
+        offsets = numpy.nan_to_num(offsets)
+        return modes, starts, ends, offsets, feeds, table[:, 9].astype(int)
+
+def parseWords(line):
+    """The words of a line of gcode without comments, as (letter, value) pairs."""
+    try:
+        return [(token[0], float(token[1:])) for token in line.upper().split()]
+    except ValueError:
+        # Words that aren't separated by spaces, like G1X2.
+        return [(letter, float(value)) for letter, value in wordRegex.findall(line.upper())]
+
+def readGcode(lines, start = (0.0, 0.0, 0.0)):
+    """The Toolpath of a gcode program, given as an iterable of lines."""
+    toolpath = Toolpath(start)
+    mode = 0
+    for line in lines:
+        if '(' in line or ';' in line:
+            match = elementRegex.search(line)
+            if match:
+                toolpath.addElement(match.group(1))
+            line = commentRegex.sub('', line)
+        words = {}
+        for letter, value in parseWords(line):
+            if letter == 'G':
+                if value in motionCodes:
+                    mode = int(value)
+            elif letter != 'N':
+                words[letter] = value
+        if 'X' in words or 'Y' in words or 'Z' in words:
+            toolpath.addMove(mode, words)
+        elif 'F' in words:
+            # A feed on its own line applies to the next move.
+            toolpath.addMove(mode, {'F': words['F']})
+    return toolpath
+
+def readGcodeText(text, start = (0.0, 0.0, 0.0)):
+    """The Toolpath of a whole gcode program, read by numpy rather than line by line; None if it can't be.
+
+    Every letter becomes a number code, so that the program reads as one list of
+    (code, value) pairs with (0, 0) between lines.
+    """
+    toolpath = Toolpath(start)
+    elementLines = []
+    line = 0
+    position = 0
+    for match in elementRegex.finditer(text):
+        line += text.count('\n', position, match.start())
+        position = match.start()
+        toolpath.addElement(match.group(1))
+        elementLines.append((line, toolpath.element))
+    if '(' in text or ';' in text:
+        text = commentRegex.sub('', text)
+    text = text.upper()
+    counts = numpy.bincount(numpy.frombuffer(text.encode('utf-8'), numpy.uint8), minlength=256)
+    pairs = int(counts[ord('\n')]) + 1
+    for code, letter in enumerate(string.ascii_uppercase, 1):
+        if counts[ord(letter)]:
+            pairs += int(counts[ord(letter)])
+            text = text.replace(letter, f' {code} ')
+    with warnings.catch_warnings():
+        # Anything that isn't a number stops the parse early, which the length check catches.
+        warnings.simplefilter('ignore')
+        try:
+            values = numpy.fromstring(text.replace('\n', ' 0 0 ') + ' 0 0', sep=' ')
+        except ValueError:
+            return None
+    if len(values) != 2 * pairs:
+        return None
+    codes = values[0::2].astype(int)
+    values = values[1::2]
+    ends = codes == 0
+    lines = numpy.cumsum(ends) - ends
+    lineCount = int(ends.sum())
+
+    def forwardFill(column, initial):
+        given = numpy.where(numpy.isnan(column), 0, numpy.arange(1, len(column) + 1))
+        return numpy.concatenate(([initial], column))[numpy.maximum.accumulate(given)]
+    def byLine(mask):
+        column = numpy.full(lineCount, nan)
+        column[lines[mask]] = values[mask]
+        return column
+    motion = (codes == letterCodes['G']) & numpy.isin(values, motionCodes)
+    columns = {letter: byLine(codes == letterCodes[letter]) for letter in 'XYZFIJPQ'}
+    elements = numpy.full(lineCount, nan)
+    for line, element in elementLines:
+        elements[line] = element
+    isMove = ~(numpy.isnan(columns['X']) & numpy.isnan(columns['Y']) & numpy.isnan(columns['Z']))
+    toolpath.table = numpy.column_stack(
+        [forwardFill(byLine(motion), 0)[isMove]]
+        + [columns[letter][isMove] for letter in 'XYZ']
+        # Feeds may be given on lines of their own.
+        + [forwardFill(columns['F'], nan)[isMove]]
+        + [columns[letter][isMove] for letter in 'IJPQ']
+        + [forwardFill(elements, 0)[isMove]])
+    return toolpath
+
+def readMoves(records, start = (0.0, 0.0, 0.0)):
+    """The Toolpath of the moves.Move records a toolpath generator yields; comments are skipped."""
+    toolpath = Toolpath(start)
+    for record in records:
+        words = getattr(record, 'words', None)
+        if words is not None and ('X' in words or 'Y' in words or 'Z' in words):
+            toolpath.addMove(int(float(record.code[1:])), {key: value for key, value in words.items()
+                                                           if value is not None})
+    return toolpath
+
+def normalize(vectors, lengths):
+    return vectors / numpy.where(lengths > 0, lengths, 1.0)[:, None]
+
+def moveGeometry(modes, starts, ends, offsets):
+    """Length, unit direction at the start and end, and XY length of every move."""
+    delta = ends - starts
+    lengths = numpy.sqrt((delta * delta).sum(axis=1))
+    xyLengths = numpy.hypot(delta[:, 0], delta[:, 1])
+    startDirections = normalize(delta, lengths)
+    endDirections = startDirections.copy()
+    radii = numpy.full(len(modes), numpy.inf)
+
+    arcs = numpy.flatnonzero((modes == 2) | (modes == 3))
+    if len(arcs):
+        centres = starts[arcs, :2] + offsets[arcs, :2]
+        r0 = starts[arcs, :2] - centres
+        r1 = ends[arcs, :2] - centres
+        radius = numpy.hypot(r0[:, 0], r0[:, 1])
+        a0 = numpy.arctan2(r0[:, 1], r0[:, 0])
+        a1 = numpy.arctan2(r1[:, 1], r1[:, 0])
+        sign = numpy.where(modes[arcs] == 3, 1.0, -1.0)
+        sweep = numpy.mod(sign * (a1 - a0), 2 * math.pi)
+        # An arc back to its start is a full circle.
+        sweep[sweep < 1e-9] = 2 * math.pi
+        xy = sweep * radius
+        dz = delta[arcs, 2]
+        length = numpy.hypot(xy, dz)
+        for directions, r in ((startDirections, r0), (endDirections, r1)):
+            tangent = sign[:, None] * numpy.stack((-r[:, 1], r[:, 0]), axis=1) / numpy.where(radius > 0, radius, 1.0)[:, None]
+            directions[arcs] = normalize(numpy.column_stack((tangent * xy[:, None], dz)), length)
+        lengths[arcs] = length
+        xyLengths[arcs] = xy
+        radii[arcs] = radius
+
+    splines = numpy.flatnonzero(modes == 5)
+    if len(splines):
+        p0 = starts[splines, :2]
+        p3 = ends[splines, :2]
+        p1 = p0 + offsets[splines, 0:2]
+        p2 = p3 + offsets[splines, 2:4]
+        t = numpy.linspace(0.0, 1.0, 17)[:, None, None]
+        points = (1 - t) ** 3 * p0 + 3 * (1 - t) ** 2 * t * p1 + 3 * (1 - t) * t * t * p2 + t ** 3 * p3
+        steps = numpy.diff(points, axis=0)
+        length = numpy.hypot(steps[..., 0], steps[..., 1]).sum(axis=0)
+        for directions, step in ((startDirections, steps[0]), (endDirections, steps[-1])):
+            stepLength = numpy.hypot(step[:, 0], step[:, 1])
+            directions[splines] = normalize(numpy.column_stack((step, numpy.zeros(len(splines)))), stepLength)
+        lengths[splines] = length
+        xyLengths[splines] = length
+    return lengths, xyLengths, startDirections, endDirections, radii
+
+def axisAccelerations(directions, model):
+    """The acceleration along each move, limited by the axis that has to accelerate hardest."""
+    xyShare = numpy.hypot(directions[:, 0], directions[:, 1])
+    zShare = numpy.abs(directions[:, 2])
+    with numpy.errstate(divide='ignore'):
+        return numpy.minimum(model.acceleration / xyShare, model.zAcceleration / zShare)
+
+def moveFeeds(modes, feeds, directions, model):
+    """The feed of each move in mm/min: rapids run at the machine's rapid rates, limited by the slowest axis, and
+    ignore F."""
+    xyShare = numpy.hypot(directions[:, 0], directions[:, 1])
+    zShare = numpy.abs(directions[:, 2])
+    with numpy.errstate(divide='ignore'):
+        rapids = numpy.minimum(model.rapid / xyShare, model.zRapid / zShare)
+    return numpy.where(modes == 0, rapids, feeds)
+
+def plan(lengths, feeds, accelerations, startDirections, endDirections, radii, model, entrySpeed = 0.0):
+    """Seconds for each move, given its length, feed (mm/s), acceleration and directions; the speed at each
+    junction, from entrySpeed at the start of the first move to rest at the end of the last; and the top speed
+    of each move.
+
+    The largest squared speed at every junction is found in two passes. Forward,
+    w[i] = min(J[i], w[i - 1] + 2 a L) unrolls to S[i] + min over k <= i of
+    (J[k] - S[k]), S being the running sum of 2 a L, so it is a cumulative
+    minimum; backward likewise. No Python loop runs per move.
+    """
+    count = len(lengths)
+    cruise = feeds.copy()
+    # Centripetal acceleration limits the speed around tight arcs.
+    cruise = numpy.minimum(cruise, numpy.sqrt(accelerations * radii))
+    cosines = -(endDirections[:-1] * startDirections[1:]).sum(axis=1)
+    sinHalf = numpy.sqrt(numpy.clip(0.5 * (1 - cosines), 0.0, 1.0))
+    with numpy.errstate(divide='ignore'):
+        junction = numpy.where(sinHalf < 1 - 1e-9,
+                               numpy.minimum(accelerations[:-1], accelerations[1:]) * model.junctionDeviation
+                               * sinHalf / (1 - sinHalf), numpy.inf)
+    limits = numpy.zeros(count + 1)
+    limits[0] = entrySpeed * entrySpeed
+    limits[1:-1] = numpy.minimum(junction, numpy.minimum(cruise[:-1], cruise[1:]) ** 2)
+
+    reach = 2 * accelerations * lengths
+    sums = numpy.concatenate(([0.0], numpy.cumsum(reach)))
+    forward = sums + numpy.minimum.accumulate(limits - sums)
+    backward = numpy.minimum.accumulate((limits + sums)[::-1])[::-1] - sums
+    squared = numpy.maximum(numpy.minimum(forward, backward), 0.0)
+
+    entry = numpy.sqrt(squared[:-1])
+    exit = numpy.sqrt(squared[1:])
+    peakSquared = numpy.minimum(cruise ** 2, (reach + squared[:-1] + squared[1:]) / 2)
+    peak = numpy.sqrt(peakSquared)
+    accelerating = (peakSquared - squared[:-1]) / (2 * accelerations)
+    decelerating = (peakSquared - squared[1:]) / (2 * accelerations)
+    cruising = numpy.maximum(lengths - accelerating - decelerating, 0.0)
+    seconds = (peak - entry) / accelerations + (peak - exit) / accelerations + cruising / numpy.where(peak > 0, peak, 1.0)
+    return seconds, numpy.sqrt(squared), peak
+
+def estimateCycleTime(toolpath, model = None):
+    """A report of the estimated run time of toolpath: totals, per category and per element."""
+    model = model or MotionModel()
+    modes, starts, ends, offsets, feeds, elements = toolpath.getArrays()
+    lengths, xyLengths, startDirections, endDirections, radii = moveGeometry(modes, starts, ends, offsets)
+    moving = lengths > 1e-9
+    modes, starts, ends, feeds, elements = modes[moving], starts[moving], ends[moving], feeds[moving], elements[moving]
+    lengths, xyLengths = lengths[moving], xyLengths[moving]
+    startDirections, endDirections, radii = startDirections[moving], endDirections[moving], radii[moving]
+
+    accelerations = axisAccelerations(startDirections, model)
+    feeds = moveFeeds(modes, feeds, startDirections, model)
+    seconds, _, _ = plan(lengths, feeds / 60.0, accelerations, startDirections, endDirections, radii, model)
+
+    category = numpy.where(xyLengths <= 1e-9, 2, numpy.where(modes == 0, 1, 0))
+    retracts = (ends[:, 2] > starts[:, 2]) & (ends[:, 2] > 0) & (starts[:, 2] <= 0)
+    elementCount = len(toolpath.elementIds)
+    def byElement(weights):
+        return numpy.bincount(elements, weights, minlength=elementCount)
+
+    report = {
+        'seconds': float(seconds.sum()),
+        'moves': int(len(lengths)),
+        'retracts': int(retracts.sum()),
+        'categories': {name: {'seconds': float(seconds[category == index].sum()),
+                              'distance': float(lengths[category == index].sum())}
+                       for index, name in enumerate(categories)},
+    }
+    elementSeconds = byElement(seconds)
+    elementCategories = [byElement(numpy.where(category == index, seconds, 0.0)) for index in range(len(categories))]
+    elementRetracts = byElement(retracts.astype(float))
+    report['elements'] = [dict({'id': toolpath.elementIds[index], 'seconds': float(elementSeconds[index]),
+                                'retracts': int(elementRetracts[index])},
+                               **{name: float(values[index]) for name, values in zip(categories, elementCategories)})
+                          for index in numpy.argsort(-elementSeconds) if elementSeconds[index] > 0]
+    return report
+
+def formatSeconds(seconds):
+    minutes, seconds = divmod(seconds, 60)
+    hours, minutes = divmod(int(minutes), 60)
+    return f'{hours}:{minutes:02d}:{seconds:04.1f}'
+
+def formatReport(report, elements = 10):
+    parts = ', '.join(f'{name} {formatSeconds(values["seconds"])} over {values["distance"]:.0f}mm'
+                      for name, values in report['categories'].items())
+    lines = [f'{formatSeconds(report["seconds"])} for {report["moves"]} moves, {report["retracts"]} retracts: {parts}']
+    for element in report['elements'][:elements]:
+        lines.append(f'  {element["id"]}: {formatSeconds(element["seconds"])} (cutting {element["cutting"]:.1f}s, '
+                     f'rapid {element["rapid"]:.1f}s, z {element["z"]:.1f}s, {element["retracts"]} retracts)')
+    return lines
+
+def main(args = None):
+    parser = argparse.ArgumentParser(description='Estimate the run time of gcode programs.')
+    parser.add_argument('inputs', nargs='+', metavar='FILE', help='gcode files')
+    parser.add_argument('--acceleration', type=float, default=500.0, help='X and Y acceleration in mm/s²')
+    parser.add_argument('--z-acceleration', type=float, default=200.0, help='Z acceleration in mm/s²')
+    parser.add_argument('--junction-deviation', type=float, default=0.01,
+                        help='How far in mm the machine may cut corners to keep up speed, as in GRBL')
+    parser.add_argument('--rapid', type=float, default=defaultStyle.rapidxy, help='X and Y rapid rate in mm/min')
+    parser.add_argument('--z-rapid', type=float, default=defaultStyle.rapidz, help='Z rapid rate in mm/min')
+    parser.add_argument('--elements', type=int, default=10, help='Slowest elements to list')
+    parser.add_argument('--json', action='store_true', help='Print the full reports as JSON')
+    options = parser.parse_args(args)
+    model = MotionModel(options.acceleration, options.z_acceleration, options.junction_deviation, options.rapid,
+                        options.z_rapid)
+
+    reports = {}
+    for path in options.inputs:
+        with open(path, 'r', encoding='utf-8', errors='replace') as file:
+            text = file.read()
+        toolpath = readGcodeText(text) or readGcode(text.splitlines())
+        reports[path] = estimateCycleTime(toolpath, model)
+    if options.json:
+        json.dump(reports, sys.stdout, indent=2)
+        sys.stdout.write('\n')
+        return 0
+    for path, report in reports.items():
+        lines = formatReport(report, options.elements)
+        print(f'{path}: {lines[0]}')
+        for line in lines[1:]:
+            print(line)
+    return 0
+
+# A 60mm line at 600mm/min from rest to rest: 0.01s to reach 10mm/s at 1000mm/s², then 5.99s at speed.
+assert abs(estimateCycleTime(readGcode(['G01 X60 F600']), MotionModel(1000.0))['seconds'] - 6.01) < 1e-9
+# Reversing stops dead; a right angle slows down; going straight on doesn't.
+assert abs(estimateCycleTime(readGcode(['G01 X60 F600', 'X0']), MotionModel(500.0))['seconds'] - 12.04) < 1e-9
+assert 12.02 + 1e-3 < estimateCycleTime(readGcode(['G01 X60 F600', 'Y60']))['seconds'] < 12.04
+assert abs(estimateCycleTime(readGcode(['G01 X60 F600', 'X120']))['seconds'] - 12.02) < 1e-9
+# Rapids run at the rapid rate, not the F of the cut before them: about 60s for 1000mm at 1000mm/min, not 600s.
+assert 60.6 < estimateCycleTime(readGcode(['G01 X1 F100', 'G00 X1001']), MotionModel(rapid=1000.0))['seconds'] < 60.7
+
+if __name__ == '__main__':
+    sys.exit(main())
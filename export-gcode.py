@@ -7,29 +7,176 @@
 Export cnc gcode (.gcode)
 """
 
+import contextlib
+import os
 import GcodeExporter
-from inkex import OutputExtension, transforms
+from concurrent.futures import ProcessPoolExecutor
+from fragmentCache import FragmentCache
+from instrumentation import Instrumentation
+from inkex import Boolean, OutputExtension, transforms
+from ModalCompressor import ModalGcodeOutput
+from parallelExport import ParallelOutput
+from toolPlanning import ToolPlanOutput, toolFileName
 from visitElement import visitElement
 
 import warnings
 warnings.filterwarnings("ignore", category=DeprecationWarning)
 
+# GCODE_INSTRUMENT values that turn instrumentation on; anything else leaves it off.
+instrumentSettings = ('1', 'true', 'yes', 'cprofile')
+
 class ExportCncGcode(OutputExtension):
     """Export all shapes with <-gcode-depth> CSS attributes"""
-    
+    # Elements the last save exported gcode for.
+    exportedElements = 0
+
+    def add_arguments(self, pars):
+        pars.add_argument("--verbosity", default="summary", choices=sorted(GcodeExporter.verbosityLevels),
+                          help="Which comments to write into the gcode")
+        pars.add_argument("--compress", type=Boolean, default=False,
+                          help="Drop words and moves that don't change the machine's modal state")
+        pars.add_argument("--merge-tolerance", type=float, default=0.001,
+                          help="Merge collinear G01 moves within this distance (mm) when compressing; negative disables")
+        pars.add_argument("--group-by-tool", default="off", choices=["off", "m6", "files"],
+                          help="Cut everything a tool cuts together: off keeps document order, m6 changes tools "
+                               "with M06, files writes each tool after the first to a program of its own")
+        pars.add_argument("--workers", type=int, default=1,
+                          help="Processes generating path toolpaths; 1 exports serially, 0 uses every CPU")
+        pars.add_argument("--cache", type=Boolean, default=False,
+                          help="Reuse the gcode of paths that haven't changed since the last export")
+        pars.add_argument("--cache-dir", default="",
+                          help="Directory of the path cache; by default <document>.gcode-cache next to the document")
+        pars.add_argument("--cache-size", type=float, default=256,
+                          help="Megabytes the path cache may hold before the least recently used paths are dropped")
+        pars.add_argument("--instrument", type=Boolean, default=False,
+                          help="Record time and counts per export stage; also enabled by GCODE_INSTRUMENT=1")
+        pars.add_argument("--instrument-file", default="",
+                          help="JSON file for the stats; by default <document>.gcode-stats.json next to the document")
+        pars.add_argument("--instrument-comments", type=Boolean, default=False,
+                          help="Also write the stats as comments at the end of the gcode")
+        pars.add_argument("--cprofile", type=Boolean, default=False,
+                          help="Run the export under cProfile too; also enabled by GCODE_INSTRUMENT=cprofile")
+
     def setupMachine(self, stream):
         stream.select_plane_xy(comment='XY plane')
         stream.select_units_mm(comment='mm mode')
         stream.tool_radius_compensation_off(comment='compensation off')
         stream.absolute_distance_mode(comment='absolute distance mode')
 
+    def createOutput(self, rawStream):
+        if self.options.compress:
+            mergeTolerance = self.options.merge_tolerance if self.options.merge_tolerance >= 0 else None
+            return ModalGcodeOutput(rawStream, mergeTolerance)
+        return GcodeExporter.GcodeOutput(rawStream)
+
     def save(self, rawStream):
+        output = self.createOutput(rawStream)
+        modalOutput = output if self.options.compress else None
+        instrumentation = profile = None
+        setting = os.environ.get('GCODE_INSTRUMENT', '').strip().lower()
+        if self.options.instrument or self.options.cprofile or setting in instrumentSettings:
+            instrumentation = Instrumentation()
+            instrumentation.start(output)
+            if self.options.cprofile or setting == 'cprofile':
+                import cProfile
+                profile = cProfile.Profile()
+        if self.options.group_by_tool != 'off':
+            # Without a file name to put them next to, tools go in one program with tool changes.
+            openTarget = None
+            if self.options.group_by_tool == 'files' and self.toolProgramPath('default'):
+                openTarget = self.openToolProgram
+            output = ToolPlanOutput(output, GcodeExporter.verbosityLevels[self.options.verbosity], openTarget)
+        workers = self.options.workers or os.cpu_count()
+        executor = None
+        if workers > 1:
+            executor = ProcessPoolExecutor(workers)
+            output = ParallelOutput(output, executor, workers * 4)
+        self.countElements(output)
+        cache = self.openCache()
+        try:
+            if profile:
+                profile.runcall(self.export, rawStream, output, modalOutput, cache, instrumentation)
+            else:
+                self.export(rawStream, output, modalOutput, cache, instrumentation)
+        finally:
+            if executor:
+                executor.shutdown(cancel_futures=True)
+            if cache:
+                cache.evict()
+            if instrumentation:
+                instrumentation.stop()
+                self.saveInstrumentation(instrumentation, profile)
+
+    def countElements(self, output):
+        """Count the elements exported to output in exportedElements; exporters mark each with output.operation."""
+        self.exportedElements = 0
+        operation = output.operation
+        def countingOperation(gcodeStyle):
+            if gcodeStyle is not None:
+                self.exportedElements += 1
+            operation(gcodeStyle)
+        # An instance attribute shadows the method; it's called per element, not per move.
+        output.operation = countingOperation
+
+    def sidecarPath(self, suffix):
+        """The document's path with suffix for its extension, or None when reading stdin."""
+        # Inkscape exports from a temporary copy; DOCUMENT_PATH is where the document really is.
+        document = os.environ.get('DOCUMENT_PATH') or self.options.input_file
+        if not isinstance(document, str):
+            return None
+        return os.path.splitext(document)[0] + suffix
+
+    def toolProgramPath(self, tool):
+        """Where the program of tool goes with --group-by-tool=files: next to the output file, or the document."""
+        suffix = f'.{toolFileName(tool)}.gcode'
+        if isinstance(self.options.output, str):
+            return os.path.splitext(self.options.output)[0] + suffix
+        return self.sidecarPath(suffix)
+
+    @contextlib.contextmanager
+    def openToolProgram(self, tool, number):
+        path = self.toolProgramPath(tool)
+        with open(path, 'wb') as file:
+            output = self.createOutput(file)
+            yield output, os.path.basename(path)
+            output.flush()
+
+    def openCache(self):
+        if not self.options.cache:
+            return None
+        directory = self.options.cache_dir or self.sidecarPath('.gcode-cache')
+        if not directory:
+            return None
+        return FragmentCache(directory, self.options.cache_size * 1024 * 1024)
+
+    def saveInstrumentation(self, instrumentation, profile):
+        path = self.options.instrument_file or self.sidecarPath('.gcode-stats.json')
+        if not path:
+            return
+        extra = {}
+        if profile:
+            import pstats
+            profilePath = os.path.splitext(path)[0] + '.prof'
+            profile.dump_stats(profilePath)
+            stats = pstats.Stats(profile).stats
+            slowest = sorted(stats.items(), key=lambda item: -item[1][3])[:25]
+            extra['profile'] = {
+                'file': profilePath,
+                'slowest': [{'function': f'{file}:{line}({name})', 'calls': calls, 'ownSeconds': round(own, 6),
+                             'seconds': round(cumulative, 6)}
+                            for (file, line, name), (_, calls, own, cumulative, _) in slowest],
+            }
+        instrumentation.writeReport(path, extra)
+
+    def export(self, rawStream, output, modalOutput, cache = None, instrumentation = None):
         name = self.svg.name.replace('.svg', '')
-        root = GcodeExporter.GcodeExporter(rawStream, self.document, 0)
+        root = GcodeExporter.GcodeExporter(rawStream, self.document, 0,
+                                           GcodeExporter.verbosityLevels[self.options.verbosity], output, cache)
         root.comment('Inkscape => GCode Save')
         stream = root.indent()
-        stream.comment(f'Name: {name}')
-        stream.comment(f'self: {self.__dir__()}')
+        stream.comment('Name: {}', name)
+        if stream.isTracing():
+            stream.trace('self: {}', self.__dir__())
 
         bbox = self.svg.get_page_bbox()
         gcodeTransform = (transforms.Transform(f'translate({bbox.left}, {bbox.bottom})')
@@ -39,10 +186,22 @@ class ExportCncGcode(OutputExtension):
         self.setupMachine(stream.indent())
 
         stream.comment('Traversing SVG document tree')
+        # Nothing is cut yet; a tool plan writes what came before this first, and into every program.
+        stream.output.operation(None)
+        rootTransform = gcodeTransform.__mul__(self.svg.transform)
         for elem in self.svg.iterchildren():
-            visitElement(stream.indent(), elem, gcodeTransform)
+            visitElement(stream.indent(), elem, rootTransform)
 
         stream.end_program(comment='end of program')
+        root.flush()
+        if modalOutput:
+            root.comment(modalOutput.getSummary())
+        if cache:
+            root.comment(cache.getSummary())
+        if instrumentation and self.options.instrument_comments:
+            for line in instrumentation.getSummary():
+                root.comment(line, level=GcodeExporter.VERBOSITY_NONE)
+        root.flush()
 
 if __name__ == '__main__':
     ExportCncGcode().run()
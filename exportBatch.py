@@ -0,0 +1,120 @@
+#!/usr/bin/env python
+# coding=utf-8
+#
+# Copyright (c) 2020 - Early Ehlinger, thenewentity.com
+#
+"""
+Export many SVG files to gcode without going through Inkscape.
+
+    python exportBatch.py [--jobs N] [--output-dir DIR] [export options] FILE_OR_GLOB...
+
+Export options are those of export-gcode.py, given as --name=value, e.g. --verbosity=none --compress=true.
+"""
+import argparse
+import glob
+import os
+import sys
+import time
+
+def loadExtension():
+    # Importing inkex and the exporter is the slow part of starting up; only pay for it when exporting. Worker
+    # processes load it as they start, so that the parent never does.
+    import importlib
+    return importlib.import_module('export-gcode').ExportCncGcode
+
+def checkArguments(extensionArgs):
+    """None if export-gcode.py accepts extensionArgs, else the exit status of its parser, which says why."""
+    try:
+        loadExtension()().parse_arguments(extensionArgs)
+    except SystemExit as exit:
+        return exit.code
+    return None
+
+def expandInputs(patterns):
+    result = []
+    for pattern in patterns:
+        matches = sorted(glob.glob(pattern, recursive=True)) if glob.has_magic(pattern) else [pattern]
+        result.extend(path for path in matches if path not in result)
+    return result
+
+def outputPathFor(inputPath, outputDir):
+    base, _ = os.path.splitext(os.path.basename(inputPath))
+    return os.path.join(outputDir or os.path.dirname(inputPath), base + '.gcode')
+
+def exportFile(inputPath, outputPath, extensionArgs):
+    """Export one file. Returns (inputPath, exportedElements, seconds, error), error being None on success."""
+    started = time.perf_counter()
+    temporaryPath = outputPath + '.part'
+    extension = None
+    try:
+        if not os.path.isfile(inputPath):
+            raise FileNotFoundError(f'no such file {inputPath}')
+        extension = loadExtension()()
+        # --output only names the file; the gcode is written to the stream below. It places per-tool programs.
+        extension.parse_arguments(extensionArgs + ['--output=' + outputPath, inputPath])
+        extension.load_raw()
+        with open(temporaryPath, 'wb') as stream:
+            extension.save(stream)
+        os.replace(temporaryPath, outputPath)
+        return inputPath, extension.exportedElements, time.perf_counter() - started, None
+    except Exception as error:
+        if os.path.exists(temporaryPath):
+            os.remove(temporaryPath)
+        return inputPath, 0, time.perf_counter() - started, f'{type(error).__name__}: {error}'
+    finally:
+        if extension is not None:
+            extension.clean_up()
+
+def main(args = None):
+    parser = argparse.ArgumentParser(description='Export SVG files to gcode, several at a time.',
+                                     epilog='Other options are passed on to export-gcode.py.')
+    parser.add_argument('inputs', nargs='+', metavar='FILE_OR_GLOB', help='SVG files or glob patterns (** recurses)')
+    parser.add_argument('-o', '--output-dir', default=None,
+                        help='Directory for the .gcode files; next to each SVG by default')
+    parser.add_argument('-j', '--jobs', type=int, default=0, help='Files exported at once; 0 uses every CPU')
+    options, extensionArgs = parser.parse_known_args(args)
+
+    inputs = expandInputs(options.inputs)
+    if not inputs:
+        parser.error('no input files')
+    jobs = min(options.jobs or os.cpu_count(), len(inputs))
+
+    started = time.perf_counter()
+    work = [(path, outputPathFor(path, options.output_dir), extensionArgs) for path in inputs]
+    executor = None
+    if jobs > 1:
+        from concurrent.futures import ProcessPoolExecutor, as_completed
+        executor = ProcessPoolExecutor(jobs, initializer=loadExtension)
+    try:
+        # Check the export options once up front rather than failing every file.
+        status = executor.submit(checkArguments, extensionArgs).result() if executor else checkArguments(extensionArgs)
+        if status is not None:
+            return status
+        if options.output_dir:
+            os.makedirs(options.output_dir, exist_ok=True)
+        if executor:
+            results = (future.result() for future in as_completed([executor.submit(exportFile, *item) for item in work]))
+            results = [report(result) for result in results]
+        else:
+            results = [report(exportFile(*item)) for item in work]
+    finally:
+        if executor:
+            executor.shutdown()
+    elapsed = max(time.perf_counter() - started, 1e-9)
+
+    failed = sum(1 for result in results if result[3])
+    elements = sum(result[1] for result in results)
+    print(f'{len(results) - failed} of {len(results)} files, {elements} elements in {elapsed:.2f}s: '
+          f'{(len(results) - failed) / elapsed:.2f} files/s, {elements / elapsed:.0f} elements/s', file=sys.stderr)
+    return 1 if failed else 0
+
+def report(result):
+    inputPath, elements, seconds, error = result
+    if error:
+        print(f'FAILED {inputPath}: {error}', file=sys.stderr)
+    else:
+        print(f'{inputPath}: {elements} elements in {seconds:.2f}s', file=sys.stderr)
+    return result
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,267 @@
+#!/usr/bin/env python
+# coding=utf-8
+#
+# Copyright (c) 2020 - Early Ehlinger, thenewentity.com
+#
+import base64
+import io
+import math
+import os
+import urllib.parse
+
+import numpy
+from numpy.lib.stride_tricks import sliding_window_view
+
+import inkex_ex
+import GcodeStyle
+
+from inkex import errormsg
+
+from float_range import float_range
+from GcodeExporter import VERBOSITY_NONE
+from geometry import transformPoints
+from instrumentation import instrumented
+from moves import linear, rapid, safeHeight, trace
+
+# Per-channel weights for the luminance of an RGB pixel.
+lumaWeights = numpy.array([0.299, 0.587, 0.114])
+
+def parseNetpbmHeader(data):
+    """(channels, width, height, maxValue, offset) for a binary PGM (P5) or PPM (P6) header, else None."""
+    if data[:2] not in (b'P5', b'P6'):
+        return None
+    fields = []
+    offset = 2
+    while len(fields) < 3:
+        while offset < len(data) and data[offset:offset + 1].isspace():
+            offset += 1
+        if data[offset:offset + 1] == b'#':
+            offset = data.index(b'\n', offset) + 1
+            continue
+        start = offset
+        while offset < len(data) and data[offset:offset + 1].isdigit():
+            offset += 1
+        if start == offset:
+            return None
+        fields.append(int(data[start:offset]))
+    # Exactly one whitespace byte separates the header from the pixels.
+    return (1 if data[:2] == b'P5' else 3), fields[0], fields[1], fields[2], offset + 1
+
+def netpbmShape(channels, width, height):
+    return (height, width) if channels == 1 else (height, width, channels)
+
+def netpbmType(maxValue):
+    return numpy.uint8 if maxValue < 256 else numpy.dtype('>u2')
+
+def decodeWithPillow(source):
+    try:
+        from PIL import Image
+    except ImportError:
+        raise ValueError('reading PNG, JPEG and other formats needs Pillow (pip install Pillow); '
+                         'or use a binary PGM/PPM image instead')
+    image = Image.open(source)
+    if image.mode in ('I', 'I;16', 'I;16B'):
+        pixels = numpy.asarray(image)
+        return pixels, 65535 if image.mode != 'I' else max(int(pixels.max()), 1)
+    return numpy.asarray(image.convert('L')), 255
+
+def loadImage(href, baseDir):
+    """Returns (pixels, maxValue) for an image href, pixels being (rows, columns) or (rows, columns, 3).
+
+    Binary PGM/PPM files are memory-mapped rather than read, so large height maps
+    are only paged in as rows are used. Other formats are decoded with Pillow.
+    """
+    if href.startswith('data:'):
+        header, _, payload = href[5:].partition(',')
+        data = base64.b64decode(payload) if header.endswith(';base64') else urllib.parse.unquote_to_bytes(payload)
+        netpbm = parseNetpbmHeader(data)
+        if netpbm is None:
+            return decodeWithPillow(io.BytesIO(data))
+        channels, width, height, maxValue, offset = netpbm
+        pixels = numpy.frombuffer(data, netpbmType(maxValue), width * height * channels, offset)
+        return pixels.reshape(netpbmShape(channels, width, height)), maxValue
+
+    url = urllib.parse.urlparse(href)
+    path = urllib.parse.unquote(url.path) if url.scheme == 'file' else href
+    if not os.path.isabs(path):
+        path = os.path.join(baseDir, path)
+    with open(path, 'rb') as file:
+        netpbm = parseNetpbmHeader(file.read(1024))
+    if netpbm is None:
+        return decodeWithPillow(path)
+    channels, width, height, maxValue, offset = netpbm
+    return numpy.memmap(path, netpbmType(maxValue), 'r', offset, netpbmShape(channels, width, height)), maxValue
+
+def luminance(pixels, maxValue):
+    """Luminance from 0 (black) to 1 (white) of a block of rows."""
+    if pixels.ndim == 3:
+        return pixels[..., :3] @ lumaWeights / maxValue
+    return pixels / float(maxValue)
+
+def slidingMax(values, radius):
+    """The largest of values[i - radius:i + radius + 1] for each i."""
+    if radius < 1:
+        return values
+    padded = numpy.pad(values, radius, constant_values=-numpy.inf)
+    return sliding_window_view(padded, 2 * radius + 1).max(axis=1)
+
+class DepthMap:
+    """Tool heights over an image, read a few rows at a time.
+
+    Luminance maps to the surface height: white is -gcode-start-depth and black
+    is -gcode-depth. The tool height at a pixel is the highest surface under a
+    flat tool centred on it, so the cutter never dips into the relief around it.
+    """
+    def __init__(self, pixels, maxValue, gcodeStyle, pixelWidth, pixelHeight):
+        self.pixels = pixels
+        self.maxValue = maxValue
+        self.top = -gcodeStyle.startDepth
+        self.range = gcodeStyle.depth - gcodeStyle.startDepth
+        radius = gcodeStyle.toolDiameter / 2.0
+        rx = radius / pixelWidth
+        ry = radius / pixelHeight
+        reach = int(ry)
+        # Half-width in columns of the tool's footprint on each row offset.
+        self.footprint = [(dy, int(rx * math.sqrt(max(0.0, 1 - (dy / ry) ** 2)))) if ry else (dy, int(rx))
+                          for dy in range(-reach, reach + 1)]
+
+    def toolHeights(self, row):
+        rows = len(self.pixels)
+        first = max(0, row + self.footprint[0][0])
+        last = min(rows, row + self.footprint[-1][0] + 1)
+        surface = self.top - (1 - luminance(numpy.asarray(self.pixels[first:last]), self.maxValue)) * self.range
+        result = None
+        for dy, halfWidth in self.footprint:
+            if first <= row + dy < last:
+                heights = slidingMax(surface[row + dy - first], halfWidth)
+                result = heights if result is None else numpy.maximum(result, heights)
+        return result
+
+def placeImage(columns, rows, x, y, width, height, preserveAspectRatio):
+    """Where an image's pixels go in its x, y, width, height box, as its preserveAspectRatio places them.
+
+    Returns (x, y, width, height) of the pixels that show, and the slices of the
+    rows and columns they are: with slice, pixels whose centres fall outside
+    the box are clipped.
+    """
+    parts = (preserveAspectRatio or '').split()
+    if parts and parts[0] == 'defer':
+        parts = parts[1:]
+    align = parts[0] if parts else 'xMidYMid'
+    if align == 'none':
+        return (x, y, width, height), slice(0, rows), slice(0, columns)
+    fractions = {'Min': 0.0, 'Mid': 0.5, 'Max': 1.0}
+    fx = fractions.get(align[1:4], 0.5)
+    fy = fractions.get(align[5:8], 0.5)
+    scales = (width / columns, height / rows)
+    scale = max(scales) if len(parts) > 1 and parts[1] == 'slice' else min(scales)
+    left = x + (width - columns * scale) * fx
+    top = y + (height - rows * scale) * fy
+    # The pixels whose centres are inside the box.
+    firstColumn = max(0, math.ceil((x - left) / scale - 0.5 - 1e-9))
+    lastColumn = min(columns, math.floor((x + width - left) / scale - 0.5 + 1e-9) + 1)
+    firstRow = max(0, math.ceil((y - top) / scale - 0.5 - 1e-9))
+    lastRow = min(rows, math.floor((y + height - top) / scale - 0.5 + 1e-9) + 1)
+    return ((left + firstColumn * scale, top + firstRow * scale, (lastColumn - firstColumn) * scale,
+             (lastRow - firstRow) * scale), slice(firstRow, lastRow), slice(firstColumn, lastColumn))
+
+# A 2:1 image in a square box: centred and shrunk to fit by default, stretched with none, clipped with slice.
+assert placeImage(20, 10, 0, 0, 10, 10, None) == ((0, 2.5, 10, 5), slice(0, 10), slice(0, 20))
+assert placeImage(20, 10, 0, 0, 10, 10, 'xMinYMax meet') == ((0, 5, 10, 5), slice(0, 10), slice(0, 20))
+assert placeImage(20, 10, 0, 0, 10, 10, 'none') == ((0, 0, 10, 10), slice(0, 10), slice(0, 20))
+assert placeImage(20, 10, 0, 0, 10, 10, 'xMidYMid slice') == ((0, 0, 10, 10), slice(0, 10), slice(5, 15))
+
+def significantPoints(heights):
+    """Indices of the samples to keep: the ends, and wherever the slope of heights changes."""
+    if len(heights) < 3:
+        return numpy.arange(len(heights))
+    bends = numpy.flatnonzero(numpy.abs(numpy.diff(heights, 2)) > 1e-9) + 1
+    return numpy.concatenate(([0], bends, [len(heights) - 1]))
+
+def surfaceAtDepth(gcodeStyle, depthMap, rowPoints, rowIndices, level, indent = 0):
+    """Yields the moves surfacing the image's rows, never going below level."""
+    zigzag = gcodeStyle.fillMode == 'zigzag'
+    started = False
+    for number, row in enumerate(rowIndices):
+        heights = numpy.maximum(depthMap.toolHeights(row), level)
+        points = rowPoints(row)
+        if zigzag and number % 2:
+            heights = heights[::-1]
+            points = points[::-1]
+        keep = significantPoints(heights)
+        yield trace("row:{} moves:{} of {}", row, len(keep), len(heights), indent=indent)
+        x, y = points[keep[0]]
+        if zigzag and started:
+            # Step over above the relief instead of retracting to safe height.
+            yield linear('clear the relief', indent, Z=max(depthMap.top, level), F=gcodeStyle.feedz)
+            yield linear('step over', indent, X=x, Y=y, F=gcodeStyle.feedxy)
+        else:
+            yield safeHeight(gcodeStyle, indent)
+            yield rapid('rapid to start of row', indent, X=x, Y=y, F=gcodeStyle.rapidxy)
+        yield linear('plunge', indent, Z=float(heights[keep[0]]), F=gcodeStyle.feedz)
+        for (x, y), z in zip(points[keep[1:]].tolist(), heights[keep[1:]].tolist()):
+            yield linear('surface', indent, X=x, Y=y, Z=z, F=gcodeStyle.feedxy)
+        started = True
+    yield safeHeight(gcodeStyle, indent)
+
+@instrumented('exportImage')
+def exportImage(stream, element, transform, methods, parentStyle = None):
+    gcodeStyle = GcodeStyle.getElementGcodeStyle(stream, element, parentStyle)
+    stream = stream.withVerbosity(gcodeStyle.getVerbosity())
+
+    stream.comment('exportImage: exporting element type:"{}" id:"{}"', inkex_ex.typeName(element), element.get_id())
+    if not gcodeStyle.depth:
+        stream.trace("Depth is 0. Skipping image")
+        return
+    if gcodeStyle.display == 'none':
+        stream.trace("Style.display:none. Skipping image")
+        return
+    href = element.get('xlink:href') or element.get('href')
+    if not href:
+        stream.comment("Image has no href. Skipping image")
+        return
+
+    url = getattr(getattr(stream.document, 'docinfo', None), 'URL', None) or os.environ.get('DOCUMENT_PATH', '')
+    try:
+        pixels, maxValue = loadImage(href, os.path.dirname(url))
+    except (OSError, ValueError) as error:
+        # A missing relief is worth knowing about whatever the verbosity: say so in the gcode and to Inkscape.
+        stream.comment("Can't read image {}: {}. Skipping image", element.get_id(), error, level=VERBOSITY_NONE)
+        errormsg(f"Can't read image {element.get_id()}: {error}. It was skipped.")
+        return
+    rows, columns = pixels.shape[:2]
+    (x, y, width, height), rowSlice, columnSlice = placeImage(
+        columns, rows, element.to_dimensionless(element.get('x', '0')), element.to_dimensionless(element.get('y', '0')),
+        element.to_dimensionless(element.get('width', str(columns))),
+        element.to_dimensionless(element.get('height', str(rows))), element.get('preserveAspectRatio'))
+    pixels = pixels[rowSlice, columnSlice]
+    rows, columns = pixels.shape[:2]
+    if not rows or not columns:
+        stream.trace("No pixels show. Skipping image")
+        return
+    effectiveTransform = transform.__mul__(element.transform)
+
+    # Pixel centres along one image row, in gcode coordinates.
+    columnXs = x + (numpy.arange(columns) + 0.5) * (width / columns)
+    def rowPoints(row):
+        ys = numpy.full(columns, y + (row + 0.5) * (height / rows))
+        return transformPoints(effectiveTransform, numpy.stack((columnXs, ys), axis=-1))
+
+    (a, c, _), (b, d, _) = effectiveTransform.matrix
+    pixelWidth = math.hypot(a, b) * width / columns
+    pixelHeight = math.hypot(c, d) * height / rows
+    stepOver = max(gcodeStyle.stepOver, pixelHeight)
+    rowIndices = numpy.unique(numpy.linspace(0, rows - 1, int(math.ceil((rows - 1) * pixelHeight / stepOver)) + 1)
+                              .round().astype(int)).tolist()
+    stream.comment("image: {}x{} pixels, {} rows of {} samples", columns, rows, len(rowIndices), columns)
+
+    if stream.output.parallel:
+        # Surfacing writes straight through; don't let it queue up behind pending paths.
+        stream.output.drain(0)
+    depthMap = DepthMap(pixels, maxValue, gcodeStyle, pixelWidth, pixelHeight)
+    stream.output.operation(gcodeStyle)
+    for level in float_range(-gcodeStyle.startDepth - gcodeStyle.depthIncrement, -gcodeStyle.depth,
+                             -gcodeStyle.depthIncrement, True):
+        stream.comment("depth:{}", level)
+        stream.emit(surfaceAtDepth(gcodeStyle, depthMap, rowPoints, rowIndices, level, 1))
+    stream.output.operation(None)
@@ -1,14 +1,45 @@
 import GcodeStyle
+import travelOrder
 
-def exportLayer(stream, element, transform, methods):
-    gcodeStyle = GcodeStyle.getElementGcodeStyle(stream, element)
+from instrumentation import instrumented
+
+def orderChildren(stream, children, transform, methods):
+    # Runs of path children are reordered; anything else (e.g. a group) stays where it is.
+    result = []
+    run = []
+    before = after = 0
+    for child in children + [None]:
+        if child is not None and methods['isPathElement'](child):
+            run.append(child)
+            continue
+        if run:
+            run, runBefore, runAfter = travelOrder.orderPathElements(run, transform, stream.getPosition())
+            result.extend(run)
+            before += runBefore
+            after += runAfter
+            run = []
+        if child is not None:
+            result.append(child)
+    stream.comment("travel order: rapids {:.1f}mm -> {:.1f}mm", before, after)
+    return result
+
+@instrumented('exportLayer')
+def exportLayer(stream, element, transform, methods, parentStyle = None):
+    style = GcodeStyle.composeStyle(element, parentStyle)
+    gcodeStyle = GcodeStyle.getGcodeStyle(stream, style)
+    stream = stream.withVerbosity(gcodeStyle.getVerbosity())
     if gcodeStyle.display == 'none':
-        stream.comment("Style.display:none. Skipping layer")
+        stream.trace("Style.display:none. Skipping layer")
         return
 
-    effectiveTransform = transform.__mul__(element.composed_transform())
-    stream.comment(f"layer: originalTransform: {transform} transform: {element.composed_transform()} effectiveTransform:{effectiveTransform}")
+    # transform already includes every ancestor's transform.
+    effectiveTransform = transform.__mul__(element.transform)
+    if stream.isTracing():
+        stream.trace("layer: originalTransform: {} transform: {} effectiveTransform:{}", transform, element.transform, effectiveTransform)
 
-    for child in reversed(list(element.iterchildren())):
-        methods['visitElement'](stream.indent(), child, effectiveTransform)
+    children = list(reversed(list(element.iterchildren())))
+    if gcodeStyle.travelOrder == 'nearest':
+        children = orderChildren(stream, children, effectiveTransform, methods)
+    for child in children:
+        methods['visitElement'](stream.indent(), child, effectiveTransform, style)
     stream.safe_height(gcodeStyle)
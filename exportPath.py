@@ -4,31 +4,84 @@ import GcodeStyle
 
 from inkex import CubicSuperPath
 from contour import contour
+from GcodeExporter import movedTo
+from instrumentation import instrumented
+from parallelExport import RecordingOutput, replay
 from pocket import pocket
 
-def exportPath(stream, element, transform, methods):
-    gcodeStyle = GcodeStyle.getElementGcodeStyle(stream, element)
-        
-    stream.comment(f'exportPath: exporting element type:"{inkex_ex.typeName(element)}" id:"{element.get_id()}"')
-    effectiveTransform = transform.__mul__(element.composed_transform())
+@instrumented('exportPath')
+def exportPath(stream, element, transform, methods, parentStyle = None):
+    gcodeStyle = GcodeStyle.getElementGcodeStyle(stream, element, parentStyle)
+    stream = stream.withVerbosity(gcodeStyle.getVerbosity())
+
+    stream.comment('exportPath: exporting element type:"{}" id:"{}"', inkex_ex.typeName(element), element.get_id())
+    effectiveTransform = transform.__mul__(element.transform)
     #stream.comment(f'composed_transform:"{element.composed_transform()}"')
     #stream.comment(f'transform:"{transform}"')
     #stream.comment(f'effectiveTransform:"{effectiveTransform}"')
 
     if not gcodeStyle.depth:
-        stream.comment("Depth is 0. Skipping path")
+        stream.trace("Depth is 0. Skipping path")
         return
     if gcodeStyle.display == 'none':
-        stream.comment("Style.display:none. Skipping path")
+        stream.trace("Style.display:none. Skipping path")
         return
 
     path = element.path
     # stream.comment(f"path:{path}")
-    stream.comment(f"gcodeStyle:{gcodeStyle.__dict__}")
+    stream.trace("gcodeStyle:{}", gcodeStyle.__dict__)
     csp = CubicSuperPath(path).to_path()
-    stream.comment(f"csp:{csp}")
-    zones = geometry.cspToZones(stream, csp, gcodeStyle, effectiveTransform)
+    stream.trace("csp:{}", csp)
+    stream.output.operation(gcodeStyle)
+    cache = stream.cache
+    if cache:
+        # Travel ordering starts from wherever the tool is, so that is part of the key too.
+        position = stream.getPosition() if gcodeStyle.travelOrder == 'nearest' else None
+        key = cache.key(stream, gcodeStyle, csp, effectiveTransform, position)
+        records = cache.get(key)
+        if records is not None:
+            replay(records, stream.output)
+            stream.output.operation(None)
+            return
+    if stream.output.parallel:
+        future = stream.output.submitPath(stream, gcodeStyle, csp, effectiveTransform)
+        if cache:
+            future.add_done_callback(lambda done: done.exception() is None and cache.put(key, done.result()))
+    elif cache:
+        recording = RecordingOutput(stream.getPosition())
+        exportPathGeometry(stream.withOutput(recording), gcodeStyle, csp, effectiveTransform)
+        replay(recording.records, stream.output)
+        cache.put(key, recording.records)
+    else:
+        exportPathGeometry(stream, gcodeStyle, csp, effectiveTransform)
+    stream.output.operation(None)
+
+def exportPathGeometry(stream, gcodeStyle, csp, transform):
+    """The part of exportPath that only needs the path's geometry, so it can run in a worker process."""
+    zones = geometry.cspToZones(stream, csp, gcodeStyle, transform)
+    if gcodeStyle.edgeMode in ('inside', 'outside'):
+        radius = gcodeStyle.toolDiameter / 2.0
+        zones = geometry.offsetZones(zones, radius if gcodeStyle.edgeMode == 'outside' else -radius,
+                                     gcodeStyle.curveTolerance or 0.01)
+        stream.trace("edge mode {}: offset by {} into {} polylines", gcodeStyle.edgeMode, radius, len(zones.polylines))
+
+    stream.emit(toolpathMoves(gcodeStyle, zones, stream.getPosition(), 1))
 
-    contour(stream.indent(), gcodeStyle, zones, effectiveTransform)
-    if gcodeStyle.fillMode == 'hatch':
-        pocket(stream.indent(), gcodeStyle, zones, effectiveTransform)
+def toolpathMoves(gcodeStyle, zones, position, indent = 0):
+    """Yields the moves.Move and moves.Comment records cutting zones: the contour, and the pocket if it's filled.
+
+    position is where the tool starts, for travel ordering.
+    """
+    if gcodeStyle.travelOrder == 'nearest':
+        # Cut the pocket while the profile around it still holds the part down.
+        if gcodeStyle.fillsArea():
+            for record in pocket(gcodeStyle, zones, indent):
+                words = getattr(record, 'words', ())
+                if 'X' in words or 'Y' in words:
+                    position = movedTo(position, words)
+                yield record
+        yield from contour(gcodeStyle, zones, position, indent)
+        return
+    yield from contour(gcodeStyle, zones, position, indent)
+    if gcodeStyle.fillsArea():
+        yield from pocket(gcodeStyle, zones, indent)
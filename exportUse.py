@@ -0,0 +1,40 @@
+import inkex
+import GcodeStyle
+
+from exportLayer import exportLayer
+from instrumentation import instrumented
+
+# ids of the elements being cloned right now, so that a clone of its own ancestor stops instead of recursing.
+expanding = set()
+
+@instrumented('exportUse')
+def exportUse(stream, element, transform, methods, parentStyle = None):
+    """Export the element a <use> clones as if it were the use's only child, at the use's x and y."""
+    style = GcodeStyle.composeStyle(element, parentStyle)
+    gcodeStyle = GcodeStyle.getGcodeStyle(stream, style)
+    stream = stream.withVerbosity(gcodeStyle.getVerbosity())
+    if gcodeStyle.display == 'none':
+        stream.trace("Style.display:none. Skipping clone")
+        return
+    source = element.href
+    if source is None:
+        stream.comment('Clone {} links to nothing. Skipping clone', element.get_id())
+        return
+    if source.get_id() in expanding or any(ancestor is source for ancestor in element.iterancestors()):
+        stream.comment('Clone {} contains itself. Skipping clone', element.get_id())
+        return
+
+    # The clone's x and y translate the source after the clone's own transform, like Use.unlink.
+    effectiveTransform = transform.__mul__(element.transform).__mul__(
+        inkex.Transform(translate=(element.to_dimensionless(element.get('x', '0')),
+                                   element.to_dimensionless(element.get('y', '0')))))
+    stream.comment('exportUse: cloning id:"{}" as id:"{}"', source.get_id(), element.get_id())
+    expanding.add(source.get_id())
+    try:
+        if isinstance(source, inkex.Symbol):
+            # A symbol is only drawn through clones, and then like a group.
+            exportLayer(stream.indent(), source, effectiveTransform, methods, style)
+        else:
+            methods['visitElement'](stream.indent(), source, effectiveTransform, style)
+    finally:
+        expanding.discard(source.get_id())
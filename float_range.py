@@ -1,11 +1,17 @@
 def float_range(start, stop, step, includeStop = False):
-    if start < stop:
+    # A step that leads away from stop gives an empty range rather than counting forever.
+    if step > 0:
         while start < stop:
             yield float(start)
             start += step
-    else:
+    elif step < 0:
         while start > stop:
             yield float(start)
             start += step
     if includeStop:
         yield stop
+
+assert list(float_range(0, 3, 1)) == [0, 1, 2]
+assert list(float_range(0, -2, -1, True)) == [0, -1, -2]
+assert list(float_range(3, 0, 1)) == []
+assert list(float_range(-2.5, -2, -2.5, True)) == [-2]
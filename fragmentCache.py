@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# coding=utf-8
+#
+# Copyright (c) 2020 - Early Ehlinger, thenewentity.com
+#
+import hashlib
+import json
+import os
+import threading
+
+# Hash of the exporter's own source, so that changing the exporter invalidates what it cached.
+exporterVersion = None
+
+def getExporterVersion():
+    global exporterVersion
+    if exporterVersion is None:
+        digest = hashlib.sha256()
+        directory = os.path.dirname(os.path.abspath(__file__))
+        for name in sorted(os.listdir(directory)):
+            if name.endswith('.py'):
+                digest.update(name.encode('utf-8'))
+                with open(os.path.join(directory, name), 'rb') as file:
+                    digest.update(file.read())
+        exporterVersion = digest.hexdigest()
+    return exporterVersion
+
+class FragmentCache:
+    """Gcode fragments of exported paths, stored on disk under a hash of everything that went into them.
+
+    Fragments are the records of a RecordingOutput, so a hit is replayed exactly
+    like a path exported in a worker process. The least recently used fragments
+    are evicted once the directory holds more than maxBytes.
+    """
+    def __init__(self, directory, maxBytes):
+        self.directory = directory
+        self.maxBytes = maxBytes
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, stream, gcodeStyle, csp, transform, position = None):
+        parts = [getExporterVersion(), stream.depth, stream.verbosity, gcodeStyle.__dict__,
+                 [(command.letter, list(command.args)) for command in csp], transform.matrix, position]
+        return hashlib.sha256(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, key[:2], key + '.json')
+
+    def get(self, key):
+        path = self.path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as file:
+                records = json.load(file)
+            # The modification time doubles as the last use, for eviction.
+            os.utime(path)
+        except (OSError, ValueError):
+            self.misses += 1
+            return None
+        self.hits += 1
+        return records
+
+    def put(self, key, records):
+        # May be called from the thread that completes worker futures, hence the per-thread file name.
+        path = self.path(key)
+        temporaryPath = f'{path}.{os.getpid()}.{threading.get_ident()}.part'
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            with open(temporaryPath, 'w', encoding='utf-8') as file:
+                json.dump(records, file, separators=(',', ':'))
+            os.replace(temporaryPath, path)
+        except OSError:
+            # A cache that can't be written only costs speed.
+            pass
+
+    def evict(self):
+        entries = []
+        for root, _, names in os.walk(self.directory):
+            for name in names:
+                if name.endswith('.json'):
+                    path = os.path.join(root, name)
+                    try:
+                        status = os.stat(path)
+                    except OSError:
+                        continue
+                    entries.append((status.st_mtime, status.st_size, path))
+        total = sum(size for _, size, _ in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.maxBytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+            total -= size
+
+    def getSummary(self):
+        return f'fragment cache: {self.hits} hits, {self.misses} misses'
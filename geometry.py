@@ -1,5 +1,9 @@
+import collections
+import functools
 import math
-from inkex import bezier
+import numpy
+
+from instrumentation import instrumented
 
 def segmentLength(p0, p1, stream = None):
     a = p1[0] - p0[0]
@@ -8,7 +12,7 @@ def segmentLength(p0, p1, stream = None):
     bsq = b * b
     result = math.sqrt(asq + bsq)
     if stream:
-        stream.comment(f'segmentLength: p0:{p0} p1:{p1} a:{a} b:{b} asq:{asq} bsq:{bsq} result:{result}')
+        stream.trace('segmentLength: p0:{} p1:{} a:{} b:{} asq:{} bsq:{} result:{}', p0, p1, a, b, asq, bsq, result)
     return result
 
 assert 10 == segmentLength((0,0), (10,0))
@@ -20,6 +24,21 @@ assert 5 == segmentLength((0,0), (4,3))
 assert 5 == segmentLength((3,4), (0,0))
 assert 5 == segmentLength((4,3), (0,0))
 
+def pointInPolygon(point, polygon):
+    """Even-odd test of point against the closed point list polygon."""
+    x, y = point[0], point[1]
+    inside = False
+    p0 = polygon[-1]
+    for p1 in polygon:
+        if (p0[1] > y) != (p1[1] > y):
+            if x < (p1[0] - p0[0]) * (y - p0[1]) / (p1[1] - p0[1]) + p0[0]:
+                inside = not inside
+        p0 = p1
+    return inside
+
+assert pointInPolygon((1,1), [(0,0),(2,0),(2,2),(0,2)])
+assert not pointInPolygon((3,1), [(0,0),(2,0),(2,2),(0,2)])
+
 class Bounds:
     def __init__(self, x0 = None, y0 = None, x1 = None, y1 = None):
         self.x0 = x0
@@ -41,32 +60,95 @@ class Bounds:
             self.y1 = point[1]
 
 class Polyline:
-    def __init__(self, points = None, closed = False):
-        self.points = points or list()
+    """A run of points, stored as a read-only (n, 2) float array.
+
+    Cumulative arc length and bounds are computed on first use and dropped
+    when points is assigned. curves holds a (first, last, bezier) tuple for each
+    cubic bezier that points[first:last + 1] were sampled from.
+    """
+    __slots__ = ('_points', 'closed', '_lengths', '_bounds', 'curves')
+
+    def __init__(self, points = None, closed = False, curves = ()):
+        self.points = points if points is not None else ()
         self.closed = closed
+        self.curves = curves
+
+    @property
+    def points(self):
+        return self._points
+
+    @points.setter
+    def points(self, points):
+        array = numpy.array(points, dtype=float).reshape(-1, 2)
+        array.flags.writeable = False
+        self._points = array
+        self._lengths = None
+        self._bounds = None
+
+    def __len__(self):
+        return len(self._points)
 
     def __str__(self):
-        return f"{self.__dict__}"
+        return f"{{'points': {self._points.tolist()}, 'closed': {self.closed}}}"
+
+    def getCumulativeLengths(self):
+        """Arc length from the first point to each point."""
+        if self._lengths is None:
+            deltas = numpy.diff(self._points, axis=0)
+            # sqrt(a*a + b*b) like segmentLength, so lengths match it exactly.
+            lengths = numpy.sqrt(deltas[:, 0] * deltas[:, 0] + deltas[:, 1] * deltas[:, 1])
+            self._lengths = numpy.concatenate(([0.0], numpy.cumsum(lengths)))
+            self._lengths.flags.writeable = False
+        return self._lengths
 
     def getLength(self):
-        if len(self.points):
-            result = 0
-            p0 = self.points[0]
-            for p1 in self.points[1:]:
-                result = result + segmentLength(p0,p1)
-                p0 = p1
-            return result
+        if len(self._points):
+            return float(self.getCumulativeLengths()[-1])
         else:
             return 0
 
-    def getBounds(self, result = Bounds()):
-        for point in self.points:
-            result.update(point)
+    def pointAtLength(self, length):
+        """The point at arc length length along the polyline, clamped to its ends."""
+        lengths = self.getCumulativeLengths()
+        index = int(numpy.searchsorted(lengths, length, side='right')) - 1
+        index = min(max(index, 0), len(lengths) - 2)
+        if index < 0:
+            return tuple(self._points[0].tolist())
+        segment = lengths[index + 1] - lengths[index]
+        fraction = min(max((length - lengths[index]) / segment, 0.0), 1.0) if segment else 0.0
+        p0, p1 = self._points[index], self._points[index + 1]
+        return (float(p0[0] + fraction * (p1[0] - p0[0])), float(p0[1] + fraction * (p1[1] - p0[1])))
+
+    def rotated(self, entry):
+        """This closed polyline starting at points[entry] instead; curves through that point become lines."""
+        points = self._points.tolist()[:-1]
+        points = points[entry:] + points[:entry]
+        count = len(points)
+        curves = [(first - entry, last - entry, bezier) if first >= entry else
+                  (first + count - entry, last + count - entry, bezier)
+                  for first, last, bezier in self.curves if first >= entry or last <= entry]
+        return Polyline(points + points[:1], True, curves)
+
+    def getBounds(self, result = None):
+        if result is None:
+            result = Bounds()
+        if not len(self._points):
+            return result
+        if self._bounds is None:
+            x0, y0 = self._points.min(axis=0).tolist()
+            x1, y1 = self._points.max(axis=0).tolist()
+            self._bounds = ((x0, y0), (x1, y1))
+        result.update(self._bounds[0])
+        result.update(self._bounds[1])
         return result
 
 class Zones:
-    def __init__(self, polylines = None):
+    """Polylines to cut. offset is how far offsetZones moved their outlines, 0 if they are as drawn."""
+    __slots__ = ('polylines', 'offset')
+
+    def __init__(self, polylines = None, offset = 0):
         self.polylines = polylines or list()
+        self.offset = offset
 
     def __str__(self):
         return "{'polylines':[" + ",".join([f"{p}" for p in self.polylines]) + "]}"
@@ -80,40 +162,454 @@ class Zones:
             polyline.getBounds(result)
         return result
 
-def cspToZones(stream, path, gcodeStyle, transform):
-    zones = Zones()
-    stream.comment(f'cspToZones...')
-    polyline = None
-    for command in path:
-        letter = command.letter
-        stream.comment(f'svg path command:"{command}"')
+assert Polyline([(0,0),(3,4),(3,10)]).getLength() == 11
+assert Polyline([(0,0),(3,4),(3,10)]).pointAtLength(8) == (3, 7)
+assert Polyline([(0,0),(10,0)]).getBounds().x1 == 10
+
+def scanlineCrossings(zones, ys):
+    """Intersect the closed polylines in zones with horizontal lines at ys.
+
+    Returns a list of (y, sorted x crossings) in the order of ys, which must be
+    ascending. Edges are built into a table sorted by their lower end and swept
+    with an active edge list. Each edge covers the half-open range
+    [ymin, ymax), so a vertex lying exactly on a scanline is counted once and
+    horizontal edges are never counted.
+    """
+    edges = []
+    for polyline in zones.polylines:
+        if not polyline.closed or len(polyline) < 2:
+            continue
+        points = polyline.points
+        p0, p1 = points[:-1], points[1:]
+        sloped = p0[:, 1] != p1[:, 1]
+        p0, p1 = p0[sloped], p1[sloped]
+        edges.extend(zip(numpy.minimum(p0[:, 1], p1[:, 1]).tolist(), numpy.maximum(p0[:, 1], p1[:, 1]).tolist(),
+                         p0[:, 0].tolist(), p0[:, 1].tolist(), p1[:, 0].tolist(), p1[:, 1].tolist()))
+    edges.sort(key=lambda edge: edge[0])
+
+    result = []
+    active = []
+    nextEdge = 0
+    for y in ys:
+        while nextEdge < len(edges) and edges[nextEdge][0] <= y:
+            active.append(edges[nextEdge])
+            nextEdge += 1
+        active = [edge for edge in active if edge[1] > y]
+        # https://en.wikipedia.org/wiki/Linear_interpolation
+        # (x-x0) = (y-y0)(x1-x0)/(y1-y0)
+        crossings = sorted((y - y0) * (x1 - x0) / (y1 - y0) + x0 for _, _, x0, y0, x1, y1 in active)
+        result.append((y, crossings))
+    return result
+
+def transformPoints(transform, points):
+    (a, c, e), (b, d, f) = transform.matrix
+    xs = points[..., 0]
+    ys = points[..., 1]
+    return numpy.stack((a * xs + c * ys + e, b * xs + d * ys + f), axis=-1)
+
+def curveIncrementParameters(curveIncrement):
+    # Accumulate exactly like the original `t += curveIncrement` loop so that
+    # existing documents keep producing the same samples.
+    result = []
+    t = 0
+    while t < 1.0:
+        result.append(t)
+        t += curveIncrement
+    return numpy.array(result, dtype=float)
+
+def curveSegmentCounts(beziers, tolerance):
+    # The chordal error of n uniform steps is bounded by max|B''| / (8 n^2), and
+    # for a cubic max|B''| <= 6 * max(|p0 - 2p1 + p2|, |p1 - 2p2 + p3|).
+    d1 = numpy.hypot(*(beziers[:, 0] - 2 * beziers[:, 1] + beziers[:, 2]).T)
+    d2 = numpy.hypot(*(beziers[:, 1] - 2 * beziers[:, 2] + beziers[:, 3]).T)
+    counts = numpy.ceil(numpy.sqrt(0.75 * numpy.maximum(d1, d2) / tolerance))
+    return numpy.maximum(counts, 1).astype(int)
+
+def flattenBeziers(beziers, curveIncrement, curveTolerance):
+    """Sample an (n, 4, 2) array of cubic beziers in one pass.
+
+    Returns the sample points and, for each curve, the offset of its first sample.
+    """
+    if curveTolerance:
+        counts = curveSegmentCounts(beziers, curveTolerance)
+        curveIndex = numpy.repeat(numpy.arange(len(beziers)), counts - 1)
+        offsets = numpy.concatenate(([0], numpy.cumsum(counts - 1)))
+        t = (numpy.arange(len(curveIndex)) - offsets[curveIndex] + 1) / counts[curveIndex]
+    else:
+        ts = curveIncrementParameters(curveIncrement)
+        curveIndex = numpy.repeat(numpy.arange(len(beziers)), len(ts))
+        offsets = numpy.arange(len(beziers) + 1) * len(ts)
+        t = numpy.tile(ts, len(beziers))
+    # same parameterization as inkex.bezier.bezierpointatt
+    p0 = beziers[curveIndex, 0]
+    c = 3 * (beziers[curveIndex, 1] - p0)
+    b = 3 * (beziers[curveIndex, 2] - beziers[curveIndex, 1]) - c
+    a = beziers[curveIndex, 3] - p0 - c - b
+    t = t[:, None]
+    return a * (t ** 3) + b * (t ** 2) + c * t + p0, offsets
+
+class Outline:
+    """A path flattened in its own coordinates, relative to its first point, ready to be placed by a transform.
+
+    points holds every polyline's points end to end; polylines are (start, end,
+    closed) slices of it, and curves are (polyline, first, last, bezier index)
+    for the rows of beziers that cutPolylineAtDepth can write as curves.
+    """
+    __slots__ = ('points', 'polylines', 'curves', 'beziers')
+
+    def __init__(self, points, polylines, curves, beziers):
+        self.points = points
+        self.polylines = polylines
+        self.curves = curves
+        self.beziers = beziers
+
+def pointCache(maxPoints):
+    """Like functools.lru_cache, but holding results (with points and beziers arrays, like Outline) up to maxPoints
+    points in all rather than a number of them, so a few huge paths can't keep the memory of a whole run."""
+    def decorate(function):
+        cache = collections.OrderedDict()
+        sizes = {}
+        total = 0
+
+        @functools.wraps(function)
+        def cached(*args):
+            nonlocal total
+            result = cache.get(args)
+            if result is not None:
+                cache.move_to_end(args)
+                return result
+            result = function(*args)
+            size = len(result.points) + 4 * len(result.beziers)
+            if size > maxPoints:
+                return result
+            cache[args] = result
+            sizes[args] = size
+            total += size
+            while total > maxPoints:
+                oldest, _ = cache.popitem(last=False)
+                total -= sizes.pop(oldest)
+            return result
+
+        def cache_clear():
+            nonlocal total
+            cache.clear()
+            sizes.clear()
+            total = 0
+
+        cached.cache_clear = cache_clear
+        cached.cache_points = lambda: total
+        return cached
+    return decorate
+
+@pointCache(maxPoints=1000000)
+def flattenOutline(commands, shape, curveIncrement, curveTolerance):
+    """The Outline of a path given as (letter, point count) commands, their points being shape, the bytes of an (n, 2) array.
+
+    Paths that repeat the same shape, wherever they are, share one Outline.
+    """
+    points = numpy.frombuffer(shape).reshape(-1, 2).tolist()
+    beziers = []
+    index = 0
+    p0 = None
+    for letter, count in commands:
+        if letter == 'C':
+            beziers.append([p0] + points[index:index + 3])
+        if count:
+            p0 = points[index + count - 1]
+        index += count
+    if beziers:
+        samples, offsets = flattenBeziers(numpy.array(beziers, dtype=float), curveIncrement, curveTolerance)
+        samples = samples.tolist()
+
+    result = []
+    polylines = []
+    curves = []
+    index = 0
+    curve = 0
+    for letter, count in commands:
         if letter == 'M':
-            polyline = Polyline()
-            zones.polylines.append(polyline)
-            p0 = transform.apply_to_point((command.args[0], command.args[1]))
-            polyline.points.append(p0)
+            if polylines:
+                polylines[-1][1] = len(result)
+            polylines.append([len(result), None, False])
+            p0 = points[index]
+            result.append(p0)
             pInitial = p0
         if letter == 'C':
-            args = command.args
-            p1 = transform.apply_to_point((args[0], args[1]))
-            p2 = transform.apply_to_point((args[2], args[3]))
-            p3 = transform.apply_to_point((args[4], args[5]))
-            t = 0
-            while t < 1.0:
-                bez = [p0,p1,p2,p3]
-                pt = bezier.bezierpointatt(bez, t)
-                polyline.points.append(pt)
-                t += gcodeStyle.curveIncrement
-            polyline.points.append(p3)
-            polyline.closed = False
-            p0 = p3
+            first = len(result) - 1 - polylines[-1][0]
+            result.extend(samples[offsets[curve]:offsets[curve + 1]])
+            p0 = points[index + 2]
+            result.append(p0)
+            curves.append((len(polylines) - 1, first, len(result) - 1 - polylines[-1][0], curve))
+            curve += 1
+            polylines[-1][2] = False
         if letter == 'L':
-            p0 = transform.apply_to_point((command.args[0], command.args[1]))
-            polyline.points.append(p0)
-            polyline.closed = False
+            p0 = points[index]
+            result.append(p0)
+            polylines[-1][2] = False
         if letter == 'Z':
-            polyline.points.append(pInitial)
-            polyline.closed = True
-    stream.comment(f'...cspToZones: {zones}')
+            result.append(pInitial)
+            polylines[-1][2] = True
+        index += count
+    if polylines:
+        polylines[-1][1] = len(result)
+    return Outline(numpy.array(result, dtype=float).reshape(-1, 2), [tuple(polyline) for polyline in polylines],
+                   curves, numpy.array(beziers, dtype=float).reshape(-1, 4, 2))
+
+# The least recently used outlines make way for new ones once their points add up to maxPoints.
+flattenZeros = pointCache(maxPoints=5)(lambda count: Outline(numpy.zeros((count, 2)), [], [], numpy.zeros((0, 4, 2))))
+assert flattenZeros(2) is flattenZeros(2)
+flattenZeros(3)
+flattenZeros(2)
+flattenZeros(1)
+assert flattenZeros.cache_points() == 3 and flattenZeros(2) is flattenZeros(2)
+
+@instrumented('cspToZones', count=lambda zones: sum(len(polyline) for polyline in zones.polylines))
+def cspToZones(stream, path, gcodeStyle, transform):
+    zones = Zones()
+    stream.trace('cspToZones...')
+    commands = list(path)
+    if stream.isTracing():
+        for command in commands:
+            stream.trace('svg path command:"{}"', command)
+    shapeCommands = tuple((command.letter, len(command.args) // 2) for command in commands)
+    args = numpy.array([arg for command in commands for arg in command.args], dtype=float).reshape(-1, 2)
+    if not len(args):
+        stream.trace('...cspToZones: {}', zones)
+        return zones
+
+    # Flatten relative to the first point, so that translated copies of a shape share the work.
+    origin = args[0].copy()
+    (a, c, _), (b, d, _) = transform.matrix
+    tolerance = gcodeStyle.curveTolerance
+    if tolerance:
+        # Flattening before the transform; the transform can stretch the error by its largest singular value.
+        tolerance /= max(numpy.linalg.norm([[a, c], [b, d]], 2), 1e-12)
+    outline = flattenOutline(shapeCommands, (args - origin).tobytes(), gcodeStyle.curveIncrement, tolerance)
+
+    # One transform places the points and the bezier control points.
+    placed = transformPoints(transform, numpy.concatenate((outline.points, outline.beziers.reshape(-1, 2))) + origin)
+    points = placed[:len(outline.points)]
+    beziers = placed[len(outline.points):].reshape(-1, 4, 2).tolist()
+    curves = [[] for _ in outline.polylines]
+    for polyline, first, last, bezier in outline.curves:
+        curves[polyline].append((first, last, tuple(map(tuple, beziers[bezier]))))
+    zones.polylines = [Polyline(points[start:end], closed, polylineCurves)
+                       for (start, end, closed), polylineCurves in zip(outline.polylines, curves)]
+    stream.trace('...cspToZones: {}', zones)
     return zones
-    
+
+def signedArea(points):
+    """Shoelace area of the closed point list; positive when counter-clockwise (y up)."""
+    x = points[:, 0]
+    y = points[:, 1]
+    return 0.5 * float(numpy.dot(x, numpy.roll(y, -1)) - numpy.dot(numpy.roll(x, -1), y))
+
+class SegmentGrid:
+    """Uniform grid of the segments points[i] -> points[i + 1] (wrapping), for finding crossings."""
+    def __init__(self, points):
+        self.points = points
+        starts = points
+        ends = numpy.roll(points, -1, axis=0)
+        lows = numpy.minimum(starts, ends)
+        highs = numpy.maximum(starts, ends)
+        self.origin = lows.min(axis=0)
+        extent = float(max((highs.max(axis=0) - self.origin).max(), 1e-9))
+        # About one segment per cell on average.
+        self.cellSize = max(float(numpy.hypot(*(ends - starts).T).mean()), extent / 4096, 1e-9)
+        self.cells = {}
+        cellSize = self.cellSize
+        originX, originY = self.origin.tolist()
+        # Cells a segment only grazes get it too, so two segments crossing on a cell edge still meet in one.
+        slack = cellSize * 1e-6
+        for index, ((x0, y0), (x1, y1)) in enumerate(zip(starts.tolist(), ends.tolist())):
+            if x0 > x1:
+                x0, y0, x1, y1 = x1, y1, x0, y0
+            dx = x1 - x0
+            dy = y1 - y0
+            # Walk the columns the segment spans, adding the cells it crosses in each, so that a long segment
+            # costs the cells along it rather than the cells of its bounding box.
+            for cx in range(math.floor((x0 - slack - originX) / cellSize),
+                            math.floor((x1 + slack - originX) / cellSize) + 1):
+                if dx > 0:
+                    t0 = min(max((originX + cx * cellSize - x0) / dx, 0.0), 1.0)
+                    t1 = min(max((originX + (cx + 1) * cellSize - x0) / dx, 0.0), 1.0)
+                else:
+                    t0, t1 = 0.0, 1.0
+                ya, yb = y0 + dy * t0, y0 + dy * t1
+                if ya > yb:
+                    ya, yb = yb, ya
+                for cy in range(math.floor((ya - slack - originY) / cellSize),
+                                math.floor((yb + slack - originY) / cellSize) + 1):
+                    self.cells.setdefault((cx, cy), []).append(index)
+
+    def crossings(self):
+        """All (i, ti, j, tj, point) where non-adjacent segments i < j cross at their parameters ti and tj."""
+        points = self.points.tolist()
+        count = len(points)
+        seen = set()
+        result = []
+        for members in self.cells.values():
+            for a in range(len(members)):
+                i = members[a]
+                for b in range(a + 1, len(members)):
+                    j = members[b]
+                    if i > j:
+                        i, j = j, i
+                    if j - i < 2 or (i == 0 and j == count - 1) or (i, j) in seen:
+                        i = members[a]
+                        continue
+                    seen.add((i, j))
+                    crossing = segmentCrossing(points[i], points[(i + 1) % count], points[j], points[(j + 1) % count])
+                    if crossing is not None:
+                        result.append((i, crossing[0], j, crossing[1], crossing[2]))
+                    i = members[a]
+        return result
+
+def segmentCrossing(p0, p1, q0, q1):
+    """(t, u, point) where p0 + t(p1 - p0) == q0 + u(q1 - q0) for t and u in [0, 1), else None."""
+    rx, ry = p1[0] - p0[0], p1[1] - p0[1]
+    sx, sy = q1[0] - q0[0], q1[1] - q0[1]
+    denominator = rx * sy - ry * sx
+    if denominator == 0:
+        return None
+    qpx, qpy = q0[0] - p0[0], q0[1] - p0[1]
+    t = (qpx * sy - qpy * sx) / denominator
+    u = (qpx * ry - qpy * rx) / denominator
+    if 0 <= t < 1 and 0 <= u < 1:
+        return t, u, (p0[0] + t * rx, p0[1] + t * ry)
+    return None
+
+def rawOffset(points, distance, tolerance):
+    """Offset each edge of a counter-clockwise closed point list outward by distance (inward if negative).
+
+    Vertices where the offset edges separate get round joins; where they overlap
+    the edges are simply connected, leaving loops for splitLoops to remove.
+    """
+    edges = numpy.roll(points, -1, axis=0) - points
+    lengths = numpy.hypot(edges[:, 0], edges[:, 1])
+    normals = numpy.stack((edges[:, 1], -edges[:, 0]), axis=-1) / lengths[:, None]
+    starts = points + normals * distance
+    ends = numpy.roll(points, -1, axis=0) + normals * distance
+    radius = abs(distance)
+    angleStep = 2 * math.acos(max(-1.0, 1 - tolerance / radius)) if tolerance < radius else math.pi / 2
+    result = []
+    count = len(points)
+    for i in range(count):
+        result.append(starts[i].tolist())
+        result.append(ends[i].tolist())
+        following = (i + 1) % count
+        turn = edges[i, 0] * edges[following, 1] - edges[i, 1] * edges[following, 0]
+        if turn * distance > 0:
+            # The offset edges separate here: arc around the vertex.
+            vertex = points[following]
+            side = math.copysign(1, distance)
+            a0 = math.atan2(side * normals[i, 1], side * normals[i, 0])
+            a1 = math.atan2(side * normals[following, 1], side * normals[following, 0])
+            sweep = (a1 - a0 + math.pi) % (2 * math.pi) - math.pi
+            steps = int(abs(sweep) / angleStep)
+            for step in range(1, steps + 1):
+                angle = a0 + sweep * step / (steps + 1)
+                result.append([float(vertex[0] + radius * math.cos(angle)), float(vertex[1] + radius * math.sin(angle))])
+    return numpy.array(result)
+
+def splitLoops(points):
+    """Split a self-crossing closed point list into simple loops by switching branches at every crossing."""
+    crossings = SegmentGrid(points).crossings() if len(points) > 3 else []
+    if not crossings:
+        return [points.tolist()]
+    bySegment = {}
+    for index, (i, ti, j, tj, point) in enumerate(crossings):
+        bySegment.setdefault(i, []).append((ti, index))
+        bySegment.setdefault(j, []).append((tj, index))
+    nodes = []
+    occurrences = {}
+    for segment, point in enumerate(points.tolist()):
+        nodes.append((point, None))
+        for _, index in sorted(bySegment.get(segment, ())):
+            occurrences.setdefault(index, []).append(len(nodes))
+            nodes.append((crossings[index][4], index))
+    partner = {}
+    for first, second in occurrences.values():
+        partner[first] = second
+        partner[second] = first
+
+    loops = []
+    visited = [False] * len(nodes)
+    for start in range(len(nodes)):
+        if visited[start]:
+            continue
+        loop = []
+        position = start
+        while True:
+            visited[position] = True
+            loop.append(nodes[position][0])
+            position = (partner.get(position, position) + 1) % len(nodes)
+            if position == start or visited[position]:
+                break
+        loops.append(loop)
+    return loops
+
+def distanceToPolygon(samples, points):
+    """Smallest distance from any of the (k, 2) samples to an edge of the closed (n, 2) array points."""
+    starts = points
+    edges = numpy.roll(points, -1, axis=0) - starts
+    lengthsSquared = numpy.maximum((edges * edges).sum(axis=1), 1e-300)
+    offsets = samples[:, None, :] - starts[None, :, :]
+    t = numpy.clip((offsets * edges).sum(axis=2) / lengthsSquared, 0, 1)
+    gaps = offsets - edges * t[:, :, None]
+    return float(numpy.sqrt((gaps * gaps).sum(axis=2).min()))
+
+def offsetPolygon(points, distance, tolerance):
+    """Offset a closed point list (first point repeated at the end) outward by distance, inward if negative.
+
+    Returns a list of closed point lists, in the original direction of travel;
+    an inward offset can split a shape into several or make it vanish.
+    """
+    points = numpy.array(points, dtype=float)[:-1]
+    keep = numpy.any(points != numpy.roll(points, 1, axis=0), axis=1)
+    points = points[keep]
+    if len(points) < 3:
+        return []
+    area = signedArea(points)
+    if area == 0:
+        return []
+    clockwise = area < 0
+    if clockwise:
+        points = points[::-1]
+    result = []
+    for loop in splitLoops(rawOffset(points, distance, tolerance)):
+        loop = numpy.array(loop)
+        # Reversed loops are where offset edges overlapped; slivers are rounding noise.
+        if len(loop) < 3 or signedArea(loop) <= tolerance * tolerance:
+            continue
+        # Keep loops the tool could actually follow: a full radius from the outline. Loop
+        # vertices are offset points or crossings (which may sit on an arc chord, up to
+        # tolerance inside the radius), so a few of them are enough to tell.
+        if distanceToPolygon(loop[::max(1, len(loop) // 8)], points) < abs(distance) - tolerance - 1e-9:
+            continue
+        if clockwise:
+            loop = loop[::-1]
+        result.append(numpy.concatenate((loop, loop[:1])))
+    return result
+
+def offsetZones(zones, distance, tolerance = 0.01):
+    """Offset the closed polylines of zones so the area they enclose grows by distance (shrinks if negative).
+
+    A polyline nested inside an odd number of others is a hole, and is offset the
+    opposite way. Open polylines are returned unchanged.
+    """
+    closed = [polyline for polyline in zones.polylines if polyline.closed and len(polyline) > 3]
+    result = Zones(offset=zones.offset + distance)
+    for polyline in zones.polylines:
+        if not polyline in closed:
+            result.polylines.append(polyline)
+            continue
+        first = polyline.points[0].tolist()
+        depth = sum(1 for other in closed if other is not polyline and pointInPolygon(first, other.points.tolist()))
+        sign = -1 if depth % 2 else 1
+        for points in offsetPolygon(polyline.points, distance * sign, tolerance):
+            result.polylines.append(Polyline(points, closed=True))
+    return result
+
+assert abs(signedArea(offsetPolygon([(0, 0), (10, 0), (10, 10), (0, 10), (0, 0)], -1, 0.1)[0][:-1]) - 64) < 1e-9
+assert offsetPolygon([(0, 0), (10, 0), (10, 10), (0, 10), (0, 0)], -6, 0.1) == []
@@ -0,0 +1,180 @@
+#!/usr/bin/env python
+# coding=utf-8
+#
+# Copyright (c) 2020 - Early Ehlinger, thenewentity.com
+#
+import functools
+import heapq
+import inspect
+import json
+import time
+
+# The Instrumentation collecting stats for the export in progress, or None.
+active = None
+
+# Stages whose first argument after the stream is the element being exported.
+elementStages = ('exportPath', 'exportImage')
+
+def instrumented(stage, count = None):
+    """Decorator that counts and times calls to the function as stage while an export is instrumented.
+
+    count, if given, maps the function's result to the number of points it generated.
+    When nothing is instrumented the cost is one extra call and a global lookup.
+    Generator functions are timed while they run, not while their consumer handles what they yield.
+    """
+    def decorate(function):
+        if inspect.isgeneratorfunction(function):
+            @functools.wraps(function)
+            def generatorWrapper(*args, **kwargs):
+                if active is None:
+                    return (yield from function(*args, **kwargs))
+                return (yield from active.callGenerator(stage, function, args, kwargs))
+            return generatorWrapper
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if active is None:
+                return function(*args, **kwargs)
+            return active.call(stage, count, function, args, kwargs)
+        return wrapper
+    return decorate
+
+class Stage:
+    __slots__ = ('calls', 'seconds', 'points')
+
+    def __init__(self):
+        self.calls = 0
+        self.seconds = 0.0
+        self.points = 0
+
+class Instrumentation:
+    """Wall time, calls and points per stage of one export, plus the elements that took longest.
+
+    Times are inclusive: exportPath includes cspToZones, which includes nothing
+    else, and everything includes emission except the toolpath generators
+    (contour, pocket, cutPolylineAtDepth), which only count their own resumes. A stage that calls itself, like
+    visitElement, is timed once at the outermost call. Moves and bytes are
+    counted where gcode reaches the output, so with worker processes they are
+    credited when a path's gcode is stitched back in, not to the path.
+    """
+    def __init__(self, worst = 20):
+        self.stages = {}
+        self.running = set()
+        self.worst = worst
+        self.elements = []
+        self.output = None
+        self.codes = 0
+        self.moves = 0
+        self.seconds = 0.0
+        self.started = None
+
+    def getSeconds(self):
+        if self.started is None:
+            return self.seconds
+        return self.seconds + time.perf_counter() - self.started
+
+    def start(self, output):
+        """Start collecting; output is where gcode finally goes (not a ParallelOutput)."""
+        global active
+        active = self
+        self.output = output
+        code = output.code
+        write = output.write
+        # Instance attributes shadow the methods only while instrumenting.
+        def countingCode(prefix, gcode, words, comment):
+            self.codes += 1
+            if 'X' in words or 'Y' in words or 'Z' in words:
+                self.moves += 1
+            self.call('emission', None, code, (prefix, gcode, words, comment), {})
+        output.code = countingCode
+        output.write = lambda text: self.call('emission', None, write, (text,), {})
+        self.started = time.perf_counter()
+
+    def stop(self):
+        global active
+        self.seconds = self.getSeconds()
+        self.started = None
+        active = None
+        del self.output.code
+        del self.output.write
+
+    def call(self, stage, count, function, args, kwargs):
+        stats = self.stages.get(stage)
+        if stats is None:
+            stats = self.stages[stage] = Stage()
+        stats.calls += 1
+        if stage in self.running:
+            result = function(*args, **kwargs)
+        else:
+            self.running.add(stage)
+            moves = self.moves
+            written = self.output.written
+            started = time.perf_counter()
+            try:
+                result = function(*args, **kwargs)
+            finally:
+                elapsed = time.perf_counter() - started
+                stats.seconds += elapsed
+                self.running.discard(stage)
+            if stage in elementStages:
+                self.noteElement(elapsed, stage, args[1], self.moves - moves, self.output.written - written)
+        if count is not None:
+            stats.points += count(result)
+        return result
+
+    def callGenerator(self, stage, function, args, kwargs):
+        stats = self.stages.get(stage)
+        if stats is None:
+            stats = self.stages[stage] = Stage()
+        stats.calls += 1
+        generator = function(*args, **kwargs)
+        outermost = stage not in self.running
+        while True:
+            if outermost:
+                self.running.add(stage)
+                started = time.perf_counter()
+            try:
+                record = next(generator)
+            except StopIteration as stop:
+                return stop.value
+            finally:
+                if outermost:
+                    stats.seconds += time.perf_counter() - started
+                    self.running.discard(stage)
+            yield record
+
+    def noteElement(self, seconds, stage, element, moves, written):
+        entry = (seconds, len(self.elements), element.get_id(), stage, moves, written)
+        if len(self.elements) < self.worst:
+            heapq.heappush(self.elements, entry)
+        else:
+            heapq.heappushpop(self.elements, entry)
+
+    def getReport(self):
+        return {
+            'seconds': round(self.getSeconds(), 6),
+            'codes': self.codes,
+            'moves': self.moves,
+            'bytesWritten': self.output.written if self.output else 0,
+            'stages': {name: {'calls': stats.calls, 'seconds': round(stats.seconds, 6), 'points': stats.points}
+                       for name, stats in sorted(self.stages.items())},
+            'worstElements': [{'id': id, 'stage': stage, 'seconds': round(seconds, 6), 'moves': moves, 'bytes': written}
+                              for seconds, _, id, stage, moves, written in sorted(self.elements, reverse=True)],
+        }
+
+    def writeReport(self, path, extra = None):
+        report = self.getReport()
+        report.update(extra or {})
+        with open(path, 'w', encoding='utf-8') as file:
+            json.dump(report, file, indent=2)
+            file.write('\n')
+
+    def getSummary(self):
+        """Lines for a comment block in the gcode."""
+        lines = [f'instrumentation: {self.getSeconds():.3f}s, {self.codes} codes, {self.moves} moves, '
+                 f'{self.output.written} bytes']
+        for name, stats in sorted(self.stages.items(), key=lambda item: -item[1].seconds):
+            points = f', {stats.points} points' if stats.points else ''
+            lines.append(f'  {name}: {stats.seconds:.3f}s in {stats.calls} calls{points}')
+        for seconds, _, id, stage, moves, written in sorted(self.elements, reverse=True)[:5]:
+            lines.append(f'  slowest {stage} {id}: {seconds:.3f}s, {moves} moves, {written} bytes')
+        return lines
@@ -0,0 +1,76 @@
+#!/usr/bin/env python
+# coding=utf-8
+#
+# Copyright (c) 2020 - Early Ehlinger, thenewentity.com
+#
+"""
+Typed records for the moves and comments that toolpath generators yield.
+
+Generators such as contour and pocket yield these instead of writing gcode, so
+anything can consume them: GcodeExporter.emit writes them as gcode, and stats,
+previews or tests can read the words directly. indent is the nesting level
+under whatever emits them, two spaces per level in the gcode.
+"""
+from GcodeExporter import VERBOSITY_SUMMARY, VERBOSITY_TRACE, formatComment, movedTo, wrapComment
+
+class Move:
+    """A code such as G00 or G01 with its words (X=, Y=, Z=, F=), in the order they are written.
+
+    comment is written only when tracing; it may be a (format, *args) tuple.
+    """
+    __slots__ = ('code', 'words', 'comment', 'indent')
+
+    def __init__(self, code, words, comment = None, indent = 0):
+        self.code = code
+        self.words = words
+        self.comment = comment
+        self.indent = indent
+
+    def emit(self, output, prefix, verbosity):
+        words = self.words
+        if 'X' in words or 'Y' in words:
+            output.position = movedTo(output.position, words)
+        output.code(prefix, self.code, words, formatComment(self.comment) if verbosity >= VERBOSITY_TRACE else None)
+
+    def __repr__(self):
+        return f'Move({self.code!r}, {self.words!r})'
+
+class Comment:
+    """A comment line, written when the verbosity reaches level. args are formatted into text when written."""
+    __slots__ = ('text', 'args', 'level', 'indent')
+
+    def __init__(self, text, args = (), level = VERBOSITY_SUMMARY, indent = 0):
+        self.text = text
+        self.args = args
+        self.level = level
+        self.indent = indent
+
+    def emit(self, output, prefix, verbosity):
+        if self.level <= verbosity:
+            output.write(prefix + wrapComment(self.text.format(*self.args) if self.args else self.text) + '\n')
+
+    def __repr__(self):
+        return f'Comment({self.text!r})'
+
+def rapid(comment, indent = 0, **words):
+    return Move('G00', words, comment, indent)
+
+def linear(comment, indent = 0, **words):
+    return Move('G01', words, comment, indent)
+
+def arc(comment, counterClockwise, indent = 0, **words):
+    """G02/G03 to X, Y (and Z for a helix) around the centre at I, J relative to the start."""
+    return Move('G03' if counterClockwise else 'G02', words, comment, indent)
+
+def spline(comment, indent = 0, **words):
+    """G5 cubic spline to X, Y; I, J is the first control point relative to the start, P, Q the second relative to the end."""
+    return Move('G5', words, comment, indent)
+
+def safeHeight(gcodeStyle, indent = 0, comment = 'raise cutter to safe height'):
+    return Move('G00', {'Z': gcodeStyle.safeHeight, 'F': gcodeStyle.rapidz}, comment, indent)
+
+def note(text, *args, indent = 0):
+    return Comment(text, args, VERBOSITY_SUMMARY, indent)
+
+def trace(text, *args, indent = 0):
+    return Comment(text, args, VERBOSITY_TRACE, indent)
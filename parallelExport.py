@@ -0,0 +1,144 @@
+#!/usr/bin/env python
+# coding=utf-8
+#
+# Copyright (c) 2020 - Early Ehlinger, thenewentity.com
+#
+from collections import deque
+
+from GcodeExporter import GcodeExporter, movedTo
+
+class PathCommand:
+    """A picklable stand-in for an inkex path command: letter, args and its text for trace comments."""
+    __slots__ = ('letter', 'args', 'text')
+
+    def __init__(self, letter, args, text):
+        self.letter = letter
+        self.args = args
+        self.text = text
+
+    def __str__(self):
+        return self.text
+
+class RecordingOutput:
+    """Records what is written to it so it can be replayed into another output later."""
+    parallel = False
+
+    def __init__(self, position = (0, 0)):
+        self.records = []
+        self.position = position
+
+    def write(self, text):
+        self.records.append((text,))
+
+    def code(self, prefix, code, words, comment):
+        self.records.append((prefix, code, words, comment))
+
+    def getPosition(self):
+        return self.position
+
+    def operation(self, gcodeStyle):
+        self.records.append(('operation', gcodeStyle))
+
+    def flush(self):
+        pass
+
+def replay(records, output):
+    for record in records:
+        if len(record) == 1:
+            output.write(record[0])
+        elif len(record) == 2:
+            output.operation(record[1])
+        else:
+            words = record[2]
+            if 'X' in words or 'Y' in words:
+                output.position = movedTo(output.position, words)
+            output.code(*record)
+
+def exportPathFragment(depth, verbosity, gcodeStyle, commands, matrix, position):
+    # Runs in a worker process.
+    from inkex.transforms import Transform
+    from exportPath import exportPathGeometry
+    output = RecordingOutput(position)
+    stream = GcodeExporter(None, None, depth, verbosity, output)
+    exportPathGeometry(stream, gcodeStyle, [PathCommand(*command) for command in commands], Transform(matrix))
+    return output.records
+
+class ParallelOutput:
+    """Output that hands path geometry to a process pool and stitches the results back in document order.
+
+    Writes go straight to target until a path is submitted; after that they are
+    recorded and queued behind the pending fragment. Fragments are replayed into
+    target as they complete, in order, so the result is the same as a serial export.
+    """
+    parallel = True
+
+    def __init__(self, target, executor, maxPending):
+        self.target = target
+        self.executor = executor
+        self.maxPending = maxPending
+        self.queue = deque()
+        self.pending = 0
+
+    def write(self, text):
+        if self.queue:
+            self.queue[-1].write(text)
+        else:
+            self.target.write(text)
+
+    def code(self, prefix, code, words, comment):
+        if self.queue:
+            self.queue[-1].code(prefix, code, words, comment)
+        else:
+            self.target.code(prefix, code, words, comment)
+
+    def operation(self, gcodeStyle):
+        if self.queue:
+            self.queue[-1].operation(gcodeStyle)
+        else:
+            self.target.operation(gcodeStyle)
+
+    @property
+    def position(self):
+        return self.queue[-1].position if self.queue else self.target.position
+
+    @position.setter
+    def position(self, value):
+        if self.queue:
+            self.queue[-1].position = value
+        else:
+            self.target.position = value
+
+    def getPosition(self):
+        # The tool position depends on every fragment before it.
+        self.drain(0)
+        return self.target.getPosition()
+
+    def submitPath(self, stream, gcodeStyle, csp, transform):
+        tracing = stream.isTracing()
+        commands = [(command.letter, tuple(command.args), str(command) if tracing else '') for command in csp]
+        # Only travel ordering needs to know where the tool is; don't wait for it otherwise.
+        position = self.getPosition() if gcodeStyle.travelOrder == 'nearest' else (0, 0)
+        future = self.executor.submit(exportPathFragment, stream.depth, stream.verbosity, gcodeStyle,
+                                      commands, transform.matrix, position)
+        self.queue.append(future)
+        self.queue.append(RecordingOutput())
+        self.pending += 1
+        self.drain(self.maxPending)
+        return future
+
+    def drain(self, maxPending = None):
+        """Replay finished fragments, waiting for more while over maxPending (None: never wait)."""
+        while self.queue:
+            head = self.queue[0]
+            if isinstance(head, RecordingOutput):
+                replay(head.records, self.target)
+            elif head.done() or (maxPending is not None and self.pending > maxPending):
+                replay(head.result(), self.target)
+                self.pending -= 1
+            else:
+                break
+            self.queue.popleft()
+
+    def flush(self):
+        self.drain(0)
+        self.target.flush()
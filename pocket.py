@@ -1,59 +1,97 @@
+import geometry
+
 from float_range import float_range
+from instrumentation import instrumented
+from moves import linear, note, rapid, safeHeight, trace
+
+def linkSpans(scanlines):
+    """Group the spans of each scanline into chains that can be cut without lifting.
+
+    A span is linked to one on the next scanline when they overlap and neither
+    overlaps anything else there, i.e. the pocket neither splits nor merges
+    between the two lines. Returns a list of chains, each a list of (y, x0, x1).
+    """
+    chains = []
+    previous = []
+    for y, crossings in scanlines:
+        spans = [(crossings[i], crossings[i + 1]) for i in range(0, len(crossings) - 1, 2)]
+        current = []
+        for x0, x1 in spans:
+            overlapping = [index for index, (_, px0, px1, _) in enumerate(previous) if px0 < x1 and x0 < px1]
+            chain = None
+            if len(overlapping) == 1:
+                _, px0, px1, candidate = previous[overlapping[0]]
+                if sum(1 for sx0, sx1 in spans if sx0 < px1 and px0 < sx1) == 1:
+                    chain = candidate
+            if chain is None:
+                chain = []
+                chains.append(chain)
+            chain.append((y, x0, x1))
+            current.append((y, x0, x1, chain))
+        previous = current
+    return chains
 
-def pocket(stream, gcodeStyle, zones, transform):
+def hatchAtDepth(gcodeStyle, scanlines, depth, indent = 0):
+    for y, crossings in scanlines:
+        yield trace("y:{} crossings:{}", y, crossings, indent=indent)
+        segments = indent + 1
+        # Sorted crossings alternate between entering and leaving the pocket.
+        up = True
+        for x in crossings:
+            if up:
+                yield safeHeight(gcodeStyle, segments)
+                yield rapid('rapid to start of polyline', segments, X=x, Y=y, F=gcodeStyle.rapidxy)
+                up = False
+            else:
+                yield linear('plunge', segments, Z=depth,F=gcodeStyle.feedz)
+                yield linear('scan', segments, X=x,Y=y,F=gcodeStyle.feedxy)
+                yield safeHeight(gcodeStyle, segments)
+                up = True
+
+def zigzagAtDepth(gcodeStyle, chains, depth, indent = 0):
+    for chain in chains:
+        y, x0, x1 = chain[0]
+        yield trace("chain: {} spans from y:{}", len(chain), y, indent=indent)
+        yield safeHeight(gcodeStyle, indent)
+        yield rapid('rapid to start of chain', indent, X=x0, Y=y, F=gcodeStyle.rapidxy)
+        yield linear('plunge', indent, Z=depth, F=gcodeStyle.feedz)
+        yield linear('scan', indent, X=x1, Y=y, F=gcodeStyle.feedxy)
+        x = x1
+        for nextY, nextX0, nextX1 in chain[1:]:
+            # Step over inside the overlap of the two spans, then cut the next span the other way.
+            stepX = min(max(x, max(x0, nextX0)), min(x1, nextX1))
+            if stepX != x:
+                yield linear('back to overlap', indent, X=stepX, Y=y, F=gcodeStyle.feedxy)
+            yield linear('step over', indent, X=stepX, Y=nextY, F=gcodeStyle.feedxy)
+            start, end = (nextX1, nextX0) if x == x1 else (nextX0, nextX1)
+            if start != stepX:
+                yield linear('to end of span', indent, X=start, Y=nextY, F=gcodeStyle.feedxy)
+            yield linear('scan', indent, X=end, Y=nextY, F=gcodeStyle.feedxy)
+            y, x0, x1, x = nextY, nextX0, nextX1, end
+    yield safeHeight(gcodeStyle, indent)
+
+@instrumented('pocket')
+def pocket(gcodeStyle, zones, indent = 0):
+    """Yields the moves filling the area of zones with gcodeStyle.fillMode, pass by pass."""
     if not gcodeStyle.depth:
-        stream.comment("Depth is 0. Skipping path")
+        yield trace("Depth is 0. Skipping path", indent=indent)
         return
     bounds = zones.getBounds()
-    stream.comment(f"Pocket bounds: {bounds}")
+    yield trace("Pocket bounds: {}", bounds, indent=indent)
+    if bounds.y0 is None:
+        yield trace("Nothing left to fill. Skipping pocket", indent=indent)
+        return
+    # Outlines offset for the edge mode already keep the tool inside; others are kept a tool radius away here.
+    margin = 0 if zones.offset else gcodeStyle.toolDiameter / 2.0
+    scanlines = geometry.scanlineCrossings(zones, float_range(bounds.y0 + margin, bounds.y1 - margin,
+                                                            gcodeStyle.toolStepOver))
+    if gcodeStyle.fillMode == 'zigzag':
+        chains = linkSpans(scanlines)
+        yield trace("zigzag: {} chains", len(chains), indent=indent)
+    # The fill pattern is the same at every depth, so it is computed once and replayed.
     for depth in float_range(-gcodeStyle.startDepth, -gcodeStyle.depth, -gcodeStyle.depthIncrement, True):
-        stream.comment(f"depth:{depth}")
-        streamScan = stream.indent()
-        for y in float_range(bounds.y0 + gcodeStyle.toolDiameter / 2.0, bounds.y1 - gcodeStyle.toolDiameter / 2.0, gcodeStyle.toolStepOver):
-            streamScan.comment(f"y:{y}")
-            streamSegments = streamScan.indent()
-            intersections = []
-            for polyline in zones.polylines:
-                if not polyline.closed:
-                    stream.comment("Skipping polyline because it isn't closed.")
-                    continue
-                p0n = polyline.points[0]
-                # streamSegments.comment(f"polyline:{polyline}")
-                for p1 in polyline.points[1:]:
-                    p0 = p0n
-                    p0n = p1
-                    x0, y0 = p0[0], p0[1]
-                    x1, y1 = p1[0], p1[1]
-                    if (y1 > y0):
-                        if (y < y0) or (y>y1):
-                            continue
-                        pass
-                    else:
-                        if (y < y1) or (y>y0):
-                            continue
-                        pass
-                    # https://en.wikipedia.org/wiki/Linear_interpolation
-                    # (y-y0)/(x-x0) = (y1-y0)/(x1-x0)
-                    # solving for x...
-                    # (x-x0)/(y-y0) = (x1-x0)/(y1-y0)
-                    # (x-x0) = (y-y0)(x1-x0)/(y1-y0)
-                    if y1 == y0:
-                        #intersections.append(x0)
-                        #intersections.append(x1)
-                        continue
-                    x = (y-y0)*(x1-x0)/(y1-y0) + x0
-                    intersections.append(x)
-                    streamSegments.comment(f"p0:{p0} p1:{p1} x:{x} intersections:{intersections}")
-            # at this point, intersections contains an unsorted list of x coordinates. If we sort them and alternate up/down, we should
-            # get the pattern we want.
-            up = True
-            for x in sorted(intersections):
-                if up:
-                    streamSegments.safe_height(gcodeStyle)
-                    streamSegments.rapid(comment='rapid to start of polyline', X=x, Y=y, F=gcodeStyle.rapidxy)
-                    up = False
-                else:
-                    streamSegments.linear('plunge', Z=depth,F=gcodeStyle.feedz)
-                    streamSegments.linear('scan', X=x,Y=y,F=gcodeStyle.feedxy)
-                    streamSegments.safe_height(gcodeStyle)
-                    up = True
+        yield note("depth:{}", depth, indent=indent)
+        if gcodeStyle.fillMode == 'zigzag':
+            yield from zigzagAtDepth(gcodeStyle, chains, depth, indent + 1)
+        else:
+            yield from hatchAtDepth(gcodeStyle, scanlines, depth, indent + 1)
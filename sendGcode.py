@@ -0,0 +1,351 @@
+#!/usr/bin/env python
+# coding=utf-8
+#
+# Copyright (c) 2020 - Early Ehlinger, thenewentity.com
+#
+"""
+Stream gcode to a GRBL-style controller.
+
+    python sendGcode.py --to HOST:PORT|DEVICE [--ping-pong] [--feed-override PERCENT] FILE [export options]
+    python sendGcode.py --simulate [--speed S] [--compare] FILE [export options]
+
+FILE is a gcode file, or an SVG that is exported with export-gcode.py first.
+Lines are sent with character counting, keeping the controller's receive
+buffer full, so its planner always has the next moves to look ahead to. While
+sending from a terminal, typed commands pause (p), resume (r), change the feed
+override (+, -, or a percentage) and show the controller's status (?).
+"""
+import argparse
+import asyncio
+import collections
+import io
+import os
+import sys
+import time
+
+from estimateCycleTime import MotionModel, commentRegex, defaultStyle, estimateCycleTime, formatSeconds, readGcode
+from simulatedGrbl import FEED_OVERRIDE_DOWN, FEED_OVERRIDE_FINE_DOWN, FEED_OVERRIDE_FINE_UP, FEED_OVERRIDE_RESET, \
+    FEED_OVERRIDE_UP, SimulatedGrbl
+
+def compactLine(line):
+    """line without comments or spaces, which GRBL doesn't need; '' if nothing is left."""
+    return ''.join(commentRegex.sub('', line).split())
+
+def feedOverrideCommands(percent):
+    """The real-time bytes that set GRBL's feed override to percent (10 to 200) from whatever it was."""
+    tens, ones = divmod(abs(percent - 100), 10)
+    up = percent > 100
+    return bytes([FEED_OVERRIDE_RESET] + [FEED_OVERRIDE_UP if up else FEED_OVERRIDE_DOWN] * tens
+                 + [FEED_OVERRIDE_FINE_UP if up else FEED_OVERRIDE_FINE_DOWN] * ones)
+
+def parseStatus(text):
+    """A status report such as <Run|MPos:1.000,2.000,0.000|Bf:15,127> as a dict of its state and fields."""
+    fields = text.strip('<>').split('|')
+    result = {'state': fields[0]}
+    for field in fields[1:]:
+        name, _, value = field.partition(':')
+        result[name] = value
+    return result
+
+class GcodeSender:
+    """Sends gcode lines to a GRBL-style controller over asyncio streams.
+
+    With character counting (the default) a line is sent as long as it and the
+    lines not answered yet fit in the controller's receive buffer of
+    rxBufferSize bytes, so the controller never waits for a line to cross the
+    link. pingPong sends each line only once the one before it was answered.
+    Real-time commands (pause, resume, feed override, status) don't go through
+    the buffer and work at any time.
+    """
+    def __init__(self, reader, writer, rxBufferSize = 128, pingPong = False, stopOnError = True):
+        self.reader = reader
+        self.writer = writer
+        self.rxBufferSize = rxBufferSize
+        self.pingPong = pingPong
+        self.stopOnError = stopOnError
+        # (line number, characters, line) of every line sent and not answered yet, oldest first.
+        self.pending = collections.deque()
+        self.pendingCharacters = 0
+        self.answered = asyncio.Condition()
+        self.statusReplies = collections.deque()
+        self.feedOverride = 100
+        self.messages = []
+        self.errors = []
+        self.closed = False
+        self.readTask = None
+        self.lines = 0
+        self.bytes = 0
+        self.seconds = 0.0
+
+    def start(self):
+        if self.readTask is None:
+            self.readTask = asyncio.ensure_future(self.readReplies())
+
+    async def readReplies(self):
+        while True:
+            data = await self.reader.readline()
+            if not data:
+                break
+            text = data.decode('ascii', 'replace').strip()
+            if (text == 'ok' or text.startswith('error')) and self.pending:
+                number, characters, line = self.pending.popleft()
+                self.pendingCharacters -= characters
+                if text != 'ok':
+                    self.errors.append((number, line, text))
+            elif text.startswith('<'):
+                if self.statusReplies:
+                    self.statusReplies.popleft().set_result(parseStatus(text))
+                continue
+            elif text:
+                self.messages.append(text)
+            async with self.answered:
+                self.answered.notify_all()
+        self.closed = True
+        while self.statusReplies:
+            self.statusReplies.popleft().set_exception(ConnectionError('the controller closed the connection'))
+        async with self.answered:
+            self.answered.notify_all()
+
+    def fits(self, characters):
+        if not self.pending:
+            # Even a line too long for the buffer can go on its own.
+            return True
+        return not self.pingPong and self.pendingCharacters + characters < self.rxBufferSize
+
+    def stopped(self):
+        return self.closed or bool(self.errors and self.stopOnError)
+
+    async def waitForWelcome(self, timeout = 5.0):
+        """Wait for the controller's start-up message; controllers that reset on connecting ignore lines until then."""
+        self.start()
+        async with self.answered:
+            try:
+                await asyncio.wait_for(self.answered.wait_for(
+                    lambda: self.closed or any(message.startswith('Grbl') for message in self.messages)), timeout)
+            except asyncio.TimeoutError:
+                pass
+
+    async def send(self, lines):
+        """Send lines, skipping comments and blank ones, and wait until all are answered.
+
+        Returns whether the controller accepted every line; with stopOnError, sending stops at the first error.
+        """
+        self.start()
+        started = time.perf_counter()
+        for number, line in enumerate(lines, 1):
+            line = compactLine(line)
+            if not line:
+                continue
+            characters = len(line) + 1
+            async with self.answered:
+                await self.answered.wait_for(lambda: self.stopped() or self.fits(characters))
+            if self.stopped():
+                break
+            self.pending.append((number, characters, line))
+            self.pendingCharacters += characters
+            self.writer.write(line.encode('ascii') + b'\n')
+            self.lines += 1
+            self.bytes += characters
+            await self.writer.drain()
+        async with self.answered:
+            await self.answered.wait_for(lambda: self.closed or not self.pending)
+        self.seconds += time.perf_counter() - started
+        if self.closed and self.pending:
+            raise ConnectionError('the controller closed the connection')
+        return not self.errors
+
+    def pause(self):
+        self.writer.write(b'!')
+
+    def resume(self):
+        self.writer.write(b'~')
+
+    def setFeedOverride(self, percent):
+        self.feedOverride = min(max(int(round(percent)), 10), 200)
+        self.writer.write(feedOverrideCommands(self.feedOverride))
+
+    async def status(self):
+        """The controller's status report, as parseStatus returns it."""
+        self.start()
+        reply = asyncio.get_running_loop().create_future()
+        self.statusReplies.append(reply)
+        self.writer.write(b'?')
+        return await reply
+
+    async def waitUntilIdle(self, interval = 0.1, onHold = None):
+        """Wait for the machine to finish the moves it was sent; returns the state it ends in.
+
+        A feed hold ends the wait too, unless onHold is given: then it is called
+        each time the machine goes into a hold, and the wait goes on until it's resumed.
+        """
+        holding = False
+        while True:
+            state = (await self.status())['state']
+            if state == 'Idle':
+                return state
+            if state.startswith('Hold'):
+                if onHold is None:
+                    return state
+                if not holding:
+                    onHold()
+            holding = state.startswith('Hold')
+            await asyncio.sleep(interval)
+
+    async def close(self):
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except ConnectionError:
+            pass
+        if self.readTask is not None:
+            self.readTask.cancel()
+
+    def getSummary(self):
+        rate = self.lines / self.seconds if self.seconds else 0
+        return f'{self.lines} lines, {self.bytes} bytes in {self.seconds:.2f}s ({rate:.0f} lines/s), {len(self.errors)} errors'
+
+async def openController(target, baudRate = 115200):
+    """Reader and writer streams for a controller at HOST:PORT, or on a serial device (which needs pyserial-asyncio)."""
+    host, separator, port = target.rpartition(':')
+    if separator and port.isdigit() and not os.path.exists(target):
+        return await asyncio.open_connection(host or '127.0.0.1', int(port))
+    try:
+        import serial_asyncio
+    except ImportError:
+        raise ValueError('sending to a serial device needs pyserial-asyncio; or give --to HOST:PORT')
+    return await serial_asyncio.open_serial_connection(url=target, baudrate=baudRate)
+
+def loadLines(path, exportArgs):
+    """The lines of a gcode file, or of the gcode export-gcode.py writes for an SVG with exportArgs."""
+    if not path.lower().endswith('.svg'):
+        with open(path, 'r', encoding='utf-8', errors='replace') as file:
+            return file.read().splitlines()
+    from exportBatch import loadExtension
+    extension = loadExtension()()
+    try:
+        extension.parse_arguments(exportArgs + [path])
+        extension.load_raw()
+        stream = io.BytesIO()
+        extension.save(stream)
+    finally:
+        extension.clean_up()
+    return stream.getvalue().decode('utf-8').splitlines()
+
+def controlFromKeyboard(sender):
+    """Let lines typed into the terminal control sender while it sends; POSIX only."""
+    loop = asyncio.get_running_loop()
+    async def showStatus():
+        print(await sender.status(), file=sys.stderr)
+    def command():
+        text = sys.stdin.readline().strip()
+        if text == 'p':
+            sender.pause()
+        elif text == 'r':
+            sender.resume()
+        elif text in ('+', '-'):
+            sender.setFeedOverride(sender.feedOverride + (10 if text == '+' else -10))
+        elif text.isdigit():
+            sender.setFeedOverride(int(text))
+        elif text == '?':
+            asyncio.ensure_future(showStatus())
+            return
+        else:
+            print('p pauses, r resumes, + and - change the feed override by 10%, a number sets it, ? shows the status',
+                  file=sys.stderr)
+            return
+        print(f'feed override {sender.feedOverride}%', file=sys.stderr)
+    try:
+        loop.add_reader(sys.stdin.fileno(), command)
+    except (NotImplementedError, ValueError):
+        return False
+    return True
+
+async def sendTo(reader, writer, lines, options, pingPong):
+    sender = GcodeSender(reader, writer, options.rx_buffer, pingPong, not options.keep_going)
+    controlled = not options.compare and sys.stdin.isatty() and controlFromKeyboard(sender)
+    try:
+        await sender.waitForWelcome()
+        if options.feed_override != 100:
+            sender.setFeedOverride(options.feed_override)
+        await sender.send(lines)
+        def remindHold():
+            print('every line is sent but the machine is in feed hold; r resumes', file=sys.stderr)
+        state = await sender.waitUntilIdle(0.05 if options.simulate else 0.5, remindHold if controlled else None)
+        if state != 'Idle':
+            print(f'every line is sent; left the machine in {state}', file=sys.stderr)
+    finally:
+        if controlled:
+            asyncio.get_running_loop().remove_reader(sys.stdin.fileno())
+        await sender.close()
+    return sender
+
+async def simulate(lines, options, model, pingPong):
+    simulator = SimulatedGrbl(model, options.speed, options.baud, options.latency, options.rx_buffer)
+    server = await simulator.serve()
+    try:
+        reader, writer = await asyncio.open_connection(*simulator.address)
+        sender = await sendTo(reader, writer, lines, options, pingPong)
+    finally:
+        server.close()
+        await server.wait_closed()
+    return sender, simulator.getStats()
+
+async def run(options, lines):
+    model = MotionModel(options.acceleration, options.z_acceleration, options.junction_deviation, options.rapid,
+                        options.z_rapid)
+    failed = False
+    if options.simulate or options.compare:
+        planned = estimateCycleTime(readGcode(lines), model)['seconds']
+        for pingPong in ((True, False) if options.compare else (options.ping_pong,)):
+            sender, stats = await simulate(lines, options, model, pingPong)
+            print(f'{"ping-pong" if pingPong else "character counting"}: {sender.getSummary()}; machine '
+                  f'{formatSeconds(stats["machineSeconds"])} ({formatSeconds(planned)} if never starved), '
+                  f'{stats["starvedStops"]} stops and {stats["starvedSeconds"]:.1f}s waiting for moves')
+            if stats['lagSeconds'] > 0.1:
+                print(f'  the simulation often fell {stats["lagSeconds"]:.2f}s behind the machine; try a lower --speed',
+                      file=sys.stderr)
+            if stats['rxOverflows']:
+                print(f'  {stats["rxOverflows"]} bytes overflowed the receive buffer', file=sys.stderr)
+            failed = failed or bool(sender.errors) or stats['rxOverflows'] > 0
+    else:
+        reader, writer = await openController(options.to, options.baud)
+        sender = await sendTo(reader, writer, lines, options, options.ping_pong)
+        print(sender.getSummary())
+        failed = bool(sender.errors)
+    for number, line, error in sender.errors:
+        print(f'line {number}: {line}: {error}', file=sys.stderr)
+    return 1 if failed else 0
+
+def main(args = None):
+    parser = argparse.ArgumentParser(description='Stream gcode to a GRBL-style controller.',
+                                     epilog='Other options are passed on to export-gcode.py when FILE is an SVG.')
+    parser.add_argument('input', metavar='FILE', help='gcode file, or SVG to export first')
+    parser.add_argument('--to', help='HOST:PORT of the controller, or its serial device')
+    parser.add_argument('--baud', type=int, default=115200, help='Baud rate of the serial link')
+    parser.add_argument('--rx-buffer', type=int, default=128, help="Size of the controller's receive buffer in bytes")
+    parser.add_argument('--ping-pong', action='store_true', help='Send each line only once the last one was answered')
+    parser.add_argument('--feed-override', type=int, default=100, help='Feed override to start with, 10 to 200 (%%)')
+    parser.add_argument('--keep-going', action='store_true', help='Keep sending after the controller reports an error')
+    parser.add_argument('--simulate', action='store_true', help='Send to a controller simulated in this process')
+    parser.add_argument('--compare', action='store_true', help='Simulate ping-pong and character counting and compare')
+    parser.add_argument('--speed', type=float, default=10.0,
+                        help='How many times faster than real time the simulated machine runs')
+    parser.add_argument('--latency', type=float, default=0.004,
+                        help='Seconds a reply from the simulated controller takes to arrive')
+    parser.add_argument('--acceleration', type=float, default=500.0, help='Simulated X and Y acceleration in mm/s²')
+    parser.add_argument('--z-acceleration', type=float, default=200.0, help='Simulated Z acceleration in mm/s²')
+    parser.add_argument('--junction-deviation', type=float, default=0.01, help='Simulated junction deviation in mm')
+    parser.add_argument('--rapid', type=float, default=defaultStyle.rapidxy, help='Simulated X and Y rapid rate in mm/min')
+    parser.add_argument('--z-rapid', type=float, default=defaultStyle.rapidz, help='Simulated Z rapid rate in mm/min')
+    options, exportArgs = parser.parse_known_args(args)
+    if not options.to and not options.simulate and not options.compare:
+        parser.error('give --to, --simulate or --compare')
+    return asyncio.run(run(options, loadLines(options.input, exportArgs)))
+
+assert feedOverrideCommands(100) == bytes([FEED_OVERRIDE_RESET])
+assert feedOverrideCommands(123) == bytes([FEED_OVERRIDE_RESET] + [FEED_OVERRIDE_UP] * 2 + [FEED_OVERRIDE_FINE_UP] * 3)
+assert feedOverrideCommands(10) == bytes([FEED_OVERRIDE_RESET] + [FEED_OVERRIDE_DOWN] * 9)
+assert compactLine('  G01 X1.00000 Y2.00000 F635.00000 (cut)') == 'G01X1.00000Y2.00000F635.00000'
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+# coding=utf-8
+#
+# Copyright (c) 2020 - Early Ehlinger, thenewentity.com
+#
+"""
+A GRBL-style controller simulated in-process on a local socket, so gcode
+senders can be tried and benchmarked without a machine.
+
+    simulator = SimulatedGrbl(speed=20)
+    server = await simulator.serve()      # then connect to simulator.address
+
+It models what makes streaming fast or slow: a serial link of baudRate that
+delivers bytes into a 128 byte receive buffer, replies that arrive latency
+seconds after the line that caused them, a planner of plannerSize moves and
+motion timed by estimateCycleTime's model. Like GRBL, the move in progress is
+planned again as moves arrive until it starts slowing down; a move with nothing
+after it in the planner by then stops at its end.
+Everything runs speed times faster than real time, and the stats are in
+machine seconds.
+
+Real-time commands: ? (status report), ! (feed hold, at the end of the move in
+progress), ~ (resume) and the feed overrides 0x90 to 0x94.
+"""
+import asyncio
+import collections
+import math
+
+import numpy
+
+from estimateCycleTime import MotionModel, commentRegex, defaultStyle, moveGeometry, motionCodes, parseWords, plan
+
+FEED_OVERRIDE_RESET = 0x90
+FEED_OVERRIDE_UP = 0x91
+FEED_OVERRIDE_DOWN = 0x92
+FEED_OVERRIDE_FINE_UP = 0x93
+FEED_OVERRIDE_FINE_DOWN = 0x94
+feedOverrideSteps = {FEED_OVERRIDE_UP: 10, FEED_OVERRIDE_DOWN: -10, FEED_OVERRIDE_FINE_UP: 1, FEED_OVERRIDE_FINE_DOWN: -1}
+realtimeCommands = frozenset(b'?!~') | frozenset(range(FEED_OVERRIDE_RESET, FEED_OVERRIDE_FINE_DOWN + 1))
+
+welcome = "Grbl 1.1h ['$' for help]"
+
+# Real seconds before a deadline to stop sleeping and yield to the event loop instead: its timers are only good to
+# a millisecond or so, which is a long time at high speed.
+timerSlack = 0.002
+
+def axisLimit(direction, xyLimit, zLimit):
+    """The largest rate along direction within xyLimit across X and Y and zLimit along Z; one move's
+    estimateCycleTime.axisAccelerations or moveFeeds."""
+    xyShare = math.hypot(direction[0], direction[1])
+    zShare = abs(direction[2])
+    return min(xyLimit / xyShare if xyShare else math.inf, zLimit / zShare if zShare else math.inf)
+
+class Block:
+    """A move in the planner: the row estimateCycleTime's plan needs, and where it ends.
+
+    Blocks are made one line at a time, so lines are worked out directly; only arcs and splines go through
+    estimateCycleTime.moveGeometry.
+    """
+    __slots__ = ('rapid', 'length', 'feed', 'acceleration', 'startDirection', 'endDirection', 'radius', 'end')
+
+    def __init__(self, mode, start, words, model):
+        end = (words.get('X', start[0]), words.get('Y', start[1]), words.get('Z', start[2]))
+        if mode in (0, 1):
+            delta = (end[0] - start[0], end[1] - start[1], end[2] - start[2])
+            length = math.sqrt(delta[0] * delta[0] + delta[1] * delta[1] + delta[2] * delta[2])
+            direction = tuple(value / length for value in delta) if length > 0 else (0.0, 0.0, 0.0)
+            self.length = length
+            self.startDirection = self.endDirection = direction
+            self.radius = math.inf
+        else:
+            offsets = [[words.get(letter, 0.0) for letter in 'IJPQ']]
+            lengths, _, startDirections, endDirections, radii = moveGeometry(
+                numpy.array([mode]), numpy.array([start]), numpy.array([end]), numpy.array(offsets))
+            self.length = float(lengths[0])
+            self.startDirection = tuple(startDirections[0].tolist())
+            self.endDirection = tuple(endDirections[0].tolist())
+            self.radius = float(radii[0])
+        self.rapid = mode == 0
+        # Rapids run at the rapid rates whatever F says.
+        feed = axisLimit(self.startDirection, model.rapid, model.zRapid) if self.rapid \
+            else words.get('F', defaultStyle.feedxy)
+        self.feed = feed / 60.0
+        self.acceleration = axisLimit(self.startDirection, model.acceleration, model.zAcceleration)
+        self.end = end
+
+class SimulatedGrbl:
+    def __init__(self, model = None, speed = 1.0, baudRate = 115200, latency = 0.004, rxBufferSize = 128,
+                 plannerSize = 15):
+        self.model = model or MotionModel()
+        self.speed = speed
+        self.byteSeconds = 10.0 / baudRate
+        self.latency = latency
+        # A ring buffer holds one byte less than its size.
+        self.rxCapacity = rxBufferSize - 1
+        self.plannerSize = plannerSize
+        self.address = None
+        self.rx = bytearray()
+        self.planner = collections.deque()
+        self.changed = asyncio.Event()
+        self.holding = False
+        self.feedOverride = 100
+        self.mode = 0
+        self.position = (0.0, 0.0, 0.0)
+        self.feed = None
+        self.machinePosition = (0.0, 0.0, 0.0)
+        self.exitSpeed = 0.0
+        self.moving = False
+        self.writer = None
+        self.tasks = []
+        # Stats, in machine seconds.
+        self.lines = 0
+        self.blocks = 0
+        self.overflows = 0
+        self.firstStart = None
+        self.lastEnd = None
+        self.starvedStops = 0
+        self.starvedSeconds = 0.0
+        self.lags = []
+
+    def now(self):
+        return asyncio.get_running_loop().time() * self.speed
+
+    async def sleepUntil(self, machineTime, event = None):
+        """Wait until machineTime, or until event is set; returns whether machineTime came."""
+        while True:
+            delay = (machineTime - self.now()) / self.speed
+            if delay <= 0:
+                return True
+            if event is not None and event.is_set():
+                return False
+            if delay <= timerSlack:
+                await asyncio.sleep(0)
+            elif event is None:
+                await asyncio.sleep(delay - timerSlack)
+            else:
+                try:
+                    await asyncio.wait_for(event.wait(), delay - timerSlack)
+                except asyncio.TimeoutError:
+                    pass
+
+    async def serve(self, host = '127.0.0.1', port = 0):
+        """Listen for a sender on host:port (port 0 picks a free one, see address); returns the asyncio server."""
+        server = await asyncio.start_server(self.handle, host, port)
+        self.address = server.sockets[0].getsockname()[:2]
+        return server
+
+    async def handle(self, reader, writer):
+        self.writer = writer
+        self.reply(welcome)
+        self.tasks = [asyncio.ensure_future(self.parse()), asyncio.ensure_future(self.execute())]
+        try:
+            await self.receive(reader)
+        finally:
+            for task in self.tasks:
+                task.cancel()
+            writer.close()
+
+    def reply(self, text):
+        # Replies cross the link latency seconds later, in order.
+        data = (text + '\r\n').encode('ascii')
+        asyncio.get_running_loop().call_later(self.latency / self.speed, self.writer.write, data)
+
+    async def receive(self, reader):
+        arrival = self.now()
+        while True:
+            data = await reader.read(4096)
+            if not data:
+                return
+            # The serial link delivers byte by byte at the baud rate.
+            arrival = max(arrival, self.now()) + len(data) * self.byteSeconds
+            await self.sleepUntil(arrival)
+            for byte in data:
+                if byte in realtimeCommands:
+                    self.realtime(byte)
+                elif len(self.rx) < self.rxCapacity:
+                    self.rx.append(byte)
+                else:
+                    # A real controller drops the byte and the line is garbled.
+                    self.overflows += 1
+            self.changed.set()
+
+    def realtime(self, byte):
+        if byte == ord('?'):
+            self.reply(self.status())
+        elif byte == ord('!'):
+            self.holding = True
+        elif byte == ord('~'):
+            self.holding = False
+        elif byte == FEED_OVERRIDE_RESET:
+            self.feedOverride = 100
+        else:
+            self.feedOverride = min(max(self.feedOverride + feedOverrideSteps[byte], 10), 200)
+
+    def status(self):
+        state = 'Hold:0' if self.holding else 'Run' if self.moving or self.planner else 'Idle'
+        x, y, z = self.machinePosition
+        feed = self.feed if self.feed is not None else 0
+        return (f'<{state}|MPos:{x:.3f},{y:.3f},{z:.3f}|Bf:{self.plannerSize - len(self.planner)},'
+                f'{self.rxCapacity - len(self.rx)}|FS:{feed:.0f},0|Ov:{self.feedOverride},100,100>')
+
+    async def parse(self):
+        """Move complete lines from the receive buffer into the planner, answering each with ok."""
+        while True:
+            end = self.rx.find(b'\n')
+            if end < 0 or len(self.planner) >= self.plannerSize:
+                self.changed.clear()
+                await self.changed.wait()
+                continue
+            line = self.rx[:end].decode('ascii', 'replace')
+            del self.rx[:end + 1]
+            self.lines += 1
+            self.reply(self.parseLine(line))
+            self.changed.set()
+
+    def parseLine(self, line):
+        axes = {}
+        for letter, value in parseWords(commentRegex.sub('', line)):
+            if letter == 'G':
+                if value in motionCodes:
+                    self.mode = int(value)
+            elif letter == 'F':
+                self.feed = value
+            elif letter != 'N':
+                axes[letter] = value
+        if 'X' in axes or 'Y' in axes or 'Z' in axes:
+            if self.feed is not None:
+                axes['F'] = self.feed
+            block = Block(self.mode, self.position, axes, self.model)
+            self.position = block.end
+            if block.length > 1e-9:
+                self.planner.append(block)
+                self.blocks += 1
+        return 'ok'
+
+    def planHead(self, entrySpeed):
+        """Seconds the first block in the planner takes, the speed it ends at and the seconds it spends slowing
+        down to it, knowing only the blocks in the planner."""
+        blocks = self.planner
+        override = self.feedOverride / 100.0
+        # Feed overrides don't apply to rapids.
+        feeds = numpy.array([block.feed if block.rapid else block.feed * override for block in blocks])
+        seconds, speeds, peaks = plan(numpy.array([block.length for block in blocks]), feeds,
+                               numpy.array([block.acceleration for block in blocks]),
+                               numpy.array([block.startDirection for block in blocks]),
+                               numpy.array([block.endDirection for block in blocks]),
+                               numpy.array([block.radius for block in blocks]), self.model, entrySpeed)
+        return float(seconds[0]), float(speeds[1]), float((peaks[0] - speeds[1]) / blocks[0].acceleration)
+
+    async def execute(self):
+        # Machine time the move in progress ends at, None while idle, and when the planner last ran dry.
+        clock = None
+        idleSince = None
+        while True:
+            if not self.planner or self.holding:
+                if clock is not None:
+                    self.moving = False
+                    self.exitSpeed = 0.0
+                    # Time spent holding isn't the sender's fault.
+                    idleSince = None if self.holding else clock
+                    clock = None
+                self.changed.clear()
+                await self.changed.wait()
+                continue
+            if clock is None:
+                # Start again from now; while moving, the clock runs on from move to move however late the loop wakes.
+                clock = self.now()
+                if idleSince is not None:
+                    self.starvedSeconds += max(clock - idleSince, 0.0)
+                if self.firstStart is None:
+                    self.firstStart = clock
+            self.moving = True
+            started = clock
+            seconds, exitSpeed, slowing = self.planHead(self.exitSpeed)
+            clock = started + seconds
+            planned = len(self.planner)
+            while True:
+                self.changed.clear()
+                if await self.sleepUntil(clock, self.changed):
+                    break
+                # Like GRBL, replan the move in progress with the moves that came since, unless it's already
+                # slowing down.
+                if len(self.planner) > planned and self.now() < clock - slowing:
+                    seconds, exitSpeed, slowing = self.planHead(self.exitSpeed)
+                    clock = started + seconds
+                    planned = len(self.planner)
+            self.lags.append(self.now() - clock)
+            self.exitSpeed = exitSpeed
+            block = self.planner.popleft()
+            self.machinePosition = block.end
+            self.lastEnd = clock
+            if planned == 1:
+                # It stopped for want of the next move.
+                self.starvedStops += 1
+            self.changed.set()
+
+    def getStats(self):
+        """Machine seconds from the first move to the last, and how much of that the planner ran dry."""
+        return {
+            'lines': self.lines,
+            'moves': self.blocks,
+            'machineSeconds': (self.lastEnd - self.firstStart) if self.firstStart is not None else 0.0,
+            # The last move always stops with nothing after it.
+            'starvedStops': max(self.starvedStops - 1, 0),
+            'starvedSeconds': self.starvedSeconds,
+            'rxOverflows': self.overflows,
+            # How far behind the machine the simulation ended one move in ten; one-off stalls of the process don't
+            # count, but lagging like this all the time means speed is too high.
+            'lagSeconds': float(numpy.percentile(self.lags, 90)) if self.lags else 0.0,
+        }
@@ -0,0 +1,242 @@
+#!/usr/bin/env python
+# coding=utf-8
+#
+# Copyright (c) 2020 - Early Ehlinger, thenewentity.com
+#
+"""
+Plan a whole export by tool, so each tool is loaded once.
+
+Exporters mark the gcode of each element's toolpath as an operation with
+output.operation(gcodeStyle) ... output.operation(None). ToolPlanOutput records
+the operations and, when flushed, writes them grouped by -gcode-tool, with a
+tool change before each group or each group as a program of its own.
+"""
+import contextlib
+import numpy
+import re
+
+from GcodeStyle import GcodeStyle
+from GcodeExporter import VERBOSITY_SUMMARY, VERBOSITY_TRACE, movedTo, wrapComment
+from geometry import segmentLength
+from parallelExport import RecordingOutput, replay
+from travelOrder import TravelItem, orderByTravel
+
+prefix = '  '
+
+class Operation:
+    """The recorded gcode of one element's toolpath, with the comments written before it.
+
+    start and end are the first and last X/Y it moves to, and bounds the box around all of them.
+    """
+    __slots__ = ('gcodeStyle', 'records', 'start', 'end', 'bounds')
+
+    def __init__(self, gcodeStyle, records, position):
+        self.gcodeStyle = gcodeStyle
+        self.records = records
+        self.start = None
+        self.end = position
+        self.bounds = None
+
+    def moveTo(self, x, y):
+        if self.bounds is None:
+            self.start = (x, y)
+            self.bounds = [x, y, x, y]
+        else:
+            bounds = self.bounds
+            bounds[0] = min(bounds[0], x)
+            bounds[1] = min(bounds[1], y)
+            bounds[2] = max(bounds[2], x)
+            bounds[3] = max(bounds[3], y)
+        self.end = (x, y)
+
+    def getStart(self):
+        return self.start or self.end
+
+def addBoundsContainment(items):
+    """Make each item follow the items whose moves lie within its bounds, so inner cuts come first."""
+    boxed = sorted((item for item in items if item.payload.bounds is not None), key=lambda item: item.payload.bounds[0])
+    if not boxed:
+        return
+    bounds = numpy.array([item.payload.bounds for item in boxed])
+    lefts = bounds[:, 0]
+    for outer, (x0, y0, x1, y1) in zip(boxed, bounds.tolist()):
+        first = numpy.searchsorted(lefts, x0, 'left')
+        candidates = bounds[first:numpy.searchsorted(lefts, x1, 'right')]
+        inside = (candidates[:, 2] <= x1) & (candidates[:, 1] >= y0) & (candidates[:, 3] <= y1) & \
+            ((candidates[:, 0] != x0) | (candidates[:, 1] != y0) | (candidates[:, 2] != x1) | (candidates[:, 3] != y1))
+        outer.mustFollow.extend(boxed[first + index] for index in numpy.flatnonzero(inside).tolist())
+
+def orderOperations(operations, start):
+    """Order the operations of one tool shallowest first, and those at the same depth for shorter travel."""
+    byDepth = {}
+    for operation in operations:
+        byDepth.setdefault(operation.gcodeStyle.depth, []).append(operation)
+    result = []
+    position = start
+    for depth in sorted(byDepth):
+        items = [TravelItem(operation, [operation.getStart()], exit=operation.end) for operation in byDepth[depth]]
+        addBoundsContainment(items)
+        items, _, _ = orderByTravel(items, position)
+        result.extend(item.payload for item in items)
+        position = result[-1].end
+    return result
+
+def planGroups(operations, start):
+    """The operations grouped by tool, as (tool, operations) pairs in the order they are cut.
+
+    Tools whose deepest cut is shallowest go first, so parts aren't cut free before the other tools are done on them.
+    """
+    groups = {}
+    for operation in operations:
+        groups.setdefault(operation.gcodeStyle.tool, []).append(operation)
+    ordered = sorted(groups.items(), key=lambda group: max(operation.gcodeStyle.depth for operation in group[1]))
+    result = []
+    position = start
+    for tool, group in ordered:
+        group = orderOperations(group, position)
+        result.append((tool, group))
+        position = group[-1].end
+    return result
+
+def toolNumbers(groups):
+    """T numbers by tool: -gcode-tool-{tool}-number where it's set, else the lowest numbers left, in order."""
+    numbers = {tool: group[0].gcodeStyle.toolNumber for tool, group in groups}
+    taken = set(numbers.values())
+    available = (number for number in range(1, len(numbers) + len(taken) + 1) if number not in taken)
+    return {tool: number if number is not None else next(available) for tool, number in numbers.items()}
+
+def rapidDistance(operations, start):
+    result = 0
+    position = start
+    for operation in operations:
+        result += segmentLength(position, operation.getStart())
+        position = operation.end
+    return result
+
+def toolFileName(tool):
+    return re.sub(r'[^\w.-]+', '_', tool)
+
+class ToolPlanOutput:
+    """Output that records a whole export and writes it grouped by tool when flushed.
+
+    Whatever is written before the first call to operation (setting up the
+    machine) is written first, and whatever is left after the last operation
+    (ending the program) last; anything else outside operations, such as the
+    comments naming an element, goes with the operation after it. Each group
+    starts with a tool change (M06), unless openTarget is given: then the first
+    group is written to target and every other one to the output openTarget(tool,
+    number) yields with its file name, as a complete program without tool changes.
+    """
+    parallel = False
+
+    def __init__(self, target, verbosity, openTarget = None):
+        self.target = target
+        self.verbosity = verbosity
+        self.openTarget = openTarget
+        self.position = target.position
+        self.prologue = None
+        self.loose = []
+        self.operations = []
+        self.current = None
+
+    def write(self, text):
+        (self.current.records if self.current else self.loose).append((text,))
+
+    def code(self, prefix, code, words, comment):
+        if self.current:
+            self.current.records.append((prefix, code, words, comment))
+            if 'X' in words or 'Y' in words:
+                self.current.moveTo(*movedTo(self.current.end, words))
+        else:
+            self.loose.append((prefix, code, words, comment))
+
+    def operation(self, gcodeStyle):
+        if self.prologue is None:
+            self.prologue, self.loose = self.loose, []
+        if gcodeStyle is None:
+            self.current = None
+            return
+        self.current = Operation(gcodeStyle, self.loose, self.position)
+        self.operations.append(self.current)
+        self.loose = []
+
+    def getPosition(self):
+        return self.position
+
+    def comment(self, target, text, *args):
+        if self.verbosity >= VERBOSITY_SUMMARY:
+            target.write(prefix + wrapComment(text.format(*args)) + '\n')
+
+    def changeTool(self, target, tool, number, gcodeStyle):
+        self.comment(target, 'tool change: T{} {}, {}mm diameter', number, tool, gcodeStyle.toolDiameter)
+        target.code(prefix, 'G00', {'Z': gcodeStyle.safeHeight, 'F': gcodeStyle.rapidz},
+                    'raise cutter to safe height' if self.verbosity >= VERBOSITY_TRACE else None)
+        target.code(prefix, f'T{number} M06', {}, 'change tool' if self.verbosity >= VERBOSITY_TRACE else None)
+
+    def writeOperations(self, target, operations):
+        for operation in operations:
+            replay(operation.records, target)
+
+    def flush(self):
+        prologue = self.prologue or []
+        operations = self.operations
+        epilogue = self.loose
+        self.prologue = self.current = None
+        self.loose = []
+        self.operations = []
+        if operations:
+            self.writePlan(prologue, operations, epilogue)
+        else:
+            replay(prologue + epilogue, self.target)
+        self.target.flush()
+
+    def writePlan(self, prologue, operations, epilogue):
+        target = self.target
+        start = target.getPosition()
+        groups = planGroups(operations, start)
+        numbers = toolNumbers(groups)
+        documentChanges = sum(1 for index, operation in enumerate(operations)
+                              if not index or operation.gcodeStyle.tool != operations[index - 1].gcodeStyle.tool)
+        replay(prologue, target)
+        rapids = (rapidDistance(operations, start),
+                  rapidDistance([operation for _, group in groups for operation in group], start))
+        if self.openTarget is None:
+            self.comment(target, 'tool plan: {} operations, {} tools, {} tool changes instead of {}, '
+                         'rapids {:.1f}mm -> {:.1f}mm', len(operations), len(groups), len(groups), documentChanges, *rapids)
+        else:
+            # Each file loads its one tool, so there are no tool changes at all.
+            self.comment(target, 'tool plan: {} operations, {} tools in {} files, 0 tool changes instead of {}, '
+                         'rapids {:.1f}mm -> {:.1f}mm', len(operations), len(groups), len(groups), documentChanges, *rapids)
+        for index, (tool, group) in enumerate(groups):
+            number = numbers[tool]
+            gcodeStyle = group[0].gcodeStyle
+            if self.openTarget is None:
+                self.changeTool(target, tool, number, gcodeStyle)
+            elif index:
+                with self.openTarget(tool, number) as (toolTarget, name):
+                    self.comment(target, 'tool T{} {}: {} operations written to {}', number, tool, len(group), name)
+                    replay(prologue, toolTarget)
+                    self.comment(toolTarget, 'tool: T{} {}, {}mm diameter', number, tool, gcodeStyle.toolDiameter)
+                    self.writeOperations(toolTarget, group)
+                    replay(epilogue, toolTarget)
+                continue
+            else:
+                self.comment(target, 'tool: T{} {}, {}mm diameter', number, tool, gcodeStyle.toolDiameter)
+            self.writeOperations(target, group)
+        replay(epilogue, target)
+
+def planComment(files):
+    """The tool plan comment for two operations of different tools, written to files or not."""
+    @contextlib.contextmanager
+    def openTarget(tool, number):
+        yield RecordingOutput(), f'{tool}.gcode'
+    output = ToolPlanOutput(RecordingOutput(), VERBOSITY_SUMMARY, openTarget if files else None)
+    for tool in ('a', 'b'):
+        output.operation(GcodeStyle({'-gcode-tool': tool, '-gcode-depth': '1'}))
+        output.code('', 'G01', {'X': 1.0, 'Y': 1.0}, None)
+        output.operation(None)
+    output.flush()
+    return next(record[0] for record in output.target.records if 'tool plan' in record[0])
+
+assert '2 tools, 2 tool changes instead of 2' in planComment(False)
+assert '2 tools in 2 files, 0 tool changes instead of 2' in planComment(True)
@@ -0,0 +1,230 @@
+import bisect
+import math
+
+from geometry import Polyline, pointInPolygon, segmentLength
+
+class TravelItem:
+    """Something to cut, as far as travel ordering is concerned.
+
+    entries are the points the cut may start at. A closed item ends where it
+    starts, so any entry works; an open item always starts at entries[0] and
+    ends at exit. Items in mustFollow are cut before this one.
+    """
+    def __init__(self, payload, entries, exit = None, closed = False):
+        self.payload = payload
+        self.entries = entries
+        self.closed = closed
+        self.entry = 0
+        self.exit = exit if exit is not None else entries[-1]
+        self.mustFollow = []
+
+    def start(self):
+        return self.entries[self.entry]
+
+    def end(self):
+        return self.start() if self.closed else self.exit
+
+    def nearestEntry(self, point):
+        if self.closed:
+            self.entry = min(range(len(self.entries)), key=lambda i: segmentLength(point, self.entries[i]))
+        return self.start()
+
+class EntryGrid:
+    """Uniform grid over the entry points of items, for nearest-entry queries."""
+    def __init__(self, items):
+        points = [point for item in items for point in item.entries]
+        x0 = min(p[0] for p in points)
+        y0 = min(p[1] for p in points)
+        x1 = max(p[0] for p in points)
+        y1 = max(p[1] for p in points)
+        self.origin = (x0, y0)
+        self.cellSize = max(x1 - x0, y1 - y0, 1e-9) / max(1, math.sqrt(len(points)))
+        self.columns = int((x1 - x0) / self.cellSize) + 1
+        self.rows = int((y1 - y0) / self.cellSize) + 1
+        self.cells = {}
+        for item in items:
+            for index, point in enumerate(item.entries):
+                self.cells.setdefault(self.cell(point), []).append((item, index))
+
+    def cell(self, point):
+        return (int((point[0] - self.origin[0]) / self.cellSize), int((point[1] - self.origin[1]) / self.cellSize))
+
+    def nearest(self, point, isAvailable):
+        cx, cy = self.cell(point)
+        best = None
+        bestDistance = None
+        for ring in range(max(self.columns, self.rows) + abs(cx) + abs(cy) + 1):
+            # Anything in a farther ring is at least (ring - 1) cells away.
+            if best is not None and (ring - 1) * self.cellSize > bestDistance:
+                break
+            for x in range(cx - ring, cx + ring + 1):
+                for y in range(cy - ring, cy + ring + 1):
+                    if max(abs(x - cx), abs(y - cy)) != ring:
+                        continue
+                    for item, index in self.cells.get((x, y), ()):
+                        if not isAvailable(item):
+                            continue
+                        distance = segmentLength(point, item.entries[index])
+                        if bestDistance is None or distance < bestDistance:
+                            best, bestDistance = (item, index), distance
+        return best
+
+def travelDistance(items, start):
+    result = 0
+    position = start
+    for item in items:
+        result += segmentLength(position, item.start())
+        position = item.end()
+    return result
+
+def nearestNeighborOrder(items, start):
+    grid = EntryGrid(items)
+    done = set()
+    def isAvailable(item):
+        return id(item) not in done and all(id(other) in done for other in item.mustFollow)
+    result = []
+    position = start
+    while len(result) < len(items):
+        nearest = grid.nearest(position, isAvailable)
+        if nearest is None:
+            # mustFollow has a cycle (e.g. two identical outlines); ignore it for what's left.
+            nearest = grid.nearest(position, lambda item: id(item) not in done)
+        item, index = nearest
+        item.entry = index if item.closed else 0
+        done.add(id(item))
+        result.append(item)
+        position = item.end()
+    return result
+
+def twoOpt(items, start, window = 32, passes = 4):
+    """Reverse runs of up to window items while that shortens travel and respects mustFollow."""
+    def link(a, b):
+        return segmentLength(a.end() if a is not None else start, b.start()) if b is not None else 0
+    for _ in range(passes):
+        improved = False
+        for i in range(len(items)):
+            if not items[i].closed:
+                continue
+            previous = items[i - 1] if i else None
+            for j in range(i + 1, min(len(items), i + window)):
+                # Only runs of closed items cost the same to cut backwards.
+                if not items[j].closed:
+                    break
+                following = items[j + 1] if j + 1 < len(items) else None
+                delta = (link(previous, items[j]) + link(items[i], following)
+                         - link(previous, items[i]) - link(items[j], following))
+                if delta >= -1e-9:
+                    continue
+                run = items[i:j + 1]
+                members = set(map(id, run))
+                if any(id(other) in members for item in run for other in item.mustFollow):
+                    continue
+                items[i:j + 1] = reversed(run)
+                improved = True
+        if not improved:
+            break
+    return items
+
+def followsDependencies(items):
+    """Whether every item comes after the items in its mustFollow."""
+    done = set()
+    for item in items:
+        if any(id(other) not in done for other in item.mustFollow):
+            return False
+        done.add(id(item))
+    return True
+
+def orderByTravel(items, start):
+    """Order items to shorten travel between them: nearest neighbor, then 2-opt, then entry points.
+
+    Returns the ordered items and the travel distance before and after.
+    """
+    before = travelDistance(items, start)
+    if len(items) < 2:
+        return items, before, before
+    result = twoOpt(nearestNeighborOrder(items, start), start)
+    position = start
+    for item in result:
+        item.nearestEntry(position)
+        position = item.end()
+    after = travelDistance(result, start)
+    if after > before and followsDependencies(items):
+        # Dependencies can force a worse order than the document's; keep the original then, if it respects them.
+        for item in items:
+            item.entry = 0
+        return items, before, before
+    return result, before, after
+
+def addContainment(items, polygons):
+    """Make each closed polygon follow the items that start inside it.
+
+    polygons[i] is the closed point list of items[i], or None if it is open.
+    """
+    bounds = []
+    for item, polygon in zip(items, polygons):
+        points = polygon or item.entries
+        bounds.append((min(p[0] for p in points), min(p[1] for p in points),
+                       max(p[0] for p in points), max(p[1] for p in points)))
+    byLeft = sorted(range(len(items)), key=lambda i: bounds[i][0])
+    lefts = [bounds[i][0] for i in byLeft]
+    for outer, polygon in enumerate(polygons):
+        if not polygon:
+            continue
+        x0, y0, x1, y1 = bounds[outer]
+        for inner in byLeft[bisect.bisect_left(lefts, x0):bisect.bisect_right(lefts, x1)]:
+            if inner == outer:
+                continue
+            ix0, iy0, ix1, iy1 = bounds[inner]
+            if ix1 <= x1 and iy0 >= y0 and iy1 <= y1 and pointInPolygon(items[inner].entries[0], polygon):
+                items[outer].mustFollow.append(items[inner])
+
+def orderPolylines(polylines, start):
+    """Order polylines for shorter travel, inner ones before the closed ones around them.
+
+    Closed polylines are rotated to start at the vertex nearest the previous cut.
+    Returns the polylines and the travel distance before and after.
+    """
+    items = []
+    polygons = []
+    for polyline in polylines:
+        points = polyline.points.tolist()
+        if polyline.closed:
+            items.append(TravelItem(polyline, points[:-1], closed=True))
+        else:
+            items.append(TravelItem(polyline, points[:1], exit=points[-1]))
+        polygons.append(points if polyline.closed else None)
+    addContainment(items, polygons)
+    items, before, after = orderByTravel(items, start)
+    result = []
+    for item in items:
+        polyline = item.payload
+        if item.closed and item.entry:
+            polyline = polyline.rotated(item.entry)
+        result.append(polyline)
+    return result, before, after
+
+def orderPathElements(elements, transform, start):
+    """Order path elements for shorter travel, judging each by where its outline starts.
+
+    A closed element is still kept after the closed ones inside it, but isn't
+    rotated: its cut starts at its first point, so that is where it is costed.
+    Returns the elements and the travel distance before and after.
+    """
+    items = []
+    polygons = []
+    for element in elements:
+        path = element.path.transform(transform.__mul__(element.transform))
+        points = [(point.x, point.y) for point in path.end_points]
+        closed = len(points) > 2 and path[-1].letter in 'Zz'
+        if closed:
+            items.append(TravelItem(element, points[:1], closed=True))
+        else:
+            items.append(TravelItem(element, points[:1], exit=points[-1] if points else start))
+        polygons.append(points if closed else None)
+    addContainment(items, polygons)
+    items, before, after = orderByTravel(items, start)
+    return [item.payload for item in items], before, after
+
+# An outer contour listed first is still cut after the one inside it.
+assert orderPolylines([Polyline([(0, 0), (10, 0), (10, 10), (0, 10), (0, 0)], closed=True),
+                       Polyline([(4, 4), (6, 4), (6, 6), (4, 6), (4, 4)], closed=True)], (0, 0))[0][0].points.min() == 4
@@ -1,6 +1,9 @@
 from exportIgnore import exportIgnore
+from exportImage import exportImage
 from exportPath import exportPath
 from exportLayer import exportLayer
+from exportUse import exportUse
+from instrumentation import instrumented
 
 from inkex_ex import getElementNamespace, typeName
 
@@ -9,13 +12,22 @@ elementExportFunctions = {
     'Group': exportLayer,
     'Circle': exportPath,
     'Ellipse': exportPath,
+    'Image': exportImage,
     'PathElement': exportPath,
     'Rectangle': exportPath,
+    'Use': exportUse,
 }
 
-def visitElement(stream, elem, transform):
-    stream.comment(f'visitElement: {getElementNamespace(elem)}:{elem.TAG} => {typeName(elem)} {elem.get_id()} {elem.label}')
+def isPathElement(elem):
+    return elementExportFunctions.get(typeName(elem)) is exportPath
+
+@instrumented('visitElement')
+def visitElement(stream, elem, transform, parentStyle = None):
+    """Export elem and its children. transform maps elem's parent's coordinates to gcode,
+    and parentStyle is the parent's composed style (None to compute it from the document)."""
+    if stream.isTracing():
+        stream.trace('visitElement: {}:{} => {} {} {}', getElementNamespace(elem), elem.TAG, typeName(elem), elem.get_id(), elem.label)
     fn = elementExportFunctions.get(typeName(elem), exportIgnore)
-    fn(stream.indent(), elem, transform, {'visitElement':visitElement})
+    fn(stream.indent(), elem, transform, {'visitElement':visitElement, 'isPathElement':isPathElement}, parentStyle)
 
     